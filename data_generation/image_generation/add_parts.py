@@ -6,9 +6,21 @@ import time
 import json
 import os
 import sys
+import re
+import tempfile
+import gzip
+import struct
+import threading
+import contextlib
 import numpy as np
 from subprocess import call
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # No lock file on Windows; concurrent renderers may then evict twice
+    fcntl = None
 
 colors = {
       "gray": [87, 87, 87],
@@ -21,23 +33,572 @@ colors = {
       "yellow": [255, 238, 51]
     }
 
-def load_obj(fn):
-    fin = open(fn, 'r')
-    lines = [line.rstrip() for line in fin]
-    fin.close()
+# The texture and normal parts of 'i/t', 'i//n' and 'i/t/n' face references
+OBJ_REF_SUFFIX_RE = re.compile(r'/\S*')
+
+def parse_obj(fn):
+    """
+    Reads the vertex positions and faces of an OBJ file. Returns v, a float32
+    array of shape (N, 3), and f, an int32 array of shape (M, 3) holding
+    1-based vertex indices. Polygons with more than three vertices are split
+    into a triangle fan.
+    """
+    with open(fn, 'r') as fin:
+        lines = fin.read().split('\n')
+
+    # Trailing comments are dropped and every line is split into its values;
+    # the blocks are converted in one go when each line has exactly three of
+    # them, and only truncated line by line otherwise
+    vertices = [line[2:].split('#', 1)[0].split() for line in lines if line.startswith('v ')]
+    faces = [line[2:].split('#', 1)[0] for line in lines if line.startswith('f ')]
+    if not vertices or not faces:
+        raise ValueError('%s contains no faces' % fn)
+
+    if any(len(row) != 3 for row in vertices):
+        if any(len(row) < 3 for row in vertices):
+            raise ValueError('%s has a vertex with fewer than three coordinates' % fn)
+        vertices = [row[:3] for row in vertices]
+    try:
+        v = np.array(vertices, dtype=np.float64)
+    except ValueError:
+        raise ValueError('%s has a vertex coordinate that is not a number' % fn)
+
+    faces = [OBJ_REF_SUFFIX_RE.sub('', line).split() if '/' in line else line.split() for line in faces]
+    if any(len(row) != 3 for row in faces):
+        if any(len(row) < 3 for row in faces):
+            raise ValueError('%s has a face with fewer than three vertices' % fn)
+        fan = []
+        for idx in faces:
+            for i in range(1, len(idx) - 1):
+                fan.append((idx[0], idx[i], idx[i + 1]))
+        faces = fan
+    try:
+        f = np.array(faces, dtype=np.int64)
+    except ValueError:
+        raise ValueError('%s has a face index that is not an integer' % fn)
+
+    v = v.astype(np.float32).reshape(-1, 3)
+    f = f.astype(np.int32).reshape(-1, 3)
 
-    vertices = []; faces = [];
-    for line in lines:
-        if line.startswith('v '):
-            vertices.append(np.float32(line.split()[1:4]))
-        elif line.startswith('f '):
-            faces.append(np.int32([item.split('/')[0] for item in line.split()[1:4]]))
+    return v, f
 
-    f = np.vstack(faces)
-    v = np.vstack(vertices)
+class MeshCache(object):
+    """
+    On-disk cache of parsed leaf meshes, shared by concurrent renderers.
+
+    A leaf mesh <shape id>/<objs dir>/<leaf id>.obj is stored as two .npy
+    files, <leaf id>.<mtime>.v.npy and <leaf id>.<mtime>.f.npy, under the
+    same relative directory of cache_dir, so editing the source file makes
+    the entry stale. Entries are read memory-mapped copy-on-write, so callers
+    may still scale the returned vertices in place.
+
+    Files are written to a temporary name and renamed into place, faces
+    first, so a reader sees either no entry or a complete one. Once the cache
+    grows past max_bytes the least recently used entries are removed until it
+    is back under 90% of the bound; every hit refreshes the mtime of the
+    vertex file, which is what the eviction order is based on.
+
+    total_bytes only follows the writes of this process, so the cache is
+    scanned again under a lock file whenever this process has written
+    another RESCAN_FRACTION of max_bytes; other renderers can thus only push
+    it past the bound by that much each.
+    """
+    # Share of max_bytes written by this process between two scans
+    RESCAN_FRACTION = 0.1
+    # Age in seconds after which a temporary file is left over from a
+    # renderer that died while writing it
+    STALE_TMP_AGE = 3600
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        # Guards total_bytes against the Prefetcher threads
+        self.lock = threading.Lock()
+        self.total_bytes = sum(size for _, size, _ in self.scan())
+        self.bytes_since_scan = 0
+
+    def entry(self, fn):
+        part_dir = os.path.dirname(os.path.abspath(fn))
+        shape_id = os.path.basename(os.path.dirname(part_dir))
+        leaf_id = os.path.splitext(os.path.basename(fn))[0]
+        entry_dir = os.path.join(self.cache_dir, shape_id, os.path.basename(part_dir))
+        key = '%s.%d' % (leaf_id, os.stat(fn).st_mtime_ns)
+        return entry_dir, leaf_id, os.path.join(entry_dir, key)
+
+    def load(self, fn):
+        _, _, prefix = self.entry(fn)
+        try:
+            v = np.load(prefix + '.v.npy', mmap_mode='c')
+            f = np.load(prefix + '.f.npy', mmap_mode='c')
+            os.utime(prefix + '.v.npy', None)
+        except (IOError, OSError, ValueError):
+            return None
+        return v, f
+
+    def store(self, fn, v, f):
+        entry_dir, leaf_id, prefix = self.entry(fn)
+        written = 0
+        try:
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir, exist_ok=True)
+            # Drop the entries of older versions of this leaf
+            for name in os.listdir(entry_dir):
+                path = os.path.join(entry_dir, name)
+                if name.endswith('.npy') and name.split('.')[0] == leaf_id and not path.startswith(prefix + '.'):
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    written -= size
+            for suffix, array in (('.f.npy', f), ('.v.npy', v)):
+                fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as fout:
+                    np.save(fout, array)
+                os.replace(tmp_path, prefix + suffix)
+                written += os.path.getsize(prefix + suffix)
+        except (IOError, OSError):
+            # A full or read-only cache must never stop the rendering
+            pass
+        with self.lock:
+            self.total_bytes += written
+            self.bytes_since_scan += max(written, 0)
+            if (self.total_bytes > self.max_bytes
+                    or self.bytes_since_scan > self.RESCAN_FRACTION * self.max_bytes):
+                self.evict()
+
+    def scan(self):
+        """
+        Returns a list of (mtime, size, paths) for every entry in the cache,
+        and for every temporary file, which is an entry of its own.
+        """
+        entries = {}
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith('.npy') and not name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                prefix = path[:-len('.v.npy')] if name.endswith('.npy') else path
+                mtime, size, paths = entries.get(prefix, (0, 0, []))
+                entries[prefix] = (max(mtime, st.st_mtime), size + st.st_size, paths + [path])
+        return list(entries.values())
+
+    @contextlib.contextmanager
+    def dir_lock(self):
+        """
+        Holds an exclusive lock on the cache directory, shared by all the
+        renderers using it.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self):
+        """
+        Recomputes total_bytes from the files in the cache, removes the
+        temporary files older than STALE_TMP_AGE, and the least recently used
+        entries while the cache is over max_bytes. Called with self.lock held.
+        """
+        with self.dir_lock():
+            entries = sorted(self.scan())
+            total = sum(size for _, size, _ in entries)
+            evicting = total > self.max_bytes
+            now = time.time()
+            for mtime, size, paths in entries:
+                if paths[0].endswith('.tmp'):
+                    # Another renderer may still be writing a recent one
+                    if now - mtime < self.STALE_TMP_AGE:
+                        continue
+                elif not evicting or total <= 0.9 * self.max_bytes:
+                    continue
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+        self.total_bytes = total
+        self.bytes_since_scan = 0
+
+mesh_cache = None
+
+def set_mesh_cache(cache_dir, max_bytes):
+    """
+    Makes load_obj go through a MeshCache in cache_dir; None disables it.
+    """
+    global mesh_cache
+    mesh_cache = MeshCache(cache_dir, max_bytes) if cache_dir else None
 
+def load_obj(fn):
+    """
+    Same as parse_obj, served from the mesh cache when one is set.
+    """
+    if mesh_cache is not None:
+        cached = mesh_cache.load(fn)
+        if cached is not None:
+            return cached
+    v, f = parse_obj(fn)
+    if mesh_cache is not None:
+        mesh_cache.store(fn, v, f)
     return v, f
 
+# Bump whenever the annotations derived by annotate_parts or
+# annotate_parts_physics change, so that cached ones are derived again
+ANNOTATION_VERSION = 1
+
+def annotation_to_json(annotation):
+    data = dict(annotation)
+    for name in ['line_dict', 'plane_dict']:
+        data[name] = {part: [np.asarray(g).tolist() for g in geos] for part, geos in annotation[name].items()}
+    return data
+
+def annotation_from_json(data):
+    data['parts'] = [tuple(p) for p in data['parts']]
+    return data
+
+class AnnotationCache(object):
+    """
+    Keeps the placement independent annotations of each shape (see
+    annotate_parts) together with its check_part verdict, so that a shape
+    placed again only needs the rotation applied by revise_annotations.
+    Entries live in memory and, when cache_dir is given, as one JSON file per
+    shape that renderers running in parallel can share. Keys include
+    ANNOTATION_VERSION, so entries written by older code are never read.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.entries = dict()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        if key in self.entries:
+            return self.entries[key]
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.path(key), 'r') as fin:
+                entry = json.load(fin)
+        except (IOError, OSError, ValueError):
+            return None
+        entry['annotation'] = annotation_from_json(entry['annotation'])
+        self.entries[key] = entry
+        return entry
+
+    def put(self, key, annotation, keep):
+        entry = {'annotation': annotation, 'keep': keep}
+        self.entries[key] = entry
+        if not self.cache_dir:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fout:
+                json.dump({'annotation': annotation_to_json(annotation), 'keep': keep}, fout)
+            os.replace(tmp_path, self.path(key))
+        except (IOError, OSError):
+            # A full or read-only cache must never stop the rendering
+            return
+
+def annotation_key(kind, obj_name, cur_part_dir):
+    """
+    Cache key of the annotations of the shape in cur_part_dir, placed as an
+    obj_name by the renderer kind ('partnet' or 'physics'). Annotations
+    derived with use_plane_flatness get keys of their own.
+    """
+    part_dir = os.path.abspath(cur_part_dir)
+    shape_id = os.path.basename(os.path.dirname(part_dir))
+    return '%s-%s-%s-%s-v%d%s' % (kind, obj_name, shape_id, os.path.basename(part_dir), ANNOTATION_VERSION,
+                                 '-flat' if use_plane_flatness else '')
+
+annotation_cache = AnnotationCache()
+
+def set_annotation_cache(cache_dir):
+    """
+    Keeps the annotation cache in cache_dir as well as in memory; None keeps
+    it in memory only.
+    """
+    global annotation_cache
+    annotation_cache = AnnotationCache(cache_dir)
+
+def cached_annotation(key):
+    """
+    Returns the cached {'annotation': ..., 'keep': ...} entry of a shape, or
+    None if it has not been annotated yet.
+    """
+    return annotation_cache.get(key)
+
+def cache_annotation(key, annotation, keep):
+    annotation_cache.put(key, annotation, keep)
+
+# Bump whenever the content of the catalog written by
+# part_utils/build_shape_catalog.py changes
+CATALOG_VERSION = 1
+
+shape_catalog = None
+
+def set_shape_catalog(path):
+    """
+    Loads the shape catalog written by part_utils/build_shape_catalog.py;
+    None leaves the renderers reading the category lists and shape
+    directories at every placement.
+    """
+    global shape_catalog
+    if not path:
+        shape_catalog = None
+        return
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as fin:
+        catalog = json.load(fin)
+    if catalog.get('version') != CATALOG_VERSION:
+        raise ValueError('%s was built by another version of build_shape_catalog.py, build it again' % path)
+    catalog['_ids'] = dict()
+    shape_catalog = catalog
+
+def has_shape_catalog():
+    return shape_catalog is not None
+
+def catalog_shape_ids(list_name, split, kind):
+    """
+    Ids of the shapes in the given split of a category list
+    (data/<list_name>.json) that pass check_part in the renderer kind
+    ('partnet' or 'physics'), repeated as often as in the list. Raises a
+    ValueError when there are none, since no shape could be drawn then.
+    """
+    key = (list_name, split, kind)
+    if key not in shape_catalog['_ids']:
+        if list_name not in shape_catalog['lists']:
+            raise ValueError('the shape catalog has no list data/%s.json, build it again' % list_name)
+        cur_list = shape_catalog['lists'][list_name]
+        shapes = shape_catalog['shapes']
+        ids = []
+        for shape_id in cur_list['splits'][split]:
+            entry = shapes.get('%s/%s' % (cur_list['dataset'], shape_id))
+            if entry is not None and entry['keep'][cur_list['category']][kind]:
+                ids.append(shape_id)
+        if not ids:
+            raise ValueError('no shape of the %s split of data/%s.json passes check_part in the %s renderer; '
+                             'leave the category out of --properties_json or build the catalog again'
+                             % (split, list_name, kind))
+        shape_catalog['_ids'][key] = ids
+    return shape_catalog['_ids'][key]
+
+def catalog_shape(dataset, shape_id):
+    """
+    Catalog entry of a shape of the 'partnet' or 'mobility' dataset, or None
+    when there is no catalog.
+    """
+    if shape_catalog is None:
+        return None
+    return shape_catalog['shapes'].get('%s/%s' % (dataset, shape_id))
+
+shape_library_dir = None
+
+def set_shape_library(library_dir):
+    """
+    Makes the renderers append the shapes written to library_dir by
+    part_utils/build_shape_library.py from their .blend library; None builds
+    every shape from its leaf meshes.
+    """
+    global shape_library_dir
+    shape_library_dir = library_dir
+
+def shape_library_entry(key, radius):
+    """
+    Metadata of the .blend library of the shape with annotation key key (see
+    annotation_key), with the path of the library in 'blend' and the
+    (part, (v, f)) of its objects in 'parts' for the placement prechecks,
+    None when the library has no .npz file for them. None when there is no
+    library directory, when the shape is not in it or when it was written
+    for another radius.
+    """
+    if shape_library_dir is None:
+        return None
+    try:
+        with open(os.path.join(shape_library_dir, key + '.json'), 'r') as fin:
+            entry = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return None
+    if entry['radius'] != radius:
+        return None
+    entry['annotation'] = annotation_from_json(entry['annotation'])
+    entry['blend'] = os.path.join(shape_library_dir, key + '.blend')
+    try:
+        with np.load(os.path.join(shape_library_dir, key + '.npz')) as meshes:
+            entry['parts'] = [(part, (meshes['v%d' % k], meshes['f%d' % k]))
+                              for k, part in enumerate(entry['objects'])]
+    except (IOError, OSError, KeyError, ValueError):
+        entry['parts'] = None
+    return entry
+
+class Prefetcher(object):
+    """
+    Prepares tasks ahead of time in background threads. next_task() draws
+    the tasks in order in the calling thread and prepare(*task) runs in the
+    pool, with at most depth tasks drawn ahead of the one get returns. The
+    time get spends waiting for a task that is not ready yet adds up in
+    wait_time.
+    """
+    def __init__(self, next_task, prepare, depth, num_workers):
+        self.next_task = next_task
+        self.prepare = prepare
+        self.depth = depth
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.queue = deque()
+        self.wait_time = 0.0
+        self.num_tasks = 0
+        self.fill()
+
+    def fill(self):
+        while len(self.queue) < self.depth:
+            task = self.next_task()
+            self.queue.append((task, self.pool.submit(self.prepare, *task)))
+
+    def get(self):
+        task, future = self.queue.popleft()
+        self.fill()
+        tic = time.time()
+        result = future.result()
+        self.wait_time += time.time() - tic
+        self.num_tasks += 1
+        return task, result
+
+    def close(self):
+        for _, future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        self.pool.shutdown(wait=True)
+
+def load_part_meshes(cur_part_dir, leaf_part_ids, radius):
+    """
+    Loads every leaf mesh of a shape once and scales the shape so that its
+    farthest vertex lies at distance radius from the origin. Returns the
+    scale that was divided out and a dict mapping each leaf id to its (v, f);
+    the vertex arrays are views into one buffer that is scaled in place.
+    """
+    leaves = [load_obj(os.path.join(cur_part_dir, idx+'.obj')) for idx in leaf_part_ids]
+    root_v = np.vstack([v for v, _ in leaves])
+
+    scale = np.sqrt(np.max(np.sum(root_v**2, axis=1)))
+    scale /= radius
+    root_v /= scale
+    # center = np.min(root_v, axis=0)
+    # root_v -= center
+
+    meshes = dict()
+    start = 0
+    for idx, (v, f) in zip(leaf_part_ids, leaves):
+        meshes[idx] = (root_v[start:start+v.shape[0]], f)
+        start += v.shape[0]
+
+    return scale, meshes
+
+EXR_MAGIC = 20000630
+# OpenEXR pixel type codes: UINT, HALF and FLOAT
+EXR_PIXEL_TYPES = {0: '<u4', 1: '<f2', 2: '<f4'}
+
+def read_exr(path):
+    """
+    Reads an uncompressed scanline OpenEXR file, as Blender writes it with
+    exr_codec 'NONE'. Returns a dict mapping each channel name to a (H, W)
+    array, top row first as in the PNG files Blender writes.
+    """
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    magic, version = struct.unpack_from('<ii', data, 0)
+    if magic != EXR_MAGIC or version & 0x1e00:
+        raise ValueError('%s is not a single part scanline OpenEXR file' % path)
+
+    header = dict()
+    pos = 8
+    while data[pos] != 0:
+        name_end = data.index(b'\0', pos)
+        type_end = data.index(b'\0', name_end + 1)
+        size, = struct.unpack_from('<i', data, type_end + 1)
+        header[data[pos:name_end].decode()] = data[type_end+5:type_end+5+size]
+        pos = type_end + 5 + size
+    pos += 1
+
+    if header['compression'][0] != 0:
+        raise ValueError('%s is compressed, write it with exr_codec NONE' % path)
+    xmin, ymin, xmax, ymax = struct.unpack('<iiii', header['dataWindow'])
+    width, height = xmax - xmin + 1, ymax - ymin + 1
+
+    # Channels are listed, and stored in each scanline, sorted by name
+    channels = []
+    chlist = header['channels']
+    at = 0
+    while chlist[at] != 0:
+        name_end = chlist.index(b'\0', at)
+        pixel_type, = struct.unpack_from('<i', chlist, name_end + 1)
+        channels.append((chlist[at:name_end].decode(), EXR_PIXEL_TYPES[pixel_type], (width,)))
+        at = name_end + 17
+
+    # Without compression every block holds one scanline: its y, its size
+    # and then the values of each channel
+    row = np.dtype([('y', '<i4'), ('size', '<i4')] + channels)
+    offsets = np.frombuffer(data, '<u8', height, pos)
+    rows = np.concatenate([np.frombuffer(data, row, 1, int(offset)) for offset in offsets])
+    rows = rows[np.argsort(rows['y'], kind='stable')]
+    return {name: np.array(rows[name]) for name, _, _ in channels}
+
+def index_masks(path, indices, box=None, frame_shape=None):
+    """
+    Decodes the masks of the objects with the given pass indices from the
+    IndexOB pass written to path (see utils.add_index_output), all at once.
+    When the render only covered the pixel box (row0, row1, col0, col1) of
+    a frame of frame_shape, the masks are put back into the full frame.
+    Returns a (len(indices), H, W) uint8 array of 0 and 255, as the
+    CompositorNodeIDMask PNGs it replaces.
+    """
+    channels = read_exr(path)
+    index = channels['R'] if 'R' in channels else next(iter(channels.values()))
+    index = np.rint(index).astype(np.int32)
+    if box is not None and index.shape != tuple(frame_shape):
+        row0, row1, col0, col1 = box
+        if index.shape != (row1 - row0, col1 - col0):
+            raise ValueError('%s is %dx%d, which is neither the frame nor the render border'
+                             % ((path,) + index.shape[::-1]))
+        frame = np.zeros(frame_shape, dtype=np.int32)
+        frame[row0:row1, col0:col1] = index
+        index = frame
+    masks = index[None, :, :] == np.asarray(indices, dtype=np.int32)[:, None, None]
+    return masks.astype(np.uint8) * 255
+
+def placement_parts(meshes, annotation, leaf_part_ids):
+    """
+    The (part, (v, f)) of every object add_one_part and the 'other' leaves
+    of the renderers add for a shape, in the order they are added, which is
+    the order of their pass indices and masks.
+    """
+    parts = [(part, gather_part_mesh(meshes, leaves)) for part, leaves in annotation['parts']]
+    rendered = set(leaf for objs in annotation['objs_dict'].values() for leaf in objs)
+    parts += [('other', meshes[idx]) for idx in leaf_part_ids if idx not in rendered]
+    return parts
+
+# Rows formatted at once by write_rows; bounds the size of the strings built
+EXPORT_CHUNK_ROWS = 65536
+
+def write_rows(fout, line_format, array):
+    """
+    Writes line_format % row for every row of array, formatting a whole
+    chunk of rows with a single % instead of one call per row.
+    """
+    for start in range(0, array.shape[0], EXPORT_CHUNK_ROWS):
+        chunk = array[start:start+EXPORT_CHUNK_ROWS]
+        fout.write((line_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
 def export_obj(out, v, f, color):
     color = color[:3]
     mtl_out = out.replace('.obj', '.mtl')
@@ -45,10 +606,8 @@ def export_obj(out, v, f, color):
     with open(out, 'w') as fout:
         fout.write('mtllib %s\n' % mtl_out)
         fout.write('usemtl m1\n')
-        for i in range(v.shape[0]):
-            fout.write('v %f %f %f\n' % (v[i, 0], v[i, 1], v[i, 2]))
-        for i in range(f.shape[0]):
-            fout.write('f %d %d %d\n' % (f[i, 0], f[i, 1], f[i, 2]))
+        write_rows(fout, 'v %f %f %f\n', v)
+        write_rows(fout, 'f %d %d %d\n', f)
 
     with open(mtl_out, 'w') as fout:
         fout.write('newmtl m1\n')
@@ -57,10 +616,29 @@ def export_obj(out, v, f, color):
 
     return mtl_out
 
+# Builds a part directly in the running Blender scene when set, see
+# set_mesh_builder
+mesh_builder = None
+
+def set_mesh_builder(builder):
+    """
+    Makes add_mesh and add_mesh2 call builder(name, v, f, color) to build each
+    part in the running Blender scene, instead of importing it into a .blend
+    file in tmp_dir in a separate Blender process; None goes back to the
+    .blend files. This module does not import bpy, so the renderers pass
+    utils.add_part_mesh.
+    """
+    global mesh_builder
+    mesh_builder = builder
+
 def add_mesh(obj_name, v, f, cur_render_dir, color=[0.216, 0.494, 0.722]):
     tmp_dir = cur_render_dir
     if not os.path.exists(tmp_dir):
         os.mkdir(tmp_dir)
+
+    if mesh_builder is not None:
+        mesh_builder(obj_name, v, f, color)
+        return
     
     tmp_obj = os.path.join(tmp_dir, obj_name+'.obj')
     blend = tmp_obj.replace('.obj', '.blend')
@@ -89,6 +667,12 @@ def add_mesh2(obj_name, part, v, f, tmp_dir, color=[0.216, 0.494, 0.722]):
 
     tmp_mtl = export_obj(tmp_obj, v, f, color=color)
 
+    # The .obj is still needed by the URDF model; the part is named after
+    # it, as when it is imported
+    if mesh_builder is not None:
+        mesh_builder(os.path.basename(tmp_obj)[:-len('.obj')], v, f, color)
+        return
+
     if obj_name+'.blend' in os.listdir(tmp_dir):
         cmd = 'bash image_generation/part_utils/add_part.sh %s %s %s' % (blend, tmp_obj, blend)
     else:
@@ -99,166 +683,175 @@ def add_mesh2(obj_name, part, v, f, tmp_dir, color=[0.216, 0.494, 0.722]):
     cmd = 'rm -rf %s' % (blend+"1")
     call(cmd, shell=True)
 
-def add_one_part(scale, data, cur_part_dir, cur_render_dir, obj_name, part_list, geo_list1, geo_list2, part_dict = dict(), count_dict = dict(), objs_dict = dict(), final_objs = [], line_dict = dict(), plane_dict = dict()):
-    
-    cur_v_list = []; cur_f_list = []; cur_v_num = 0; 
-    
-    part = data['name']  
-
-    part = rename_one_part(part, obj_name)
+def walk_part_tree(tree, obj_name, meshes=None):
+    """
+    Walks a PartNet part hierarchy (result_after_merging.json) without
+    recursion. Returns the renamed part of every node in pre-order, and a
+    post-order list of (node, part, leaves) where leaves are the leaf ids
+    whose meshes make up the node: its own 'objs' if it has any, otherwise
+    the leaves of its children in order. When meshes is given, leaves
+    without a mesh are left out.
+    """
+    parts = []
+    nodes = []
+    child_leaves = dict()
+    stack = [(tree, None)]
+    while stack:
+        data, part = stack.pop()
+        if part is None:
+            part = rename_one_part(data['name'], obj_name)
+            parts.append(part)
+            stack.append((data, part))
+            for child in reversed(data.get('children', [])):
+                stack.append((child, None))
+            continue
+
+        children = [child_leaves.pop(id(child)) for child in data.get('children', [])]
+        if 'objs' in data:
+            leaves = [leaf for leaf in data['objs'] if meshes is None or leaf in meshes]
+        else:
+            leaves = [leaf for cur_leaves in children for leaf in cur_leaves]
+        child_leaves[id(data)] = leaves
+        nodes.append((data, part, leaves))
+    return parts, nodes
+
+def gather_part_mesh(meshes, leaves):
+    """
+    Stacks the leaf meshes of one part into its own (v, f).
+    """
+    cur_v_list = []; cur_f_list = []; cur_v_num = 0;
+    for leaf in leaves:
+        v, f = meshes[leaf]
+        cur_v_list.append(v)
+        cur_f_list.append(f+cur_v_num)
+        cur_v_num += v.shape[0]
 
-    if part in count_dict.keys():
-        count_dict[part] += 1
-    else:
-        count_dict[part] = 1
-
-    if 'objs' in data.keys():
-        for child in data['objs']:
-            v, f = load_obj(os.path.join(cur_part_dir, child+'.obj'))
-            # v -= center
-            v /= scale
-            cur_v_list.append(v)
-            cur_f_list.append(f+cur_v_num)
-            cur_v_num += v.shape[0]
-    if 'children' in data.keys():
-        for child in data['children']:
-            v, f, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict = add_one_part(scale, child, cur_part_dir, cur_render_dir, obj_name, part_list, geo_list1, geo_list2, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict)
-            if 'objs' not in data.keys():
-                cur_v_list.append(v)
-                cur_f_list.append(f+cur_v_num)
-                cur_v_num += v.shape[0]
-    
     part_v = np.vstack(cur_v_list)
     part_f = np.vstack(cur_f_list)
 
-    chosen_v = []
-
-    for face in part_f:
-        for fa in face:
-            chosen_v.append(part_v[fa-1])
-
-    chosen_v = np.array(chosen_v)
+    return part_v, part_f
 
-    if part in part_list:
-        keep = True
+def choose_part_color(part, part_dict):
+    if not part in part_dict.keys():
+        color_name, rgba = random.choice(list(colors.items()))
 
-        if part == 'chair_arm' and ('arm_near_vertical_bar' in part_dict.keys() or 'arm_horizontal_bar' in part_dict.keys()):
-            keep = False
-        # if part == 'chair_back' and ('back_frame_vertical_bar' in part_dict.keys() or 'back_frame_horizontal_bar' in part_dict.keys()):
-        #     keep = False
-        if keep:
-            line_dict, plane_dict = find_equation(part, chosen_v, geo_list1, geo_list2, line_dict, plane_dict)
-
-            final_objs.append(part)
-            if not part in objs_dict.keys():
-                objs_dict[part] = []
-            objs_dict[part].extend(data['objs'])
-
-            if not part in part_dict.keys():
+        if (part == 'arm_near_vertical_bar' and 'arm_horizontal_bar' in part_dict.keys()):
+            while color_name == part_dict['arm_horizontal_bar'][0]:
                 color_name, rgba = random.choice(list(colors.items()))
-            
-
-                if (part == 'arm_near_vertical_bar' and 'arm_horizontal_bar' in part_dict.keys()):
-                    while color_name == part_dict['arm_horizontal_bar'][0]:
-                        color_name, rgba = random.choice(list(colors.items()))
 
-                if (part == 'arm_horizontal_bar' and 'arm_near_vertical_bar' in part_dict.keys()):
-                    while color_name == part_dict['arm_near_vertical_bar'][0]:
-                        color_name, rgba = random.choice(list(colors.items()))
-
-                part_dict[part] = (color_name, rgba)
-
-            color_name = part_dict[part][0]
-            rgba = [float(int(c)) / 255.0 for c in part_dict[part][1]] + [1.0]
-            
-            add_mesh(obj_name, part_v, part_f, cur_render_dir, color=rgba)
-
-    return part_v, part_f, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict
-
-
-def add_one_part_physics(scale, data, cur_part_dir, cur_render_dir, obj_name, part_list, geo_list1, geo_list2, tmp_dir, part_dict = dict(), count_dict = dict(), objs_dict = dict(), final_objs = [], line_dict = dict(), plane_dict = dict()):
-    cur_v_list = []; cur_f_list = []; cur_v_num = 0; 
-    
-    part = data['name']
-    part = rename_one_part(part, obj_name)
+        if (part == 'arm_horizontal_bar' and 'arm_near_vertical_bar' in part_dict.keys()):
+            while color_name == part_dict['arm_near_vertical_bar'][0]:
+                color_name, rgba = random.choice(list(colors.items()))
 
-    i = 0
-    if 'objs' in data.keys():
-        for child in data['objs']:
-            try:
-                v, f = load_obj(os.path.join(cur_part_dir, child+'.obj'))
-                # v -= center
-                v /= scale
-                cur_v_list.append(v)
-                cur_f_list.append(f+cur_v_num)
-                cur_v_num += v.shape[0]
-                i += 1
-            except:
-                pass
-    if 'children' in data.keys():
-        for child in data['children']:
-            v, f, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict = add_one_part_physics(scale, child, cur_part_dir, cur_render_dir, obj_name, part_list, geo_list1, geo_list2, tmp_dir, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict)
-            if 'objs' not in data.keys() and (not v == np.vstack([[]])):
-                cur_v_list.append(v)
-                cur_f_list.append(f+cur_v_num)
-                cur_v_num += v.shape[0]
-                i += 1
-    keep = True
+        part_dict[part] = (color_name, rgba)
 
-    if i == 0: 
-        keep = False
-        cur_v_list = [[]]
-        cur_f_list = [[]]
-    part_v = np.vstack(cur_v_list)
-    part_f = np.vstack(cur_f_list)
+    return [float(int(c)) / 255.0 for c in part_dict[part][1]] + [1.0]
 
-    
-    if part == 'chair_arm' and ('arm_near_vertical_bar' in part_dict.keys() or 'arm_horizontal_bar' in part_dict.keys()):
-        keep = False
+def annotate_parts(meshes, tree, obj_name, part_list, geo_list1, geo_list2):
+    """
+    Derives the annotations of a shape that do not depend on where it is
+    placed: the annotated parts of the hierarchy with their leaves, children
+    before their parents, and count_dict, objs_dict, line_dict and
+    plane_dict, with the lines and planes before any rotation.
+    """
+    parts = []; count_dict = dict(); objs_dict = dict()
+    line_dict = dict(); plane_dict = dict()
 
-    if keep:
+    all_parts, nodes = walk_part_tree(tree, obj_name)
+    for part in all_parts:
         if part in count_dict.keys():
             count_dict[part] += 1
         else:
             count_dict[part] = 1
 
-    chosen_v = []
-
-    for face in part_f:
-        for fa in face:
-            chosen_v.append(part_v[fa-1])
-
-    chosen_v = np.array(chosen_v)
+    for data, part, leaves in nodes:
+        if part not in part_list:
+            continue
+        if part == 'chair_arm' and any(p in ['arm_near_vertical_bar', 'arm_horizontal_bar'] for p, _ in parts):
+            continue
+        # if part == 'chair_back' and ('back_frame_vertical_bar' in part_dict.keys() or 'back_frame_horizontal_bar' in part_dict.keys()):
+        #     continue
+        part_v, part_f = gather_part_mesh(meshes, leaves)
+        chosen_v = part_v[part_f-1].reshape(-1, 3)
+        line_dict, plane_dict = find_equation(part, chosen_v, geo_list1, geo_list2, line_dict, plane_dict)
+
+        parts.append((part, leaves))
+        if not part in objs_dict.keys():
+            objs_dict[part] = []
+        objs_dict[part].extend(data['objs'])
+
+    return {'parts': parts, 'count_dict': count_dict, 'objs_dict': objs_dict,
+            'line_dict': line_dict, 'plane_dict': plane_dict}
+
+def annotate_parts_physics(meshes, tree, obj_name, part_list, geo_list1, geo_list2):
+    """
+    Same as annotate_parts for the physics scenes: parts are only counted
+    once they have a mesh.
+    """
+    parts = []; count_dict = dict(); objs_dict = dict()
+    line_dict = dict(); plane_dict = dict()
+
+    _, nodes = walk_part_tree(tree, obj_name, meshes)
+    for data, part, leaves in nodes:
+        keep = len(leaves) > 0
+        if part == 'chair_arm' and any(p in ['arm_near_vertical_bar', 'arm_horizontal_bar'] for p, _ in parts):
+            keep = False
+        if not keep:
+            continue
 
+        if part in count_dict.keys():
+            count_dict[part] += 1
+        else:
+            count_dict[part] = 1
 
-    if part in part_list:
-        if keep:
+        if part in part_list:
+            part_v, part_f = gather_part_mesh(meshes, leaves)
+            chosen_v = part_v[part_f-1].reshape(-1, 3)
             line_dict, plane_dict = find_equation(part, chosen_v, geo_list1, geo_list2, line_dict, plane_dict)
-            final_objs.append(part)
+            parts.append((part, leaves))
             if not part in objs_dict.keys():
                 objs_dict[part] = []
             objs_dict[part].extend(data['objs'])
 
-            if not part in part_dict.keys():
-                color_name, rgba = random.choice(list(colors.items()))
-                
-
-                if (part == 'arm_near_vertical_bar' and 'arm_horizontal_bar' in part_dict.keys()):
-                    while color_name == part_dict['arm_horizontal_bar'][0]:
-                        color_name, rgba = random.choice(list(colors.items()))
-
-                if (part == 'arm_horizontal_bar' and 'arm_near_vertical_bar' in part_dict.keys()):
-                    while color_name == part_dict['arm_near_vertical_bar'][0]:
-                        color_name, rgba = random.choice(list(colors.items()))
-
-                part_dict[part] = (color_name, rgba)
-
-            color_name = part_dict[part][0]
-            rgba = [float(int(c)) / 255.0 for c in part_dict[part][1]] + [1.0]
-            
-            add_mesh2(obj_name, part, part_v, part_f, tmp_dir, color=rgba)
-
-    return part_v, part_f, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict
+    return {'parts': parts, 'count_dict': count_dict, 'objs_dict': objs_dict,
+            'line_dict': line_dict, 'plane_dict': plane_dict}
+
+def add_one_part(meshes, annotation, cur_render_dir, obj_name):
+    """
+    Adds one mesh per annotated part of a shape (see annotate_parts) to the
+    blend file of the object, or to the scene (see set_mesh_builder).
+    meshes is None when the parts are appended from a shape library.
+    Returns part_dict, count_dict, objs_dict, final_objs, line_dict and
+    plane_dict; the dicts are copies, so the annotation can be reused for
+    the next placement of the shape.
+    """
+    part_dict = dict(); final_objs = []
+    for part, leaves in annotation['parts']:
+        part_v, part_f = gather_part_mesh(meshes, leaves) if meshes is not None else (None, None)
+        final_objs.append(part)
+        rgba = choose_part_color(part, part_dict)
+        add_mesh(obj_name, part_v, part_f, cur_render_dir, color=rgba)
+
+    return (part_dict, dict(annotation['count_dict']),
+            {part: list(objs) for part, objs in annotation['objs_dict'].items()},
+            final_objs, dict(annotation['line_dict']), dict(annotation['plane_dict']))
+
+
+def add_one_part_physics(meshes, annotation, obj_name, tmp_dir):
+    """
+    Same as add_one_part for the physics scenes: parts are exported one by
+    one for the URDF model.
+    """
+    part_dict = dict(); final_objs = []
+    for part, leaves in annotation['parts']:
+        part_v, part_f = gather_part_mesh(meshes, leaves)
+        final_objs.append(part)
+        rgba = choose_part_color(part, part_dict)
+        add_mesh2(obj_name, part, part_v, part_f, tmp_dir, color=rgba)
+
+    return (part_dict, dict(annotation['count_dict']),
+            {part: list(objs) for part, objs in annotation['objs_dict'].items()},
+            final_objs, dict(annotation['line_dict']), dict(annotation['plane_dict']))
 
 def rename_one_part(part, obj_name):
     if 'Table' in obj_name:
@@ -276,63 +869,206 @@ def rename_one_part(part, obj_name):
         # if part in ['bed_side_surface', 'surface_base']: part = 'frame'
     return part
     
-def find_equation(part, chosen_v, geo_list1, geo_list2, line_dict, plane_dict):
-    if part in geo_list1:
+def get_list(obj_name):
+    if obj_name == 'Chair':
+      part_list = ['chair_head', 'chair_back', 'chair_seat', 'leg', 'footrest', 'central_support', 'pedestal', 'leg bar', 'foot', 'mechanical_control', 'caster', 'connector', 'chair_arm', 'arm_near_vertical_bar', 'arm_horizontal_bar']
+      part_list2 = ['arm', 'leg', 'back', 'seat', 'central support', 'pedestal', 'leg bar', 'wheel', 'arm vertical bar', 'arm horizontal bar']
+      count_list = ['arm', 'leg', 'leg bar', 'wheel', 'arm vertical bar', 'arm horizontal bar', 'central support', 'seat', 'back']
+      geo_list1 = ['arm_near_vertical_bar', 'arm_horizontal_bar', 'leg', 'leg bar', 'central_support']
+      geo_list2 = ['chair_back', 'chair_seat', 'pedestal']
+
+    if obj_name == 'Refrigerator':
+      part_list = ['door_frame', 'frame', 'body_interior', 'base', 'handle']
+      part_list2 = ['door', 'body']
+      count_list = ['door']
+      geo_list1 = []
+      geo_list2 = ['door_frame']
+
+    if obj_name == 'Bed':
+      part_list = ['bed_sleep_area', 'headboard', 'surface_base', 'leg', 'bar_stretcher']
+      part_list2 = ['sleep area', 'back', 'leg']
+      count_list = ['leg', 'leg bar']
+      geo_list1 = ['leg', 'leg bar']
+      geo_list2 = ['headboard']
+
+    if obj_name == 'Table':
+      part_list = ['tabletop', 'leg', 'central_support', 'pedestal', 'foot',  'leg bar', 'cabinet_door_surface', 'handle',\
+        'shelf', 'drawer_box', 'keyboard_tray', 'foot', 'caster', 'frame']      
+      count_list = ['drawer', 'leg', 'door', 'leg bar', 'shelf', 'wheel', 'central support', 'top']
+      part_list2 = ['top', 'drawer', 'door', 'central support', 'leg', 'pedestal', 'shelf', 'leg bar', 'wheel']
+      geo_list1 = ['leg', 'central_support', 'leg bar']
+      geo_list2 = ['pedestal', 'cabinet_door_surface', 'drawer_box', 'tabletop', 'shelf']
+
+    if obj_name == 'Cart':
+      part_list = ['base_body', 'handle', 'wheel']
+      part_list2 = ['body', 'wheel']
+      count_list = ['wheel']
+      geo_list1 = []
+      geo_list2 = []
+
+    return part_list, part_list2, count_list, geo_list1, geo_list2
+
+
+def rename_part(part, obj_name):
+  if part in ['bar_stretcher', 'circular_stretcher', 'runner', 'rocker']:
+    part = 'leg bar'
+  if part in ['back_panel', 'vertical_side_panel', 'bottom_panel', 'vertical_divider_panel', 'vertical_front_panel']:
+    part = 'frame'
+  if part in ['drawer_box']: part = 'drawer'
+  if part in ['cabinet_door_surface']: part = 'door'
+  if part in ['back_surface']: part='chair_back'
+  if part in ['door_frame']: part = 'door'
+  if part in ['headboard']: part = 'back'
+  if part in ['bed_post']: part = 'leg'
+  if part in ['surface_base']: part = 'base'
+  if part in ['base_body']: part = 'body'
+  if part in ['frame'] and 'Refrigerator' in obj_name: part = 'body'
+  if part in ['caster']: part = 'wheel'
+  if part in ['arm_near_vertical_bar']: part = 'arm vertical bar'
+  if part in ['back_frame_vertical_bar']: part = 'back vertical bar'
+  if part in ['back_frame_horizontal_bar']: part = 'back horizontal bar'
+  part = part.replace("chair_", "").replace("table", "").replace("bed", "").replace("_", " ").replace("bed", "")
+  part = part.strip()
+
+  return part
+
+def check_part(obj_name, part_count_final, part_color_final):
+    keep = True
+    if "wheel" in part_count_final.keys() and obj_name in ['Chair', 'Table']:
+      if "leg" in part_count_final.keys():
+        part_count_final["wheel"] = part_count_final["leg"]
+      else:
+        print ("wheel not paired with leg")
+        keep = False
         
-        angles = []
-        ds = []
-        j = 0
-
-        large1 = np.argmax(chosen_v[:,0])
-        large1 = chosen_v[large1]
-        small1 = np.argmin(chosen_v[:,0])
-        small1 = chosen_v[small1]
-        large2 = np.argmax(chosen_v[:,2])
-        large2 = chosen_v[large2]
-        small2 = np.argmin(chosen_v[:,2])
-        small2 = chosen_v[small2]
-        large3 = np.argmax(chosen_v[:,1])
-        large3 = chosen_v[large3]
-        small3 = np.argmin(chosen_v[:,1])
-        small3 = chosen_v[small3]
-        sum1 = np.max(large1 - small1)
-        sum2 = np.max(large2 - small2)
-        sum3 = np.max(large3 - small3)
-
-        if sum1 > sum2:
-            if sum3 > sum1:
-                angle = large3 - small3
+    if obj_name == 'Chair' and not ('leg' in part_color_final.keys() or 'central_support' in part_color_final.keys() or 'pedestal' in part_color_final.keys()):
+      print ("lack base of chair")
+      keep = False
+
+    if obj_name == 'Refrigerator' and not 'door' in part_color_final.keys():
+      print ("lack door of fridge")
+      keep = False
+
+    if obj_name == 'Chair' and ('arm' in part_color_final.keys() and ('arm vertical bar' in part_color_final.keys() or 'arm horizontal bar' in part_color_final.keys())):
+      print ("duplicate arm entry")
+      keep = False
+    return keep
+
+def check_annotation(obj_name, annotation):
+    """
+    Gives the check_part verdict of an annotated shape (see annotate_parts)
+    without placing it: check_part only looks at which parts are annotated
+    and at their counts, as revise_annotations renames them.
+    """
+    _, part_list2, count_list, _, _ = get_list(obj_name)
+    part_color_final = dict(); part_count_final = dict()
+    for part, _ in annotation['parts']:
+        part = rename_part(part, obj_name)
+        if part in part_list2:
+            part_color_final[part] = True
+
+    for part, count in annotation['count_dict'].items():
+        part = rename_part(part, obj_name)
+        if part in count_list:
+            if not part in part_count_final.keys():
+                part_count_final[part] = count
             else:
-                angle = large1 - small1
-        else:
-            if sum3 > sum2:
-                angle = large3 - small3
-            else:
-                angle = large2 - small2               
-
-        angle3 = np.copy(angle)
-        angle /= (np.linalg.norm(angle) + 0.00001)
-
-        for i in range (100):
-            angle2 = 0
-            while np.linalg.norm(angle2) < np.linalg.norm(angle3) / 2:            
-                ran1 = np.random.randint(len(chosen_v[:, 0]) - 1)
-                ran1 = chosen_v[ran1]
-                ran2 = np.random.randint(len(chosen_v[:, 0]) - 1)
-                ran2 = chosen_v[ran2]
-                angle2 = ran1 - ran2
-
-            angle2 /= (np.linalg.norm(angle2) + 0.00001)
-            # d = math.min (abs(angle - angle2), abs(angle + angle2))
-            distance = min(np.linalg.norm(abs(angle - angle2)), np.linalg.norm(abs(angle2 - angle)))
-            if distance < 0.15:
-                j += 1
-            # ds.append(abs(d))
+                part_count_final[part] += count
+
+    return check_part(obj_name, part_count_final, part_color_final)
+
+# A part is taken as a line when enough of its vertices lie within
+# LINE_TOLERANCE * length of its principal axis
+LINE_TOLERANCE = 0.09
+LINE_INLIERS = 0.5
+LINE_INLIERS_AXIS = 0.4
+# Large parts are fitted on an evenly strided subset of their vertices
+FIT_MAX_POINTS = 4096
+
+def fit_line(chosen_v):
+    """
+    Fits the principal axis of a part through the SVD of its centred
+    vertices. Returns the unit direction, with its largest component made
+    positive, and the fraction of vertices lying close to the axis.
+    """
+    stride = -(-len(chosen_v) // FIT_MAX_POINTS)
+    points = np.asarray(chosen_v[::stride], dtype=np.float64)
+    centred = points - points.mean(axis=0)
+    # The right singular vectors of the centred vertices are those of their
+    # 3x3 scatter matrix, which is much cheaper to decompose
+    _, _, vt = np.linalg.svd(centred.T.dot(centred))
+    direction = vt[0]
+    if direction[np.argmax(np.abs(direction))] < 0:
+        direction = -direction
+
+    proj = centred.dot(direction)
+    length = proj.max() - proj.min()
+    if length <= 0:
+        return direction, 0.0
+    residual2 = np.einsum('ij,ij->i', centred, centred) - proj**2
+    inliers = np.count_nonzero(residual2 <= (LINE_TOLERANCE * length)**2) / float(len(proj))
+
+    return direction, inliers
+
+# With use_plane_flatness, a part is only taken as a plane when the spread
+# of its vertices across the fitted plane is below PLANE_FLATNESS times
+# their smaller spread along it. The original classifier had no such test,
+# and it has only been checked on synthetic parts, so it is off by default
+PLANE_FLATNESS = 0.25
+
+use_plane_flatness = False
+
+def set_plane_flatness(enabled):
+    """
+    Makes find_equation reject planar parts that are not flat enough when
+    enabled, see PLANE_FLATNESS.
+    """
+    global use_plane_flatness
+    use_plane_flatness = enabled
+
+# Reweighting steps of the plane fit; vertices far from the current plane
+# (e.g. the legs under a seat) are down-weighted
+PLANE_ITERATIONS = 3
+
+def fit_plane(chosen_v):
+    """
+    Fits a plane to the vertices of a part by weighted least squares: the
+    normal is the last singular vector of the weighted, centred vertices,
+    and each step gives Cauchy weights to the distances to the previous
+    plane. Returns the unit normal and the flatness of the part, the ratio
+    of the spread across the plane to the smaller spread along it, or None
+    for a degenerate part.
+    """
+    stride = -(-len(chosen_v) // FIT_MAX_POINTS)
+    points = np.asarray(chosen_v[::stride], dtype=np.float64)
+    extent = np.max(points.max(axis=0) - points.min(axis=0)) if len(points) else 0
+    if len(points) < 3 or extent <= 0:
+        return None, None
+
+    weights = np.ones(len(points))
+    for i in range(PLANE_ITERATIONS):
+        center = weights.dot(points) / weights.sum()
+        centred = points - center
+        _, s, vt = np.linalg.svd((centred * weights[:, None]).T.dot(centred))
+        normal = vt[2]
+        if s[1] <= 0:
+            # All the vertices are on one line
+            return None, None
+
+        residual = np.abs(centred.dot(normal))
+        scale = max(1.4826 * np.median(residual), 1e-3 * extent)
+        weights = 1.0 / (1.0 + (residual / scale)**2)
+
+    return normal, np.sqrt(s[2] / s[1])
+
+def find_equation(part, chosen_v, geo_list1, geo_list2, line_dict, plane_dict):
+    if part in geo_list1:
+        angle, inliers = fit_line(chosen_v)
 
         if not part in line_dict.keys():
             line_dict[part] = []
 
-        if j > 25 or (np.max(angle) > 0.95 and j > 20):
+        if inliers > LINE_INLIERS or (np.max(angle) > 0.95 and inliers > LINE_INLIERS_AXIS):
             line_dict[part].append(angle)
         else:
             line_dict[part].append([10000,10000,10000])
@@ -340,67 +1076,25 @@ def find_equation(part, chosen_v, geo_list1, geo_list2, line_dict, plane_dict):
     if part in geo_list2:
         if not ('back' in part and ('back_frame_vertical_bar' in line_dict.keys() or 'back_frame_horizontal_bar' in line_dict.keys() or 'back_surface_vertical_bar' in line_dict.keys() or 'back_surface_horizontal_bar' in line_dict.keys())):
 
-            angles = []
-            ds = []
-            i = 0
-            j = 0
-            while i < 100:
-                ran1 = np.random.randint(len(chosen_v[:, 0]) - 1)
-                ran1 = chosen_v[ran1]
-                ran2 = np.random.randint(len(chosen_v[:, 0]) - 1)
-                ran2 = chosen_v[ran2]
-                ran3 = np.random.randint(len(chosen_v[:, 0]) - 1)
-                ran3 = chosen_v[ran3]
-                line1 = ran1-ran2
-                line2 = ran2-ran3
-
-                if part in ['chair_seat', 'pedestal', 'tabletop', 'shelf'] and ((abs(ran1[0] - ran2[0]) < 0.15 and abs(ran2[0] - ran3[0]) < 0.15 and abs(ran1[0] - ran3[0]) < 0.05) or (abs(ran1[2] - ran2[2]) < 0.15 and abs(ran2[2] - ran3[2]) < 0.15 and abs(ran1[2] - ran3[2]) < 0.25)):
-                    j += 1
-                    if j == 10000:
-                        break
-                    continue
+            angle, flatness = fit_plane(chosen_v)
 
-                if part in ['cabinet_door_surface', 'door_frame', 'headboard',  'chair_back'] and (abs(ran1[1] - ran2[1]) < 0.15 and abs(ran2[1] - ran3[1]) < 0.15 and abs(ran1[1] - ran3[1]) < 0.25):
-                    j += 1
-                    if j == 10000:
-                        break
-                    continue
-                i += 1
-                    
-                angle = np.cross(line1, line2)     
+            if not part in plane_dict.keys():
+                plane_dict[part] = []
+
+            if angle is not None:
+                angle = np.abs(angle)
                 if part in ['cabinet_door_surface', 'drawer_box', 'door_frame', 'headboard']:
                     angle[1] = 0.001
                     if part in ['drawer_box', 'headboard']:
                         angle[0] = 0.001
-                
-                angles.append(abs(angle))
-
-            if j != 10000:
-                angle = np.mean(np.array(angles), axis=0)
-                
-
                 angle /= (np.linalg.norm(angle) + 0.00001)
 
-                for i in range (100):
-                    ran1 = np.random.randint(len(chosen_v[:, 0]) - 1)
-                    ran1 = chosen_v[ran1]
-                    d = ran1 * angle
-                    ds.append(d)
-                
-                ds = np.array(ds)
-
-                if not part in plane_dict.keys():
-                    plane_dict[part] = []
-
-                if np.max(angle) > 0.95:
-                    plane_dict[part].append(angle)
-                else:
-                    plane_dict[part].append([10000, 10000, 10000])
-
+            flat = not use_plane_flatness or flatness < PLANE_FLATNESS
+            if angle is not None and flat and np.max(angle) > 0.95:
+                plane_dict[part].append(angle)
             else:
-                if not part in plane_dict.keys():
-                    plane_dict[part] = []
                 plane_dict[part].append([10000, 10000, 10000])
+
         else:
             line_dict.pop('back_frame_vertical_bar', None)  
             line_dict.pop('back_frame_horizontal_bar', None) 
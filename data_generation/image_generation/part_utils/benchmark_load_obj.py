@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Compares add_parts.parse_obj against the original line-by-line OBJ parser on
+PartNet leaf meshes: checks that both return the same (v, f) and reports the
+parse time of each. Run it from the data_generation directory, e.g.
+
+python image_generation/part_utils/benchmark_load_obj.py --data_dir $DATA_DIR --num_shapes 50
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from add_parts import parse_obj
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', required=True,
+                    help="PartNet data directory with one <shape id>/objs folder per shape")
+parser.add_argument('--num_shapes', default=50, type=int,
+                    help="Number of randomly chosen shapes whose leaf meshes are parsed")
+parser.add_argument('--repeats', default=3, type=int,
+                    help="Number of times each file is parsed by each parser; the best time is kept")
+parser.add_argument('--seed', default=0, type=int)
+
+
+def load_obj_lines(fn):
+    # The parser parse_obj replaced, kept as the reference
+    fin = open(fn, 'r')
+    lines = [line.rstrip() for line in fin]
+    fin.close()
+
+    vertices = []; faces = [];
+    for line in lines:
+        if line.startswith('v '):
+            vertices.append(np.float32(line.split()[1:4]))
+        elif line.startswith('f '):
+            faces.append(np.int32([item.split('/')[0] for item in line.split()[1:4]]))
+
+    f = np.vstack(faces)
+    v = np.vstack(vertices)
+
+    return v, f
+
+
+def best_time(fn, path, repeats):
+    best = None
+    for _ in range(repeats):
+        tic = time.time()
+        result = fn(path)
+        toc = time.time() - tic
+        best = toc if best is None else min(best, toc)
+    return best, result
+
+
+def main(args):
+    shape_ids = sorted(d for d in os.listdir(args.data_dir)
+                       if os.path.isdir(os.path.join(args.data_dir, d, 'objs')))
+    random.Random(args.seed).shuffle(shape_ids)
+    shape_ids = shape_ids[:args.num_shapes]
+
+    num_files = num_vertices = num_faces = num_bytes = 0
+    mismatches = []
+    time_lines = time_bulk = 0.0
+    for shape_id in shape_ids:
+        obj_dir = os.path.join(args.data_dir, shape_id, 'objs')
+        for obj_file in sorted(os.listdir(obj_dir)):
+            if not obj_file.endswith('.obj'):
+                continue
+            path = os.path.join(obj_dir, obj_file)
+            t_lines, (v1, f1) = best_time(load_obj_lines, path, args.repeats)
+            t_bulk, (v2, f2) = best_time(parse_obj, path, args.repeats)
+            time_lines += t_lines
+            time_bulk += t_bulk
+            num_files += 1
+            num_vertices += v1.shape[0]
+            num_faces += f1.shape[0]
+            num_bytes += os.path.getsize(path)
+            same = (v1.dtype == v2.dtype and f1.dtype == f2.dtype
+                    and np.array_equal(v1, v2) and np.array_equal(f1, f2))
+            if not same:
+                mismatches.append(path)
+
+    print('Parsed %d files from %d shapes (%d vertices, %d faces, %.1f MB)'
+          % (num_files, len(shape_ids), num_vertices, num_faces, num_bytes / 1e6))
+    print('line-by-line parser: %.3fs' % time_lines)
+    print('bulk parser:         %.3fs (%.1fx faster)'
+          % (time_bulk, time_lines / max(time_bulk, 1e-9)))
+    # Meshes with polygons other than triangles are expected to differ, the
+    # old parser dropped every vertex after the third one
+    print('%d files with different output' % len(mismatches))
+    for path in mismatches:
+        print('  %s' % path)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
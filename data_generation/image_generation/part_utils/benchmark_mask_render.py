@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Times the mask render of a placement attempt (utils.add_object) with the
+full render settings, with the mask render profile, with the profile and
+the render border, and with all of these and persistent render data. Leaf
+parts of randomly chosen PartNet shapes are placed in the base scene
+--attempts_per_shape times, rendered with the renderer's settings, and
+removed again; the report gives the time per attempt for each, and how
+many mask pixels differ from those of the full settings. The last two
+settings only differ in persistent render data, so the difference of their
+times is what keeping the synchronized scene and BVH saves. Run it in
+Blender from the data_generation directory, e.g.
+
+blender --background -noaudio --python image_generation/part_utils/benchmark_mask_render.py -- --data_dir $DATA_DIR --num_shapes 10
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import time
+import numpy as np
+
+import bpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+from add_parts import load_part_meshes
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', required=True,
+                    help="PartNet data directory with one <shape id>/objs folder per shape")
+parser.add_argument('--num_shapes', default=10, type=int,
+                    help="Number of randomly chosen shapes placed with each setting")
+parser.add_argument('--attempts_per_shape', default=3, type=int,
+                    help="Placement attempts of each shape in one scene, at different rotations")
+parser.add_argument('--base_scene_blendfile', default='image_generation/data/base_scene2.blend')
+parser.add_argument('--tmp_dir', default='benchmark_mask_render_tmp')
+parser.add_argument('--radius', default=1.5, type=float,
+                    help="Radius the shapes are scaled to, as in the renderers")
+parser.add_argument('--width', default=800, type=int)
+parser.add_argument('--height', default=600, type=int)
+parser.add_argument('--render_num_samples', default=512, type=int)
+parser.add_argument('--render_min_bounces', default=8, type=int)
+parser.add_argument('--render_max_bounces', default=8, type=int)
+parser.add_argument('--render_tile_size', default=256, type=int)
+parser.add_argument('--seed', default=0, type=int)
+
+
+def open_scene(args, persistent):
+    # Same settings as render_scene in render_images_partnet.py, on the CPU
+    bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+    utils.set_persistent_render_data(bpy.context.scene, persistent)
+    render_args = bpy.context.scene.render
+    render_args.engine = "CYCLES"
+    render_args.resolution_x = args.width
+    render_args.resolution_y = args.height
+    render_args.resolution_percentage = 100
+    render_args.tile_x = args.render_tile_size
+    render_args.tile_y = args.render_tile_size
+    bpy.data.worlds['World'].cycles.sample_as_light = True
+    bpy.context.scene.cycles.blur_glossy = 2.0
+    bpy.context.scene.cycles.samples = args.render_num_samples
+    bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
+    bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
+    bpy.context.scene.cycles.device = 'CPU'
+
+
+def place(args, shape_id, meshes, theta):
+    if os.path.isdir(args.tmp_dir):
+        shutil.rmtree(args.tmp_dir)
+    os.makedirs(args.tmp_dir)
+    name = 'Bench%s' % shape_id
+    for idx in sorted(meshes):
+        v, f = meshes[idx]
+        utils.add_part_mesh(name, v, f, [0.5, 0.5, 0.5])
+    tic = time.time()
+    _, _, masks = utils.add_object(name, (0.0, 0.0), args.tmp_dir, theta=theta)
+    toc = time.time()
+    utils.delete_parts(name)
+    return toc - tic, masks
+
+
+# (description, mask render profile, mask render border, persistent render data)
+SETTINGS = [
+    ('full settings', 0, 0, 0),
+    ('mask render profile', 1, 0, 0),
+    ('mask render profile and border', 1, 1, 0),
+    ('mask render profile, border and persistent render data', 1, 1, 1),
+]
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    shape_ids = sorted(d for d in os.listdir(args.data_dir)
+                       if os.path.isdir(os.path.join(args.data_dir, d, 'objs')))
+    shape_ids = rng.sample(shape_ids, min(args.num_shapes, len(shape_ids)))
+
+    times = [[] for _ in SETTINGS]
+    num_pixels = 0
+    num_different = [0 for _ in SETTINGS]
+    for shape_id in shape_ids:
+        part_dir = os.path.join(args.data_dir, shape_id, 'objs')
+        leaf_part_ids = [item.split('.')[0] for item in os.listdir(part_dir) if item.endswith('.obj')]
+        _, meshes = load_part_meshes(part_dir, leaf_part_ids, args.radius)
+        thetas = [rng.uniform(0, 2 * np.pi) for _ in range(args.attempts_per_shape)]
+
+        masks = []
+        for k, (_, profile, border, persistent) in enumerate(SETTINGS):
+            open_scene(args, persistent)
+            utils.set_mask_render_profile(profile)
+            utils.set_mask_render_border(border)
+            # Later attempts in the same scene are the ones persistent
+            # render data speeds up
+            cur_masks = []
+            for theta in thetas:
+                elapsed, attempt_masks = place(args, shape_id, meshes, theta)
+                times[k].append(elapsed)
+                cur_masks.append(attempt_masks)
+            masks.append(cur_masks)
+            num_different[k] += sum(np.count_nonzero(a != b) for a, b in zip(masks[0], cur_masks))
+        num_pixels += max(sum(np.count_nonzero(a) for a in masks[0]), 1)
+        print('%s: %d parts, %s' % (shape_id, len(leaf_part_ids),
+              ', '.join('%.2fs with the %s' % (np.mean(times[k][-len(thetas):]), name)
+                        for k, (name, _, _, _) in enumerate(SETTINGS))))
+
+    shutil.rmtree(args.tmp_dir, ignore_errors=True)
+    print('Placed %d shapes %d times each at %dx%d with %d samples'
+          % (len(shape_ids), args.attempts_per_shape, args.width, args.height, args.render_num_samples))
+    for k, (name, _, _, _) in enumerate(SETTINGS):
+        print('%s: %.2fs per attempt (%.1fx faster), %d mask pixels differ (%.3f%% of the mask pixels)'
+              % (name, np.mean(times[k]), np.mean(times[0]) / max(np.mean(times[k]), 1e-9),
+                 num_different[k], 100.0 * num_different[k] / num_pixels))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args(utils.extract_args())
+    main(args)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Builds the shape catalog the renderers load with --shape_catalog. It scans
+every shape named in the category lists (data/<category>.json) once, in a
+process pool, and records for each split of each list the shape ids in the
+order of the list, and for each shape its leaf part ids, its part hierarchy,
+its bounding radius, its vertex and face counts and whether it passes
+check_part in each renderer. Shapes that never pass are then never sampled.
+Run it from the data_generation directory, e.g.
+
+python image_generation/part_utils/build_shape_catalog.py --data_dir $DATA_DIR --mobility_dir $MOBILITY_DIR
+"""
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from add_parts import parse_obj, get_list, annotate_parts, annotate_parts_physics, check_annotation, CATALOG_VERSION
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', default='image_generation/data_v0',
+                    help="PartNet data directory with one <shape id>/objs folder per shape")
+parser.add_argument('--mobility_dir', default='image_generation/cart',
+                    help="PartNet-Mobility data directory with one <shape id>/textured_objs folder per shape")
+parser.add_argument('--list_dir', default='image_generation/data',
+                    help="Directory containing the <category>.json shape lists")
+parser.add_argument('--output', default='image_generation/data/shape_catalog.json.gz',
+                    help="Catalog file to write; it is gzipped if the name ends with .gz")
+parser.add_argument('--num_workers', default=os.cpu_count(), type=int,
+                    help="Number of worker processes scanning shapes")
+
+# (list name, category, dataset) for every list the renderers sample from
+LISTS = [
+    ('chair', 'Chair', 'partnet'),
+    ('chair_static', 'Chair', 'partnet'),
+    ('chair_physics', 'Chair', 'mobility'),
+    ('table', 'Table', 'partnet'),
+    ('bed', 'Bed', 'partnet'),
+    ('refrigerator', 'Refrigerator', 'partnet'),
+    ('cart', 'Cart', 'mobility'),
+]
+
+PART_DIRS = {'partnet': 'objs', 'mobility': 'textured_objs'}
+
+
+def split_ids(ids, split):
+    # Same slicing as add_random_objects in the renderers
+    if split == "val": ids = ids[:int (len(ids) * 0.14286) - 1]
+    if split == "test": ids = ids[int (len(ids) * 0.14286) - 1: int (len(ids) * 0.28571) - 1]
+    if split == "train": ids = ids[int (len(ids) * 0.28571) - 1:]
+    return ids
+
+
+def prune_tree(tree):
+    # Only keep what walk_part_tree looks at
+    node = {'name': tree['name']}
+    if 'objs' in tree:
+        node['objs'] = tree['objs']
+    if 'children' in tree:
+        node['children'] = [prune_tree(child) for child in tree['children']]
+    return node
+
+
+def load_tree(shape_dir):
+    try:
+        with open(os.path.join(shape_dir, 'result_after_merging.json'), 'r') as fin:
+            return json.load(fin)[0]
+    except:
+        with open(os.path.join(shape_dir, 'result.json'), 'r') as fin:
+            return json.load(fin)[0]
+
+
+def scan_shape(task):
+    dataset, shape_dir, categories = task
+    entry = {'keep': {category: {'partnet': False, 'physics': False} for category in categories}}
+    try:
+        part_dir = os.path.join(shape_dir, PART_DIRS[dataset])
+        leaf_part_ids = sorted(item.split('.')[0] for item in os.listdir(part_dir) if item.endswith('.obj'))
+        meshes = dict()
+        for idx in leaf_part_ids:
+            meshes[idx] = parse_obj(os.path.join(part_dir, idx+'.obj'))
+        tree = prune_tree(load_tree(shape_dir))
+    except Exception as err:
+        entry['error'] = repr(err)
+        return dataset, os.path.basename(shape_dir), entry
+
+    entry['leaf_part_ids'] = leaf_part_ids
+    entry['hierarchy'] = tree
+    entry['radius'] = float(np.sqrt(max(np.max(np.sum(v.astype(np.float64)**2, axis=1)) for v, _ in meshes.values())))
+    entry['num_vertices'] = sum(v.shape[0] for v, _ in meshes.values())
+    entry['num_faces'] = sum(f.shape[0] for _, f in meshes.values())
+
+    for category in categories:
+        part_list = get_list(category)[0]
+        for kind, annotate in [('partnet', annotate_parts), ('physics', annotate_parts_physics)]:
+            # check_part reports why it rejects a shape, which is noise here
+            with contextlib.redirect_stdout(io.StringIO()):
+                try:
+                    annotation = annotate(meshes, tree, category, part_list, [], [])
+                    keep = check_annotation(category, annotation)
+                except Exception as err:
+                    entry['error'] = repr(err)
+                    keep = False
+            entry['keep'][category][kind] = keep
+
+    return dataset, os.path.basename(shape_dir), entry
+
+
+def main(args):
+    dataset_dirs = {'partnet': args.data_dir, 'mobility': args.mobility_dir}
+    lists = dict()
+    categories = dict()
+    for list_name, category, dataset in LISTS:
+        path = os.path.join(args.list_dir, list_name + '.json')
+        if not os.path.isfile(path):
+            print('Skipping missing list %s' % path)
+            continue
+        with open(path, 'r') as fin:
+            objs = json.load(fin)
+        ids = [str(obj['anno_id']) if isinstance(obj, dict) else str(obj) for obj in objs]
+        lists[list_name] = {
+            'category': category,
+            'dataset': dataset,
+            'splits': {split: split_ids(ids, split) for split in ['train', 'val', 'test']},
+        }
+        for shape_id in ids:
+            categories.setdefault((dataset, shape_id), set()).add(category)
+
+    tasks = [(dataset, os.path.join(dataset_dirs[dataset], shape_id), sorted(cats))
+             for (dataset, shape_id), cats in sorted(categories.items())]
+    print('Scanning %d shapes from %d lists with %d workers' % (len(tasks), len(lists), args.num_workers))
+
+    shapes = dict()
+    num_rejected = 0
+    errors = []
+    tic = time.time()
+    pool = Pool(args.num_workers)
+    try:
+        for dataset, shape_id, entry in pool.imap_unordered(scan_shape, tasks, chunksize=8):
+            shapes['%s/%s' % (dataset, shape_id)] = entry
+            if not all(keep for verdicts in entry['keep'].values() for keep in verdicts.values()):
+                num_rejected += 1
+            if 'error' in entry:
+                errors.append((dataset, shape_id, entry['error']))
+    finally:
+        pool.close()
+        pool.join()
+    toc = time.time()
+
+    catalog = {'version': CATALOG_VERSION, 'lists': lists, 'shapes': shapes}
+    opener = gzip.open if args.output.endswith('.gz') else open
+    with opener(args.output, 'wt') as fout:
+        json.dump(catalog, fout, separators=(',', ':'))
+
+    for dataset, shape_id, error in errors:
+        print('ERROR %s/%s: %s' % (dataset, shape_id, error))
+    print('Scanned %d shapes in %.1fs; %d fail check_part in at least one renderer, %d with errors'
+          % (len(tasks), toc - tic, num_rejected, len(errors)))
+    for list_name, cur_list in sorted(lists.items()):
+        for split in ['train', 'val', 'test']:
+            ids = cur_list['splits'][split]
+            kept = [shape_id for shape_id in ids
+                    if shapes['%s/%s' % (cur_list['dataset'], shape_id)]['keep'][cur_list['category']]['partnet']]
+            print('%s %s: %d entries, %d passing check_part in render_images_partnet.py%s'
+                  % (list_name, split, len(ids), len(kept),
+                     '' if kept else '; the renderer refuses to draw from it'))
+    print('Wrote %s (%.1f MB)' % (args.output, os.path.getsize(args.output) / 1e6))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Writes the shapes of a category list to the shape library the renderers read
+with --shape_library_dir. Every shape passing check_part gets a .blend file
+holding one mesh object per renamed part (and per leaf left to 'other'),
+named in the order the renderer adds them and with a placeholder material
+that the renderer swaps for the part color, plus a .json file with its leaf
+part ids, its scale and its annotations, and a .npz file with the vertices
+and faces of the parts for the placement prechecks. All are named after the
+annotation key of the shape. Shapes are scaled to --radius, which has to be
+the radius the renderer uses for the category. Run it in Blender from the
+data_generation directory, e.g.
+
+blender --background -noaudio --python image_generation/part_utils/build_shape_library.py -- --list chair --radius 1
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+import bpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import utils
+from add_parts import load_part_meshes, placement_parts, get_list, annotate_parts, annotate_parts_physics, check_annotation, annotation_key, annotation_to_json
+from build_shape_catalog import LISTS, PART_DIRS, load_tree
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--list', required=True, choices=[list_name for list_name, _, _ in LISTS],
+                    help="Category list (data/<list>.json) whose shapes are written")
+parser.add_argument('--radius', required=True, type=float,
+                    help="Radius the shapes are scaled to, as in the renderer")
+parser.add_argument('--kind', default='partnet', choices=['partnet', 'physics'],
+                    help="Renderer whose annotations are stored")
+parser.add_argument('--data_dir', default='image_generation/data_v0',
+                    help="PartNet data directory with one <shape id>/objs folder per shape")
+parser.add_argument('--mobility_dir', default='image_generation/cart',
+                    help="PartNet-Mobility data directory with one <shape id>/textured_objs folder per shape")
+parser.add_argument('--list_dir', default='image_generation/data',
+                    help="Directory containing the <category>.json shape lists")
+parser.add_argument('--output_dir', default='image_generation/data/shape_library',
+                    help="Directory the .blend and .json files are written to")
+
+PLACEHOLDER_COLOR = [0.5, 0.5, 0.5]
+
+
+def write_shape(args, category, shape_dir, part_dir):
+    leaf_part_ids = sorted(item.split('.')[0] for item in os.listdir(part_dir) if item.endswith('.obj'))
+    scale, meshes = load_part_meshes(part_dir, leaf_part_ids, args.radius)
+    part_list, part_list2, count_list, geo_list1, geo_list2 = get_list(category)
+    annotate = annotate_parts if args.kind == 'partnet' else annotate_parts_physics
+    annotation = annotate(meshes, load_tree(shape_dir), category, part_list, geo_list1, geo_list2)
+    if not check_annotation(category, annotation):
+        return False
+
+    parts = placement_parts(meshes, annotation, leaf_part_ids)
+    rendered = set(leaf for objs in annotation['objs_dict'].values() for leaf in objs)
+    other = [idx for idx in leaf_part_ids if idx not in rendered]
+
+    objects = [utils.add_part_mesh('part%04d' % k, v, f, PLACEHOLDER_COLOR) for k, (_, (v, f)) in enumerate(parts)]
+    key = annotation_key(args.kind, category, part_dir)
+    bpy.data.libraries.write(os.path.join(args.output_dir, key + '.blend'), set(objects))
+
+    entry = {
+        'radius': args.radius,
+        'scale': float(scale),
+        'leaf_part_ids': leaf_part_ids,
+        'annotation': annotation_to_json(annotation),
+        'objects': [part for part, _ in parts],
+        'other': other,
+        'num_vertices': sum(v.shape[0] for _, (v, _) in parts),
+        'num_faces': sum(f.shape[0] for _, (_, f) in parts),
+    }
+    with open(os.path.join(args.output_dir, key + '.json'), 'w') as fout:
+        json.dump(entry, fout)
+    arrays = dict()
+    for k, (_, (v, f)) in enumerate(parts):
+        arrays['v%d' % k], arrays['f%d' % k] = v, f
+    np.savez(os.path.join(args.output_dir, key + '.npz'), **arrays)
+
+    for obj in objects:
+        mesh = obj.data
+        materials = list(mesh.materials)
+        bpy.data.objects.remove(obj, do_unlink=True)
+        bpy.data.meshes.remove(mesh, do_unlink=True)
+        for mat in materials:
+            bpy.data.materials.remove(mat, do_unlink=True)
+    return True
+
+
+def main(args):
+    category, dataset = [(c, d) for list_name, c, d in LISTS if list_name == args.list][0]
+    dataset_dir = args.data_dir if dataset == 'partnet' else args.mobility_dir
+    with open(os.path.join(args.list_dir, args.list + '.json'), 'r') as fin:
+        objs = json.load(fin)
+    ids = sorted(set(str(obj['anno_id']) if isinstance(obj, dict) else str(obj) for obj in objs))
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    num_written = 0
+    errors = []
+    tic = time.time()
+    for shape_id in ids:
+        shape_dir = os.path.join(dataset_dir, shape_id)
+        try:
+            num_written += write_shape(args, category, shape_dir, os.path.join(shape_dir, PART_DIRS[dataset]))
+        except Exception as err:
+            errors.append((shape_id, repr(err)))
+
+    for shape_id, error in errors:
+        print('ERROR %s: %s' % (shape_id, error))
+    print('Wrote %d of %d shapes of %s in %.1fs, %d with errors'
+          % (num_written, len(ids), args.list, time.time() - tic, len(errors)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args(utils.extract_args())
+    main(args)
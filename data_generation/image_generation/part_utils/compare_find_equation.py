@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the line and plane fits of add_parts.find_equation against the
+original random-sampling classifiers on PartNet shapes. Every node of the
+part hierarchy is treated as a candidate line and as a candidate plane; the
+report gives how often both agree on whether there is one, the angle between
+the two directions when both find one, and the time spent by each. Run it
+from the data_generation directory, e.g.
+
+python image_generation/part_utils/compare_find_equation.py --data_dir $DATA_DIR --num_shapes 50
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from add_parts import load_part_meshes, walk_part_tree, gather_part_mesh, find_equation, set_plane_flatness
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', required=True,
+                    help="PartNet data directory with one <shape id>/objs folder per shape")
+parser.add_argument('--num_shapes', default=50, type=int,
+                    help="Number of randomly chosen shapes whose parts are compared")
+parser.add_argument('--radius', default=1.5, type=float,
+                    help="Radius the shapes are scaled to, as in the renderers")
+parser.add_argument('--plane_flatness', default=0, type=int,
+                    help="Whether the plane fit also requires the part to be flat, as the "
+                         "renderers do with --plane_flatness 1")
+parser.add_argument('--seed', default=0, type=int)
+
+
+def legacy_line(chosen_v):
+    # The line branch find_equation replaced, kept as the reference
+    j = 0
+
+    large1 = np.argmax(chosen_v[:,0])
+    large1 = chosen_v[large1]
+    small1 = np.argmin(chosen_v[:,0])
+    small1 = chosen_v[small1]
+    large2 = np.argmax(chosen_v[:,2])
+    large2 = chosen_v[large2]
+    small2 = np.argmin(chosen_v[:,2])
+    small2 = chosen_v[small2]
+    large3 = np.argmax(chosen_v[:,1])
+    large3 = chosen_v[large3]
+    small3 = np.argmin(chosen_v[:,1])
+    small3 = chosen_v[small3]
+    sum1 = np.max(large1 - small1)
+    sum2 = np.max(large2 - small2)
+    sum3 = np.max(large3 - small3)
+
+    if sum1 > sum2:
+        if sum3 > sum1:
+            angle = large3 - small3
+        else:
+            angle = large1 - small1
+    else:
+        if sum3 > sum2:
+            angle = large3 - small3
+        else:
+            angle = large2 - small2
+
+    angle3 = np.copy(angle)
+    angle /= (np.linalg.norm(angle) + 0.00001)
+
+    for i in range (100):
+        angle2 = 0
+        while np.linalg.norm(angle2) < np.linalg.norm(angle3) / 2:
+            ran1 = np.random.randint(len(chosen_v[:, 0]) - 1)
+            ran1 = chosen_v[ran1]
+            ran2 = np.random.randint(len(chosen_v[:, 0]) - 1)
+            ran2 = chosen_v[ran2]
+            angle2 = ran1 - ran2
+
+        angle2 /= (np.linalg.norm(angle2) + 0.00001)
+        distance = min(np.linalg.norm(abs(angle - angle2)), np.linalg.norm(abs(angle2 - angle)))
+        if distance < 0.15:
+            j += 1
+
+    if j > 25 or (np.max(angle) > 0.95 and j > 20):
+        return angle
+    return [10000,10000,10000]
+
+
+def legacy_plane(part, chosen_v):
+    # The plane branch find_equation replaced, kept as the reference
+    angles = []
+    i = 0
+    j = 0
+    while i < 100:
+        ran1 = np.random.randint(len(chosen_v[:, 0]) - 1)
+        ran1 = chosen_v[ran1]
+        ran2 = np.random.randint(len(chosen_v[:, 0]) - 1)
+        ran2 = chosen_v[ran2]
+        ran3 = np.random.randint(len(chosen_v[:, 0]) - 1)
+        ran3 = chosen_v[ran3]
+        line1 = ran1-ran2
+        line2 = ran2-ran3
+
+        if part in ['chair_seat', 'pedestal', 'tabletop', 'shelf'] and ((abs(ran1[0] - ran2[0]) < 0.15 and abs(ran2[0] - ran3[0]) < 0.15 and abs(ran1[0] - ran3[0]) < 0.05) or (abs(ran1[2] - ran2[2]) < 0.15 and abs(ran2[2] - ran3[2]) < 0.15 and abs(ran1[2] - ran3[2]) < 0.25)):
+            j += 1
+            if j == 10000:
+                break
+            continue
+
+        if part in ['cabinet_door_surface', 'door_frame', 'headboard',  'chair_back'] and (abs(ran1[1] - ran2[1]) < 0.15 and abs(ran2[1] - ran3[1]) < 0.15 and abs(ran1[1] - ran3[1]) < 0.25):
+            j += 1
+            if j == 10000:
+                break
+            continue
+        i += 1
+
+        angle = np.cross(line1, line2)
+        if part in ['cabinet_door_surface', 'drawer_box', 'door_frame', 'headboard']:
+            angle[1] = 0.001
+            if part in ['drawer_box', 'headboard']:
+                angle[0] = 0.001
+
+        angles.append(abs(angle))
+
+    if j == 10000:
+        return [10000, 10000, 10000]
+
+    angle = np.mean(np.array(angles), axis=0)
+    angle /= (np.linalg.norm(angle) + 0.00001)
+    if np.max(angle) > 0.95:
+        return angle
+    return [10000, 10000, 10000]
+
+
+def is_found(geo):
+    return geo[0] != 10000
+
+
+class Comparison(object):
+    def __init__(self, name):
+        self.name = name
+        # counts[(found by the legacy classifier, found by the fit)]
+        self.counts = {(a, b): 0 for a in [True, False] for b in [True, False]}
+        self.angles = []
+        self.disagreements = []
+        self.time_legacy = 0.0
+        self.time_fit = 0.0
+
+    def add(self, key, old, new):
+        self.counts[(is_found(old), is_found(new))] += 1
+        if is_found(old) and is_found(new):
+            cos = np.dot(old, new) / (np.linalg.norm(old) * np.linalg.norm(new))
+            self.angles.append(np.degrees(np.arccos(np.clip(cos, -1, 1))))
+        elif is_found(old) != is_found(new):
+            self.disagreements.append(key + (is_found(old),))
+
+    def report(self):
+        counts = self.counts
+        total = sum(counts.values())
+        name = self.name
+        print('%s: compared %d parts' % (name, total))
+        print('                 fit: %-5s fit: none' % name)
+        print('legacy: %-5s    %9d  %9d' % (name, counts[(True, True)], counts[(True, False)]))
+        print('legacy: none     %9d  %9d' % (counts[(False, True)], counts[(False, False)]))
+        print('agreement: %.1f%%' % (100.0 * (counts[(True, True)] + counts[(False, False)]) / max(total, 1)))
+        if self.angles:
+            print('angle between directions when both find a %s: median %.2f, max %.2f degrees'
+                  % (name, np.median(self.angles), np.max(self.angles)))
+        print('legacy classifier: %.3fs' % self.time_legacy)
+        print('%s fit: %.3fs (%.1fx faster)'
+              % (name, self.time_fit, self.time_legacy / max(self.time_fit, 1e-9)))
+        for shape_id, node_id, part, old_found in self.disagreements:
+            print('  %s node %s (%s): only the %s finds a %s'
+                  % (shape_id, node_id, part, 'legacy classifier' if old_found else 'fit', name))
+
+
+def load_tree(shape_dir):
+    for fn in ['result_after_merging.json', 'result.json']:
+        path = os.path.join(shape_dir, fn)
+        if os.path.isfile(path):
+            with open(path, 'r') as fin:
+                return json.load(fin)[0]
+    return None
+
+
+def main(args):
+    set_plane_flatness(args.plane_flatness)
+    shape_ids = sorted(d for d in os.listdir(args.data_dir)
+                       if os.path.isdir(os.path.join(args.data_dir, d, 'objs')))
+    random.Random(args.seed).shuffle(shape_ids)
+    shape_ids = shape_ids[:args.num_shapes]
+    np.random.seed(args.seed)
+
+    lines = Comparison('line')
+    planes = Comparison('plane')
+    num_shapes = 0
+    for shape_id in shape_ids:
+        shape_dir = os.path.join(args.data_dir, shape_id)
+        tree = load_tree(shape_dir)
+        if tree is None:
+            continue
+        cur_part_dir = os.path.join(shape_dir, 'objs')
+        leaf_part_ids = [item.split('.')[0] for item in os.listdir(cur_part_dir) if item.endswith('.obj')]
+        _, meshes = load_part_meshes(cur_part_dir, leaf_part_ids, args.radius)
+        _, nodes = walk_part_tree(tree, '', meshes)
+        num_shapes += 1
+
+        for data, part, leaves in nodes:
+            if len(leaves) == 0:
+                continue
+            part_v, part_f = gather_part_mesh(meshes, leaves)
+            chosen_v = part_v[part_f-1].reshape(-1, 3)
+            key = (shape_id, data.get('id'), part)
+
+            tic = time.time()
+            old = legacy_line(np.copy(chosen_v))
+            lines.time_legacy += time.time() - tic
+            tic = time.time()
+            line_dict, _ = find_equation(part, chosen_v, [part], [], dict(), dict())
+            lines.time_fit += time.time() - tic
+            lines.add(key, old, line_dict[part][0])
+
+            tic = time.time()
+            old = legacy_plane(part, chosen_v)
+            planes.time_legacy += time.time() - tic
+            tic = time.time()
+            _, plane_dict = find_equation(part, chosen_v, [], [part], dict(), dict())
+            planes.time_fit += time.time() - tic
+            if part in plane_dict:
+                planes.add(key, old, plane_dict[part][0])
+
+    print('Compared the parts of %d shapes' % num_shapes)
+    lines.report()
+    planes.report()
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the part masks of the numpy rasterizer (placement.raster_masks) to
+the IndexOB masks Cycles renders for a placement attempt (utils.add_object).
+Leaf parts of randomly chosen PartNet shapes are placed at random positions
+and rotations in the base scene, as add_random_objects does; the report gives
+the IoU of the masks part by part and object by object, how often both
+agree on the frame boundary check, and the time each takes. Run it in
+Blender from the data_generation directory, e.g.
+
+blender --background -noaudio --python image_generation/part_utils/compare_raster_masks.py -- --data_dir $DATA_DIR --num_shapes 20
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import time
+import numpy as np
+
+import bpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+from add_parts import load_part_meshes
+from placement import placement_matrix, raster_masks, mask_iou
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', required=True,
+                    help="PartNet data directory with one <shape id>/objs folder per shape")
+parser.add_argument('--num_shapes', default=20, type=int,
+                    help="Number of randomly chosen shapes, each placed once")
+parser.add_argument('--base_scene_blendfile', default='image_generation/data/base_scene2.blend')
+parser.add_argument('--tmp_dir', default='compare_raster_masks_tmp')
+parser.add_argument('--radius', default=1.5, type=float,
+                    help="Radius the shapes are scaled to, as in the renderers")
+parser.add_argument('--width', default=800, type=int)
+parser.add_argument('--height', default=600, type=int)
+parser.add_argument('--raster_scale', default=1.0, type=float,
+                    help="Resolution of the rasterized masks relative to the render")
+parser.add_argument('--seed', default=0, type=int)
+
+
+def open_scene(args):
+    bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+    render_args = bpy.context.scene.render
+    render_args.engine = "CYCLES"
+    render_args.resolution_x = args.width
+    render_args.resolution_y = args.height
+    render_args.resolution_percentage = 100
+    bpy.context.scene.cycles.device = 'CPU'
+    bpy.context.scene.update()
+
+
+def in_frame(masks, args):
+    # The boundary check of add_random_objects
+    obj_img = np.any(masks > 0, axis=0)
+    rows = np.where(obj_img.any(axis=1))[0]
+    cols = np.where(obj_img.any(axis=0))[0]
+    return len(rows) > 0 and cols[0] > 0 and cols[-1] < args.width - 1 and rows[-1] < args.height - 1
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    shape_ids = sorted(d for d in os.listdir(args.data_dir)
+                       if os.path.isdir(os.path.join(args.data_dir, d, 'objs')))
+    shape_ids = rng.sample(shape_ids, min(args.num_shapes, len(shape_ids)))
+
+    part_ious = []
+    object_ious = []
+    num_agree = 0
+    raster_time = 0.0
+    cycles_time = 0.0
+    for shape_id in shape_ids:
+        part_dir = os.path.join(args.data_dir, shape_id, 'objs')
+        leaf_part_ids = sorted(item.split('.')[0] for item in os.listdir(part_dir) if item.endswith('.obj'))
+        _, meshes = load_part_meshes(part_dir, leaf_part_ids, args.radius)
+        parts = [meshes[idx] for idx in leaf_part_ids]
+        loc = (rng.uniform(-5, 5), rng.uniform(-8, 3))
+        theta = rng.uniform(-1.2, 1.2)
+
+        open_scene(args)
+        P = np.array(utils.get_3x4_P_matrix_from_blender(bpy.context.scene.camera)[0])
+        tic = time.time()
+        raster = raster_masks(parts, placement_matrix(parts, loc, theta), P,
+                              (args.height, args.width), args.raster_scale)
+        raster_time += time.time() - tic
+
+        if os.path.isdir(args.tmp_dir):
+            shutil.rmtree(args.tmp_dir)
+        os.makedirs(args.tmp_dir)
+        name = 'Compare%s' % shape_id
+        for v, f in parts:
+            utils.add_part_mesh(name, v, f, [0.5, 0.5, 0.5])
+        tic = time.time()
+        _, _, cycles = utils.add_object(name, loc, args.tmp_dir, theta=theta)
+        cycles_time += time.time() - tic
+
+        ious = [mask_iou(a, b) for a, b in zip(raster, cycles) if np.any(a) or np.any(b)]
+        part_ious += ious
+        object_ious.append(mask_iou(np.any(raster, axis=0), np.any(cycles, axis=0)))
+        num_agree += in_frame(raster, args) == in_frame(cycles, args)
+        print('%s: %d parts, object IoU %.3f, mean part IoU %.3f'
+              % (shape_id, len(parts), object_ious[-1], np.mean(ious) if ious else 1.0))
+
+    shutil.rmtree(args.tmp_dir, ignore_errors=True)
+    part_ious = np.array(part_ious)
+    print('Placed %d shapes at %dx%d, rasterized at scale %.2f'
+          % (len(shape_ids), args.width, args.height, args.raster_scale))
+    print('parts: mean IoU %.3f, median %.3f, %.1f%% of %d parts above 0.9'
+          % (part_ious.mean(), np.median(part_ious), 100.0 * np.mean(part_ious > 0.9), len(part_ious)))
+    print('objects: mean IoU %.3f, lowest %.3f; boundary check agrees for %d of %d'
+          % (np.mean(object_ious), np.min(object_ious), num_agree, len(shape_ids)))
+    print('%.3fs per placement rasterized, %.2fs per placement rendered'
+          % (raster_time / len(shape_ids), cycles_time / len(shape_ids)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args(utils.extract_args())
+    main(args)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Screen space geometry of placement attempts, without Blender: the world
+matrix add_object gives the parts of an object, a z-buffer rasterizer for
+their masks, convex hulls and their overlap for the analytic precheck, and
+the floor region and footprint hash object positions are drawn with.
+"""
+
+import random
+import numpy as np
+
+def placement_matrix(parts, loc, theta):
+    """
+    World matrix utils.add_object gives the parts of an object placed at
+    loc = (x, y) and turned by theta: the OBJ importer's rotation by pi/2
+    about x, theta about z, and the lowest vertex 0.02 above the ground.
+    parts is a list of (v, f).
+    """
+    minz = min(v[:, 1].min() for v, _ in parts)
+    c, s = np.cos(theta), np.sin(theta)
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]).dot(
+        np.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]]))
+    matrix[:3, 3] = [loc[0], loc[1], -minz + 0.02]
+    return matrix
+
+
+# Triangle and pixel pairs tested at once by rasterize_parts; bounds the
+# memory it needs for large triangles
+RASTER_CHUNK_PAIRS = 1 << 22
+
+
+def rasterize_parts(parts, matrix, P, shape, scale=1.0):
+    """
+    Software z-buffer rendering of the IndexOB pass of utils.add_object:
+    parts is a list of (v, f) with 1-based faces as load_obj returns them,
+    matrix their world matrix (see placement_matrix) and P the 4x4 camera
+    matrix of utils.get_3x4_P_matrix_from_blender, the inverse of the
+    projection_matrix stored in the scene json. A pixel of the (H, W) frame
+    shape, scaled by scale, belongs to the nearest triangle covering its
+    centre. Returns an int32 image holding k + 1 where part k is seen and 0
+    elsewhere. Triangles reaching behind the camera are left out.
+    """
+    height, width = int(round(shape[0] * scale)), int(round(shape[1] * scale))
+    ids = np.zeros(height * width, dtype=np.int32)
+    depth = np.full(height * width, -np.inf)
+    if not parts:
+        return ids.reshape(height, width)
+
+    offsets = np.cumsum([0] + [v.shape[0] for v, _ in parts])
+    faces = np.vstack([f - 1 + offset for (_, f), offset in zip(parts, offsets)])
+    face_ids = np.repeat(np.arange(1, len(parts) + 1, dtype=np.int32), [f.shape[0] for _, f in parts])
+    v = np.vstack([v for v, _ in parts])
+    camera = np.diag([scale, scale, 1.0, 1.0]).dot(P).dot(matrix)
+    proj = np.hstack([v, np.ones((v.shape[0], 1))]).dot(camera.T)
+
+    w = proj[:, 2][faces]
+    keep = np.all(w > 1e-6, axis=1)
+    faces, face_ids, w = faces[keep], face_ids[keep], w[keep]
+    x = proj[:, 0][faces] / w
+    y = proj[:, 1][faces] / w
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+
+    # Pixels whose centre (col + 0.5, row + 0.5) lies in the bounding box
+    col0 = np.maximum(np.ceil(x.min(axis=1) - 0.5), 0)
+    col1 = np.minimum(np.floor(x.max(axis=1) - 0.5), width - 1)
+    row0 = np.maximum(np.ceil(y.min(axis=1) - 0.5), 0)
+    row1 = np.minimum(np.floor(y.max(axis=1) - 0.5), height - 1)
+    keep = (np.abs(area) > 1e-12) & (col0 <= col1) & (row0 <= row1)
+    x, y, w, area, face_ids = x[keep], y[keep], w[keep], area[keep], face_ids[keep]
+    col0, row0 = col0[keep].astype(np.int64), row0[keep].astype(np.int64)
+    box_width = col1[keep].astype(np.int64) - col0 + 1
+    counts = box_width * (row1[keep].astype(np.int64) - row0 + 1)
+    ends = np.cumsum(counts)
+
+    start = 0
+    while start < len(counts):
+        first = ends[start] - counts[start]
+        stop = max(np.searchsorted(ends, first + RASTER_CHUNK_PAIRS, 'right'), start + 1)
+        tri = np.repeat(np.arange(start, stop), counts[start:stop])
+        k = np.arange(first, ends[stop - 1]) - (ends - counts)[tri]
+        col = col0[tri] + k % box_width[tri]
+        row = row0[tri] + k // box_width[tri]
+        px, py = col + 0.5, row + 0.5
+
+        # Barycentric coordinates; dividing by the signed area makes them
+        # positive inside triangles of either winding
+        tx, ty = x[tri], y[tri]
+        b0 = ((tx[:, 2] - tx[:, 1]) * (py - ty[:, 1]) - (ty[:, 2] - ty[:, 1]) * (px - tx[:, 1])) / area[tri]
+        b1 = ((tx[:, 0] - tx[:, 2]) * (py - ty[:, 2]) - (ty[:, 0] - ty[:, 2]) * (px - tx[:, 2])) / area[tri]
+        b2 = 1.0 - b0 - b1
+        inside = (b0 >= 0) & (b1 >= 0) & (b2 >= 0)
+        # 1 / depth is linear in screen space; the nearest has the largest
+        tw = 1.0 / w[tri[inside]]
+        inv_depth = b0[inside] * tw[:, 0] + b1[inside] * tw[:, 1] + b2[inside] * tw[:, 2]
+        pixel = row[inside] * width + col[inside]
+        owner = face_ids[tri[inside]]
+
+        order = np.lexsort((-inv_depth, pixel))
+        pixel, first_hit = np.unique(pixel[order], return_index=True)
+        inv_depth, owner = inv_depth[order][first_hit], owner[order][first_hit]
+        nearer = inv_depth > depth[pixel]
+        depth[pixel[nearer]] = inv_depth[nearer]
+        ids[pixel[nearer]] = owner[nearer]
+        start = stop
+
+    return ids.reshape(height, width)
+
+
+def raster_masks(parts, matrix, P, shape, scale=1.0):
+    """
+    Masks of the parts from rasterize_parts in the format of index_masks:
+    a (len(parts), H, W) uint8 array of 0 and 255 for the frame shape
+    (H, W), scaled back up to it when rasterized at a lower scale.
+    """
+    ids = rasterize_parts(parts, matrix, P, shape, scale)
+    if ids.shape != tuple(shape):
+        rows = np.minimum(((np.arange(shape[0]) + 0.5) * scale).astype(np.int64), ids.shape[0] - 1)
+        cols = np.minimum(((np.arange(shape[1]) + 0.5) * scale).astype(np.int64), ids.shape[1] - 1)
+        ids = ids[rows[:, None], cols[None, :]]
+    masks = ids[None, :, :] == np.arange(1, len(parts) + 1, dtype=np.int32)[:, None, None]
+    return masks.astype(np.uint8) * 255
+
+
+def project_points(points, matrix, P):
+    """
+    Projects (N, 3) points with the world matrix and the 4x4 camera matrix P
+    of rasterize_parts. Returns their (N, 2) pixel coordinates, x to the
+    right and y down, and their (N,) depths, which are positive in front
+    of the camera.
+    """
+    proj = np.hstack([points, np.ones((points.shape[0], 1))]).dot(P.dot(matrix).T)
+    return proj[:, :2] / proj[:, 2:3], proj[:, 2]
+
+
+def box_corners(points):
+    """
+    The 8 corners of the axis-aligned bounding box of (N, 3) points.
+    """
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    return np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+
+
+def inside_convex(points, hull):
+    """
+    Which of the (N, 2) points lie strictly inside the counter-clockwise
+    convex polygon hull.
+    """
+    edges = np.roll(hull, -1, axis=0) - hull
+    rel = points[:, None, :] - hull[None, :, :]
+    return np.all(edges[None, :, 0] * rel[:, :, 1] - edges[None, :, 1] * rel[:, :, 0] > 0, axis=1)
+
+
+def convex_hull_2d(points):
+    """
+    Convex hull of (N, 2) points, as the (M, 2) array of its vertices in
+    counter-clockwise order (Andrew's monotone chain). Points inside the
+    polygon of the extreme points along 8 directions are dropped first, so
+    only few points reach the loop.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.shape[0] > 16:
+        x, y = points[:, 0], points[:, 1]
+        extremes = [pick(d) for d in (x, y, x + y, x - y) for pick in (np.argmin, np.argmax)]
+        octagon = convex_hull_2d(points[extremes])
+        if octagon.shape[0] >= 3:
+            points = points[~inside_convex(points, octagon)]
+    points = np.unique(points, axis=0)
+    if points.shape[0] < 3:
+        return points
+
+    def chain(pts):
+        hull = []
+        for p in pts:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1])
+                                      - (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull[:-1]
+
+    pts = [tuple(p) for p in points]
+    return np.array(chain(pts) + chain(pts[::-1]))
+
+
+def polygon_area(polygon):
+    """
+    Area of a simple polygon given as an (M, 2) array of its vertices.
+    """
+    if polygon.shape[0] < 3:
+        return 0.0
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def clip_half_plane(polygon, a, b, c):
+    """
+    Clips a convex polygon, given as a list of (x, y), to the half-plane
+    a * x + b * y + c >= 0 (one step of Sutherland-Hodgman).
+    """
+    side = [a * p[0] + b * p[1] + c for p in polygon]
+    out = []
+    for k in range(len(polygon)):
+        p, q = polygon[k - 1], polygon[k]
+        sp, sq = side[k - 1], side[k]
+        if (sp >= 0) != (sq >= 0):
+            t = sp / (sp - sq)
+            out.append((p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1])))
+        if sq >= 0:
+            out.append(q)
+    return out
+
+
+def convex_overlap_area(poly1, poly2):
+    """
+    Area of the intersection of two counter-clockwise convex polygons, by
+    clipping the first with every edge of the second.
+    """
+    if poly1.shape[0] < 3 or poly2.shape[0] < 3:
+        return 0.0
+    out = [tuple(p) for p in poly1]
+    for a, b in zip(poly2, np.roll(poly2, -1, axis=0)):
+        if not out:
+            break
+        out = clip_half_plane(out, a[1] - b[1], b[0] - a[0], (b[1] - a[1]) * a[0] - (b[0] - a[0]) * a[1])
+    return polygon_area(np.array(out))
+
+
+# Area of the ground plane objects were placed in before the sampling took
+# the camera into account, (xmin, xmax, ymin, ymax)
+PLACEMENT_AREA = (-5.0, 5.0, -8.0, 3.0)
+
+
+# Depth in front of the camera below which nothing is placed
+NEAR_DEPTH = 0.1
+
+
+def visible_floor(P, width, height, radius, area=PLACEMENT_AREA):
+    """
+    The convex polygon, as an (M, 2) array of ground plane (x, y), of the
+    centres of the objects of the given radius whose bounding sphere lies in
+    front of the 4x4 camera matrix P (see rasterize_parts) and within the
+    left, right and bottom edges of the (width, height) frame, clipped to
+    area. The sphere of a placed object is centred between 0.02 and
+    radius + 0.02 above the ground (see placement_matrix); it stays in view
+    for both heights, and thus for all heights in between. Objects may
+    still reach past the top of the frame, as the mask checks allow.
+    """
+    r0, r1, r2 = np.asarray(P, dtype=np.float64)[:3]
+    near = r2.copy()
+    near[3] -= NEAR_DEPTH
+    # x >= 0, x <= width, y <= height and depth >= NEAR_DEPTH are linear in
+    # the homogeneous point, since the depth is positive
+    planes = [r0, width * r2 - r0, height * r2 - r1, near]
+    xmin, xmax, ymin, ymax = area
+    polygon = [(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]
+    for plane in planes:
+        # Distances in world units, so that the sphere fits at distance radius
+        plane = plane / np.linalg.norm(plane[:3])
+        for z in (0.02, radius + 0.02):
+            polygon = clip_half_plane(polygon, plane[0], plane[1], plane[2] * z + plane[3] - radius)
+    return np.array(polygon).reshape(-1, 2)
+
+
+def sample_in_polygon(polygon, rng=random):
+    """
+    A uniformly distributed point of a convex polygon with a nonzero area,
+    drawn by rejection from its bounding box.
+    """
+    lo, hi = polygon.min(axis=0), polygon.max(axis=0)
+    edges = np.roll(polygon, -1, axis=0) - polygon
+    while True:
+        point = np.array([rng.uniform(lo[0], hi[0]), rng.uniform(lo[1], hi[1])])
+        rel = point - polygon
+        if np.all(edges[:, 0] * rel[:, 1] - edges[:, 1] * rel[:, 0] >= 0):
+            return point[0], point[1]
+
+
+class FootprintHash(object):
+    """
+    2D spatial hash of the footprints (x, y, radius) of the objects placed in
+    a scene, in square cells of cell_size on the ground plane. fits looks up
+    the neighbours of a new footprint in the cells it can reach only.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = dict()
+        self.footprints = []
+        self.max_radius = 0.0
+
+    def cell(self, x, y):
+        return int(np.floor(x / self.cell_size)), int(np.floor(y / self.cell_size))
+
+    def add(self, x, y, radius):
+        self.cells.setdefault(self.cell(x, y), []).append((x, y, radius))
+        self.footprints.append((x, y, radius))
+        self.max_radius = max(self.max_radius, radius)
+
+    def near(self, x, y, reach):
+        """
+        The footprints whose centre may lie within reach of (x, y).
+        """
+        (i0, j0), (i1, j1) = self.cell(x - reach, y - reach), self.cell(x + reach, y + reach)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                for footprint in self.cells.get((i, j), []):
+                    yield footprint
+
+    def fits(self, x, y, radius, min_dist):
+        """
+        Whether a footprint at (x, y) keeps min_dist between its edge and the
+        edge of every placed footprint.
+        """
+        for xx, yy, rr in self.near(x, y, radius + self.max_radius + min_dist):
+            if np.hypot(x - xx, y - yy) - radius - rr < min_dist:
+                return False
+        return True
+
+
+def margins_good(scene_struct, footprints, x, y, margin):
+    """
+    Whether a position at (x, y) is at least margin away from every footprint
+    in footprints along each cardinal direction of the scene, or exactly
+    aligned.
+    """
+    for xx, yy, _ in footprints.footprints:
+        dx, dy = x - xx, y - yy
+        for direction_name in ['left', 'right', 'front', 'behind']:
+            direction_vec = scene_struct['directions'][direction_name]
+            if 0 < dx * direction_vec[0] + dy * direction_vec[1] < margin:
+                return False
+    return True
+
+
+def mask_iou(mask1, mask2):
+    """
+    Intersection over union of two masks, 1 when both are empty.
+    """
+    mask1, mask2 = mask1 > 0, mask2 > 0
+    union = np.count_nonzero(mask1 | mask2)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(mask1 & mask2) / float(union)
@@ -1,11 +1,13 @@
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile
+import math, sys, random, argparse, json, os, tempfile, time, copy
 import pathlib
 import shutil
 from datetime import datetime as dt
 from collections import Counter
 sys.path.append('.')
 from image_generation.add_parts import *
+import image_generation.placement as placement
+import image_generation.rle_masks as rle_masks
 # from add_parts import *
 from PIL import Image
 
@@ -95,6 +97,13 @@ parser.add_argument(
     help="The number of times to try placing an object before giving up and " +
          "re-placing all objects in the scene."
 )
+parser.add_argument(
+    '--max_restarts',
+    default=10,
+    type=int,
+    help="The number of times all objects of a scene are placed again " +
+         "before the scene gets one object fewer."
+)
 
 # Output settings
 parser.add_argument(
@@ -256,8 +265,84 @@ parser.add_argument(
 
 parser.add_argument('--data_dir', default=str(THIS_DIR / 'data_v0'), type=str)
 parser.add_argument('--mobility_dir', default=str(THIS_DIR / 'cart'), type=str)
+parser.add_argument('--mesh_cache_dir', default=None, type=str,
+    help="Directory of an on-disk cache of parsed PartNet leaf meshes, which " +
+         "can be shared by renderers running in parallel. Meshes are parsed " +
+         "from their .obj files every time if not given.")
+parser.add_argument('--mesh_cache_size', default=20.0, type=float,
+    help="Size bound of the mesh cache in GB; least recently used meshes are " +
+         "removed once it is exceeded.")
+parser.add_argument('--annotation_cache_dir', default=None, type=str,
+    help="Directory where the placement independent annotations of each shape " +
+         "(parts, counts, lines and planes, check_part verdict) are kept, so " +
+         "they are derived once per shape across runs. They are only kept in " +
+         "memory for the current run if not given.")
+parser.add_argument('--plane_flatness', default=0, type=int,
+    help="Setting --plane_flatness 1 only takes a part as a plane when its " +
+         "vertices are thin across the fitted plane (add_parts.PLANE_FLATNESS), " +
+         "in addition to the axis test of the original classifier.")
+parser.add_argument('--shape_catalog', default=None, type=str,
+    help="Shape catalog written by part_utils/build_shape_catalog.py. Shapes " +
+         "are then sampled among those passing check_part, and their leaf " +
+         "part ids and hierarchy are taken from it instead of the dataset. " +
+         "The category lists in data/ are used if not given.")
+parser.add_argument('--prefetch_depth', default=0, type=int,
+    help="Number of shapes whose meshes and annotations are prepared ahead " +
+         "of time in background threads while objects are placed and " +
+         "rendered; 0 prepares each shape when it is placed.")
+parser.add_argument('--prefetch_workers', default=2, type=int,
+    help="Number of threads preparing prefetched shapes.")
+parser.add_argument('--import_parts', default=0, type=int,
+    help="Setting --import_parts 1 builds the parts of each object by " +
+         "importing their .obj files into a .blend file in tmp_dir, one " +
+         "Blender process per part, as before. By default they are built " +
+         "directly in the running scene.")
+parser.add_argument('--shape_library_dir', default=None, type=str,
+    help="Directory of the .blend libraries written by " +
+         "part_utils/build_shape_library.py. Shapes found there are appended " +
+         "with their parts and annotations in one go instead of being built " +
+         "from their leaf meshes.")
+parser.add_argument('--mask_render_profile', default=1, type=int,
+    help="Setting --mask_render_profile 0 renders the part masks of each " +
+         "placement attempt with the full render settings instead of with " +
+         "1 sample, no bounces, no lamps and no world.")
+parser.add_argument('--mask_render_border', default=1, type=int,
+    help="Setting --mask_render_border 0 renders the part masks of each " +
+         "placement attempt over the full frame instead of only around the " +
+         "projected bounding box of the object.")
+parser.add_argument('--persistent_render_data', default=1, type=int,
+    help="Setting --persistent_render_data 0 makes Cycles synchronize the " +
+         "scene and build its BVH from scratch for every render, instead of " +
+         "keeping them between the renders of one image, which then all " +
+         "use the dynamic BVH.")
+parser.add_argument('--frustum_sampling', default=1, type=int,
+    help="Setting --frustum_sampling 0 draws object positions from the " +
+         "whole placement area. By default they are only drawn where the " +
+         "bounding sphere of the object is in view of the jittered camera.")
+parser.add_argument('--analytic_precheck', default=1, type=int,
+    help="Setting --analytic_precheck 0 builds and renders every placement " +
+         "attempt. By default attempts whose projected object leaves the " +
+         "frame are rejected before their parts are built, and those whose " +
+         "projected part hulls are clear of the earlier objects skip the " +
+         "raster precheck.")
+parser.add_argument('--raster_precheck', default=0, type=int,
+    help="Setting --raster_precheck 1 rasterizes the parts of each " +
+         "placement attempt in numpy before they are built, and rejects " +
+         "attempts whose object leaves the frame or overlaps an earlier " +
+         "object without rendering them. Cycles still renders the masks of " +
+         "the accepted ones; the agreement of both is reported at the end.")
+parser.add_argument('--raster_scale', default=1.0, type=float,
+    help="Resolution of the --raster_precheck masks relative to the render.")
 
 def main(args):
+  set_mesh_cache(args.mesh_cache_dir, int(args.mesh_cache_size * 1e9))
+  set_annotation_cache(args.annotation_cache_dir)
+  set_plane_flatness(args.plane_flatness)
+  set_shape_catalog(args.shape_catalog)
+  set_shape_library(args.shape_library_dir)
+  utils.set_mask_render_profile(args.mask_render_profile)
+  utils.set_mask_render_border(args.mask_render_border)
+  utils.enable_render_timer()
   tmp_dir = pathlib.Path(args.tmp_dir)
 
   if tmp_dir.exists():
@@ -283,6 +368,7 @@ def main(args):
     os.makedirs(args.output_blend_dir)
 
   all_scene_paths = []
+  scene_times = []
   for i in range(args.num_images):
     img_path = img_template % (i + args.start_idx)
     scene_path = scene_template % (i + args.start_idx)
@@ -301,6 +387,9 @@ def main(args):
     else:
       split = "train"
 
+    tic = time.time()
+    render_before = copy.deepcopy(utils.render_time_stats)
+    placement_before = placement_counts()
     render_scene(args,
       num_objects=num_objects,
       output_index=(i + args.start_idx),
@@ -310,6 +399,32 @@ def main(args):
       output_blendfile=blend_path,
       split = split
     )
+    scene_times.append(time.time() - tic)
+    print ("scene %d took %.1fs" % (i + args.start_idx, scene_times[-1]))
+    print (utils.render_time_report(render_before))
+    print (placement_report(placement_before))
+
+  print ("%d scenes in %.1fs, %.1fs per scene (prefetch depth %d)"
+         % (len(scene_times), sum(scene_times), sum(scene_times) / max(len(scene_times), 1), args.prefetch_depth))
+  stats = utils.mask_render_stats
+  print ("%d placement attempts, %d mask renders in %.1fs, %.2fs per attempt (mask render profile %d)"
+         % (stats['attempts'], stats['renders'], stats['time'], stats['time'] / max(stats['attempts'], 1), args.mask_render_profile))
+  print ("mask renders covered %.1f%% of the frame pixels (mask render border %d)"
+         % (100.0 * stats['pixels'] / max(stats['frame_pixels'], 1), args.mask_render_border))
+  print ("persistent render data %d" % args.persistent_render_data)
+  print (placement_report())
+  if args.raster_precheck:
+    ious = np.array(raster_stats['ious'])
+    print ("raster precheck: %d attempts checked in %.1fs, %d rejected before building their parts, %d accepted ones rejected by the Cycles masks"
+           % (raster_stats['checks'], raster_stats['time'], raster_stats['rejected'], raster_stats['cycles_rejected']))
+    if len(ious) > 0:
+      print ("raster part masks against the Cycles IndexOB masks: mean IoU %.3f, median %.3f, %.1f%% of %d parts above 0.9 (raster scale %.2f)"
+             % (ious.mean(), np.median(ious), 100.0 * np.mean(ious > 0.9), len(ious), args.raster_scale))
+  print (utils.render_time_report())
+  for split, prefetcher in prefetchers.items():
+    print ("%s: %d prefetched shapes, %.1fs spent waiting for them"
+           % (split, prefetcher.num_tasks, prefetcher.wait_time))
+    prefetcher.close()
 
   # After rendering all images, combine the JSON files for each scene into a
   # single JSON file.
@@ -354,6 +469,9 @@ def render_scene(args,
   render_args.resolution_percentage = 100
   render_args.tile_x = args.render_tile_size
   render_args.tile_y = args.render_tile_size
+  # Keep the synchronized scene between the mask renders of the placement
+  # attempts and the final render
+  utils.set_persistent_render_data(bpy.context.scene, args.persistent_render_data)
   if args.use_gpu == 1:
     # Blender changed the API for enabling CUDA at some point
     if bpy.app.version < (2, 78, 0):
@@ -565,6 +683,229 @@ def render_scene(args,
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
 
 
+SCALES = {'Bed': 1.5, 'Table': 1.5, 'Refrigerator': 1.5, 'Chair': 1, 'Cart': 1.25}
+
+def choose_shape_id(obj_name, split, rng=random):
+  """
+  Picks the id of a random shape of category obj_name in the given split.
+  """
+  if has_shape_catalog():
+    # Only shapes that pass check_part are sampled from the catalog
+    return rng.choice(catalog_shape_ids(obj_name.lower(), split, 'partnet'))
+
+  category_path = str(DATA_DIR / "%s.json") % obj_name.lower()
+  f = open(category_path)
+  objs = json.load(f)
+  if split == "val": objs = objs[:int (len(objs) * 0.14286) - 1]
+  if split == "test": objs = objs[int (len(objs) * 0.14286) - 1: int (len(objs) * 0.28571) - 1]
+  if split == "train": objs = objs[int (len(objs) * 0.28571) - 1:]
+  if obj_name in ['Chair', 'Table', 'Bed', 'Cart']:
+    id2 = rng.choice(objs)
+  else:
+    obj = rng.choice(objs)
+    id2 = obj['anno_id']
+  return id2
+
+def prepare_shape(args, obj_name, id2, radius):
+  """
+  Loads what placing shape id2 of category obj_name needs: its leaf meshes
+  scaled to radius and its placement independent annotations. A shape
+  annotated before only needs its rotation applied, and one that failed
+  check_part before is returned with 'annotation' None, without loading
+  its meshes. A shape annotated here gets its check_part verdict from
+  check_annotation, so one that fails is also returned with 'annotation'
+  None, before any of its parts are built. A shape found in the shape
+  library is returned with its 'library' entry instead of its meshes.
+  """
+  if obj_name == 'Cart':
+    # cur_shape_dir = "../../cart/%s"%id2
+    cur_shape_dir = "%s/%s"%(args.mobility_dir, id2)
+    cur_part_dir = os.path.join(cur_shape_dir, 'textured_objs')
+    catalog_entry = catalog_shape('mobility', id2)
+  else:
+    # cur_shape_dir = "../../data_v0/%s"%id2
+    cur_shape_dir = "%s/%s"%(args.data_dir, id2)
+    cur_part_dir = os.path.join(cur_shape_dir, 'objs')
+    catalog_entry = catalog_shape('partnet', id2)
+  if catalog_entry is not None:
+    leaf_part_ids = catalog_entry['leaf_part_ids']
+  else:
+    leaf_part_ids = [item.split('.')[0] for item in os.listdir(cur_part_dir) if item.endswith('.obj')]
+
+  shape_key = annotation_key('partnet', obj_name, cur_part_dir)
+  library = shape_library_entry(shape_key, radius)
+  if library is not None:
+    # Only shapes passing check_part are written to the library
+    return {'id': id2, 'leaf_part_ids': library['leaf_part_ids'], 'key': shape_key,
+            'cached': {'annotation': library['annotation'], 'keep': True}, 'library': library,
+            'scale': library['scale'], 'meshes': None, 'annotation': library['annotation']}
+
+  cached = cached_annotation(shape_key)
+  shape = {'id': id2, 'leaf_part_ids': leaf_part_ids, 'key': shape_key, 'cached': cached, 'library': None,
+           'scale': None, 'meshes': None, 'annotation': None}
+  if cached is not None and not cached['keep']:
+    return shape
+
+  scale, meshes = load_part_meshes(cur_part_dir, leaf_part_ids, radius)
+
+  if cached is None:
+    if catalog_entry is not None:
+      tree_hier = catalog_entry['hierarchy']
+    else:
+      try:
+        cur_result_json = os.path.join(cur_shape_dir, 'result_after_merging.json')
+        with open(cur_result_json, 'r') as fin:
+            tree_hier = json.load(fin)[0]
+      except:
+        cur_result_json = os.path.join(cur_shape_dir, 'result.json')
+        with open(cur_result_json, 'r') as fin:
+            tree_hier = json.load(fin)[0]
+    part_list, part_list2, count_list, geo_list1, geo_list2 = utils.get_list(obj_name)
+    annotation = annotate_parts(meshes, tree_hier, obj_name, part_list, geo_list1, geo_list2)
+    keep = check_annotation(obj_name, annotation)
+    cache_annotation(shape_key, annotation, keep)
+    shape['cached'] = cached_annotation(shape_key)
+    if not keep:
+      return shape
+  else:
+    annotation = cached['annotation']
+
+  shape['scale'] = scale
+  shape['meshes'] = meshes
+  shape['annotation'] = annotation
+  return shape
+
+# One Prefetcher per split, see prefetched_shape
+prefetchers = dict()
+
+# Placement attempts that got past check_part before being built, those
+# analytic_precheck rejected, and those whose hulls overlap an earlier object
+placement_stats = {'attempts': 0, 'out_of_frame': 0, 'hull_overlaps': 0, 'restarts': 0}
+
+# Overlap in pixels above which the masks of two objects collide
+MAX_MASK_OVERLAP = 5
+
+def screen_hulls(placed, P):
+  """
+  Screen space convex hulls of the parts of a placement of analytic_precheck,
+  computed when they are first needed.
+  """
+  if placed['hulls'] is None:
+    placed['hulls'] = [placement.convex_hull_2d(placement.project_points(v, placed['matrix'], P)[0]) for v, _ in placed['meshes']]
+  return placed['hulls']
+
+def analytic_precheck(args, parts, loc, theta, P, obj_placements):
+  """
+  Rejects placements that the mask checks of add_random_objects would reject,
+  from the projection of the parts alone. The object must lie in front of
+  the camera and not reach past the left, right or bottom edge of the frame,
+  nor lie above it; the projected corners of its bounding box settle most
+  placements inside the frame without projecting every vertex. Hulls only
+  ever accept: a convex hull covers more than a non-convex part, so when the
+  screen space hull of each part overlaps those of the parts of the earlier
+  placements in obj_placements by at most MAX_MASK_OVERLAP pixels, the masks
+  cannot collide and placed['clear'] is set; otherwise the masks decide.
+  Hulls are only computed for objects whose boxes overlap. Returns whether
+  the placement is kept, the reason when it is not, and the placement to add
+  to obj_placements.
+  """
+  meshes = [mesh for _, mesh in parts]
+  matrix = placement.placement_matrix(meshes, loc, theta)
+  corners, depth = placement.project_points(placement.box_corners(np.vstack([v for v, _ in meshes])), matrix, P)
+  box = np.array([corners.min(axis=0), corners.max(axis=0)])
+  if np.any(depth <= 0) or np.any(box[0] < 0) or box[1, 0] > args.width or box[1, 1] > args.height:
+    projected = [placement.project_points(v, matrix, P) for v, _ in meshes]
+    if any(np.any(d <= 0) for _, d in projected):
+      return False, 'out_of_frame', None
+    points = np.vstack([uv for uv, _ in projected])
+    box = np.array([points.min(axis=0), points.max(axis=0)])
+    if box[0, 0] < 0 or box[1, 0] > args.width or box[1, 1] > args.height or box[1, 1] < 0:
+      return False, 'out_of_frame', None
+
+  placed = {'box': box, 'matrix': matrix, 'meshes': meshes, 'hulls': None, 'clear': True}
+  for prev in obj_placements:
+    if np.any(box[0] > prev['box'][1]) or np.any(prev['box'][0] > box[1]):
+      continue
+    for hull in screen_hulls(placed, P):
+      for prev_hull in screen_hulls(prev, P):
+        if placement.convex_overlap_area(hull, prev_hull) > MAX_MASK_OVERLAP:
+          placed['clear'] = False
+          return True, None, placed
+  return True, None, placed
+
+def placement_counts():
+  """
+  Running totals of placement_stats, raster_stats and mask renders, for
+  placement_report.
+  """
+  counts = dict(placement_stats)
+  counts['raster_rejected'] = raster_stats['rejected']
+  counts['mask_renders'] = utils.mask_render_stats['attempts']
+  return counts
+
+def placement_report(since=None):
+  """
+  One line on the placement attempts since the placement_counts since.
+  """
+  counts = placement_counts()
+  if since is not None:
+    counts = {name: value - since[name] for name, value in counts.items()}
+  avoided = counts['out_of_frame'] + counts['raster_rejected']
+  return ("placement: %d attempts, %d mask renders, %d renders avoided (%d out of frame, %d by the raster precheck), %d with overlapping hulls, %d restarts"
+          % (counts['attempts'], counts['mask_renders'], avoided, counts['out_of_frame'],
+             counts['raster_rejected'], counts['hull_overlaps'], counts['restarts']))
+
+# Placement attempts checked by raster_precheck, those it rejected, the time
+# it took, the accepted attempts the Cycles masks rejected after all, and
+# the IoU of each part mask with the Cycles one
+raster_stats = {'checks': 0, 'rejected': 0, 'time': 0.0, 'cycles_rejected': 0, 'ious': []}
+
+def raster_precheck(args, parts, loc, theta, P, obj_masks):
+  """
+  Applies the boundary and overlap checks of add_random_objects to the part
+  masks of rasterize_parts instead of the Cycles ones, before the parts of
+  the object are built. Returns whether the placement is kept and the masks.
+  """
+  tic = time.time()
+  meshes = [mesh for _, mesh in parts]
+  matrix = placement.placement_matrix(meshes, loc, theta)
+  masks = placement.raster_masks(meshes, matrix, P, (args.height, args.width), args.raster_scale)
+  obj_img = np.any(masks > 0, axis=0)
+  rows = np.where(obj_img.any(axis=1))[0]
+  cols = np.where(obj_img.any(axis=0))[0]
+  if len(rows) == 0 or cols[0] == 0 or cols[-1] == args.width - 1 or rows[-1] == args.height - 1:
+    keep = False
+  else:
+    obj_rle = rle_masks.encode(obj_img)
+    keep = all(rle_masks.overlap(prev_mask, obj_rle) <= MAX_MASK_OVERLAP for prev_mask in obj_masks)
+  raster_stats['checks'] += 1
+  raster_stats['rejected'] += not keep
+  raster_stats['time'] += time.time() - tic
+  return keep, masks
+
+def prefetched_shape(args, split, object_list, weight_list):
+  """
+  Returns the category and the prepared shape (see prepare_shape) of the
+  next object to place. Categories and shapes are drawn ahead of time from
+  their own random streams, and prepared by --prefetch_workers threads
+  while the main thread places and renders the previous objects.
+  """
+  if split not in prefetchers:
+    rng = random.Random(random.getrandbits(32))
+    np_rng = np.random.RandomState(rng.getrandbits(32))
+
+    def next_task():
+      obj_name = object_list[np_rng.choice(len(object_list), p=weight_list)]
+      return obj_name, choose_shape_id(obj_name, split, rng), SCALES[obj_name]
+
+    def prepare(obj_name, id2, radius):
+      return prepare_shape(args, obj_name, id2, radius)
+
+    prefetchers[split] = Prefetcher(next_task, prepare, args.prefetch_depth, args.prefetch_workers)
+
+  (obj_name, _, _), shape = prefetchers[split].get()
+  return obj_name, shape
+
 def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
   """
   Add random objects to the current blender scene
@@ -587,9 +928,17 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
   obj_masks = []
   obj_names = []
   blender_objects = []
+  # Placements of the placed objects for analytic_precheck, None for those
+  # it did not check
+  obj_placements = []
+  P = np.array(utils.get_3x4_P_matrix_from_blender(camera)[0])
+  footprints = placement.FootprintHash(2 * max(SCALES.values()) + args.min_dist)
+  # Ground polygon of the positions in view, per object radius
+  floors = dict()
 
   i = 0
   tries = dict()
+  restarts = 0
 
   # place object
   while i < num_objects:
@@ -602,42 +951,61 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
 
     # Choose random categories
     from numpy.random import choice
-    obj_name = choice(object_list, 1, p=weight_list)[0]
-    scales = {'Bed': 1.5, 'Table': 1.5, 'Refrigerator': 1.5, 'Chair': 1, 'Cart': 1.25}
+    if args.prefetch_depth > 0:
+      obj_name, shape = prefetched_shape(args, split, object_list, weight_list)
+    else:
+      obj_name = choice(object_list, 1, p=weight_list)[0]
+    scales = SCALES
     # Choose random orientation for the object.
 
 
     num_tries = 0
     r = scales[obj_name]
+    if r not in floors:
+      floors[r] = placement.visible_floor(P, args.width, args.height, r) if args.frustum_sampling else np.zeros((0, 2))
+      if args.frustum_sampling and len(floors[r]) < 3:
+        print ("no room in view for objects of radius %.2f, drawing from the whole placement area" % r)
+    print ("place %d-th object"%i)
+    restart = False
     while True:
-      print ("place %d-th object"%i)
       # If we try and fail to place an object too many times, then delete all
       # the objects in the scene and start over.
       num_tries += 1
       if num_tries > args.max_retries:
-        for (j,obj) in enumerate(blender_objects):
-          utils.delete_object(obj)
-          cmd = 'rm -rf %s' %args.tmp_dir
-          call(cmd, shell=True)
-        return add_random_objects(scene_struct, num_objects, args, camera)
-
-      x = random.uniform(-5, 5)
-
-      y = random.uniform(-8, 3)
-
-      dists_good = True
-      margins_good = True
-      for (m,(xx, yy, rr)) in enumerate(positions):
-        dx, dy = abs(x - xx), abs(y - yy)
-        dist = math.sqrt(dx * dx + dy * dy)
+        restart = True
+        break
 
-        if abs(dx) < 0:
-            print('BROKEN MARGIN!')
-            margins_good = False
+      if len(floors[r]) >= 3:
+        x, y = placement.sample_in_polygon(floors[r])
+      else:
+        xmin, xmax, ymin, ymax = placement.PLACEMENT_AREA
+        x, y = random.uniform(xmin, xmax), random.uniform(ymin, ymax)
 
-      if dists_good and margins_good:
+      if footprints.fits(x, y, r, args.min_dist) and placement.margins_good(scene_struct, footprints, x, y, args.margin):
         break
 
+    if restart:
+      print ("could not place the %d-th object, placing all objects again" % i)
+      for obj in blender_objects:
+        utils.delete_object(obj)
+      cmd = 'rm -rf %s' %args.tmp_dir
+      call(cmd, shell=True)
+      positions, objects, obj_masks, obj_names, blender_objects, obj_placements = [], [], [], [], [], []
+      footprints = placement.FootprintHash(footprints.cell_size)
+      placement_stats['restarts'] += 1
+      restarts += 1
+      if restarts > args.max_restarts:
+        # The scene cannot hold that many objects
+        if num_objects == 1:
+          raise RuntimeError("could not place a single object in %d restarts of %d retries each; "
+                             "check --min_dist, --margin and the camera" % (args.max_restarts, args.max_retries))
+        num_objects -= 1
+        restarts = 0
+        print ("%d restarts, placing %d objects in this scene instead" % (args.max_restarts, num_objects))
+      i = 0
+      tries = dict()
+      continue
+
     base = 0.2
     if obj_name == 'Cart':
       base = 0.5
@@ -649,77 +1017,74 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
 
     # get a random object
     # if obj_name in ['Chair', 'Table', 'Bed', 'Cart']:
-    category_path = str(DATA_DIR / "%s.json") % obj_name.lower()
-    f = open(category_path)
-    objs = json.load(f)
-    if split == "val": objs = objs[:int (len(objs) * 0.14286) - 1]
-    if split == "test": objs = objs[int (len(objs) * 0.14286) - 1: int (len(objs) * 0.28571) - 1]
-    if split == "train": objs = objs[int (len(objs) * 0.28571) - 1:]
-    if obj_name in ['Chair', 'Table', 'Bed', 'Cart']:
-      id2 = random.choice(objs)
-    else:
-      obj = random.choice(objs)
-      id2 = obj['anno_id']
-
-    if obj_name == 'Cart':
-      # cur_shape_dir = "../../cart/%s"%id2
-      cur_shape_dir = "%s/%s"%(args.mobility_dir, id2)
-      cur_part_dir = os.path.join(cur_shape_dir, 'textured_objs')
-    else:
-      # cur_shape_dir = "../../data_v0/%s"%id2
-      cur_shape_dir = "%s/%s"%(args.data_dir, id2)
-      cur_part_dir = os.path.join(cur_shape_dir, 'objs')
-    leaf_part_ids = [item.split('.')[0] for item in os.listdir(cur_part_dir) if item.endswith('.obj')]
+    if args.prefetch_depth == 0:
+      id2 = choose_shape_id(obj_name, split)
+      shape = prepare_shape(args, obj_name, id2, scales[obj_name])
+    id2 = shape['id']
+    leaf_part_ids = shape['leaf_part_ids']
     cur_render_dir = args.tmp_dir
 
-    root_v_list = []; root_f_list = []; tot_v_num = 0;
-    for idx in leaf_part_ids:
-        v, f = load_obj(os.path.join(cur_part_dir, str(idx)+'.obj'))
-        mesh = dict();
-        mesh['v'] = v; mesh['f'] = f;
-        root_v_list.append(v);
-        root_f_list.append(f+tot_v_num);
-        tot_v_num += v.shape[0];
-
-    root_v = np.vstack(root_v_list)
-    root_f = np.vstack(root_f_list)
-
-    scale = np.sqrt(np.max(np.sum(root_v**2, axis=1)))
-    scale /= scales[obj_name]
-    root_v /= scale
-    # center = np.min(root_v, axis=0)
-    # root_v -= center
-
-    try:
-      cur_result_json = os.path.join(cur_shape_dir, 'result_after_merging.json')
-      with open(cur_result_json, 'r') as fin:
-          tree_hier = json.load(fin)[0]
-    except:
-      cur_result_json = os.path.join(cur_shape_dir, 'result.json')
-      with open(cur_result_json, 'r') as fin:
-          tree_hier = json.load(fin)[0]
+    if shape['annotation'] is None:
+      print ("shape %s failed check_part before" % id2)
+      i -= 1
+      continue
+
+    scale, meshes, annotation = shape['scale'], shape['meshes'], shape['annotation']
 
     obj_name2 = obj_name + str(i)
 
+    # Placements the prechecks reject are dropped before their parts are
+    # built; those whose hulls are clear of the earlier objects need no
+    # raster precheck
+    placement_stats['attempts'] += 1
+    precheck_masks = None
+    placed = None
+    parts = None
+    if (args.analytic_precheck or args.raster_precheck) and meshes is not None:
+      parts = placement_parts(meshes, annotation, leaf_part_ids)
+    elif shape['library'] is not None:
+      # Written next to the .blend file by build_shape_library.py; None for
+      # libraries written before
+      parts = shape['library']['parts']
+    if args.analytic_precheck and parts is not None:
+      keep, reason, placed = analytic_precheck(args, parts, (x, y), theta, P,
+                                              [p for p in obj_placements if p is not None])
+      if not keep:
+        print ("rejected by the analytic precheck: %s" % reason.replace('_', ' '))
+        placement_stats[reason] += 1
+        i -= 1
+        if i >= 5 and tries[i] >= 50:
+          break
+        else:
+          continue
+      if not placed['clear']:
+        placement_stats['hull_overlaps'] += 1
+    if args.raster_precheck and parts is not None and (placed is None or not placed['clear']):
+      keep, precheck_masks = raster_precheck(args, parts, (x, y), theta, P, obj_masks)
+      if not keep:
+        print ("rejected by the raster precheck")
+        i -= 1
+        if i >= 5 and tries[i] >= 50:
+          break
+        else:
+          continue
+
     #get annotations
 
     #part_list2 specifies the parts to be kept; count_list specifies the parts that we want to count the number of; geo_list1 specifies the lists that can be considered as lines; geo_list2 specifies the lists that can be considered as planes
     part_list, part_list2, count_list, geo_list1, geo_list2 = utils.get_list(obj_name)
 
-    part_dict = dict()
-    count_dict = dict()
-    objs_dict = dict()
-    line_dict = dict()
-    plane_dict = dict()
-
-    final_objs = []
-    _, _, part_color, part_count, part_objs, all_objects, line_geo, plane_geo = add_one_part(scale, tree_hier, cur_part_dir, cur_render_dir, obj_name2, part_list, geo_list1, geo_list2, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict)
+    set_mesh_builder(utils.mesh_builder_for(shape['library'], args.import_parts))
+    part_color, part_count, part_objs, all_objects, line_geo, plane_geo = add_one_part(meshes, annotation, cur_render_dir, obj_name2)
 
     line_geo_final, plane_geo_final, part_color_all, part_color_final, part_count_final,  geometry, final_objects = revise_annotations(line_geo, plane_geo, part_color, part_count, all_objects, obj_name, part_list2, count_list, theta)
 
+    # prepare_shape already dropped the shapes check_annotation rejects
     keep = check_part(obj_name, part_count_final, part_color_final)
     if not keep:
       i -= 1
+      if not args.import_parts or shape['library'] is not None:
+        utils.delete_parts(obj_name2)
       cmd = 'rm -rf %s'%args.tmp_dir
       call(cmd, shell=True)
       continue
@@ -737,45 +1102,35 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
     for obj_file in leaf_part_ids:
       if not obj_file in rendered_objs:
         part_objs['other'].append(obj_file)
-        cur_v_list = []; cur_f_list = []; cur_v_num = 0;
-        v, f = load_obj(os.path.join(cur_part_dir, obj_file+'.obj'))
-        # v -= center
-        v /= scale
-        cur_v_list.append(v)
-        cur_f_list.append(f+cur_v_num)
-        cur_v_num += v.shape[0]
-
-        part_v = np.vstack(cur_v_list)
-        part_f = np.vstack(cur_f_list)
+        part_v, part_f = meshes[obj_file] if meshes is not None else (None, None)
 
         final_objects.append('other')
         add_mesh (obj_name2, part_v, part_f, args.tmp_dir, color=rgba)
 
     # Actually add the object to the scene
-    utils.add_object(obj_name2, (x, y), args.tmp_dir, theta=theta)
+    _, _, masks = utils.add_object(obj_name2, (x, y), args.tmp_dir, theta=theta)
 
     import copy
     part_color_occluded = part_color_final.copy()
     part_count_occluded = part_count_final.copy()
 
-    # get masks and find overlappings
-    ims = os.listdir(args.tmp_dir)
-    images = [image for image in ims if (image.endswith(".png") and not image == "Image0001.png")]
-    images.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
-
+    # get masks and find overlappings; masks[idx] is the mask of the part
+    # added as final_objects[idx]
     obj_img = np.zeros((args.height, args.width))
 
-    assert len(images) == len(final_objects)
+    assert len(masks) == len(final_objects)
+
+    if precheck_masks is not None:
+      for raster_mask, img in zip(precheck_masks, masks):
+        if np.any(raster_mask) or np.any(img):
+          raster_stats['ious'].append(placement.mask_iou(raster_mask, img))
 
     keep = True
 
     part_masks = dict()
 
-    for (idx, image) in enumerate(images):
+    for (idx, img) in enumerate(masks):
       part = final_objects[idx]
-      img = Image.open('%s/'%args.tmp_dir + image).convert('L')
-
-      img = np.asarray(img)
       obj_img += img
       if len(np.where(img > 0)[0]) < 5:
         print ("occluded part: %s" %part)
@@ -798,7 +1153,7 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
     if keep:
       obj_img = np.clip(obj_img, 0, 1).astype('uint8')
       try:
-        if np.min(np.where(obj_img > 0)[1]) == 0 or np.max(np.where(obj_img > 0)[1]) == 799 or np.max(np.where(obj_img > 0)[0]) == 599:
+        if np.min(np.where(obj_img > 0)[1]) == 0 or np.max(np.where(obj_img > 0)[1]) == args.width - 1 or np.max(np.where(obj_img > 0)[0]) == args.height - 1:
           print ("out of boundary")
           keep = False
       except:
@@ -813,17 +1168,17 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
       obj_mask = rle
 
       for (im, prev_mask) in enumerate(obj_masks):
-        overlapping_area = prev_mask & obj_img
-        img = Image.fromarray(overlapping_area*255, 'L')
-        ov = len(np.where(overlapping_area > 0)[0])
+        ov = rle_masks.overlap(prev_mask, obj_mask)
         # print (mask1 - mask2)
 
-        if ov > 5:
+        if ov > MAX_MASK_OVERLAP:
           print ("overlapping objects")
           keep = False
           break
 
     if not keep:
+      if precheck_masks is not None:
+        raster_stats['cycles_rejected'] += 1
       bpy.data.objects[obj_name2].select = True
       bpy.ops.object.delete()
       cmd = 'rm -rf %s'%args.tmp_dir
@@ -838,11 +1193,13 @@ def add_random_objects(scene_struct, num_objects, args, camera, split="train"):
     call(cmd, shell=True)
 
     # Record data about the object in the scene data structure
-    obj_masks.append(obj_img)
+    obj_masks.append(obj_mask)
+    obj_placements.append(placed)
     obj_names.append(obj_name)
     obj = bpy.context.object
     blender_objects.append(obj)
     positions.append((x, y, r))
+    footprints.add(x, y, r)
 
     pixel_coords = utils.get_camera_coords(camera, obj.location)
 
@@ -930,28 +1287,6 @@ def revise_annotations(line_geo, plane_geo, part_color, part_count, all_objects,
 
     return line_geo_final, plane_geo_final, part_color_all, part_color_final, part_count_final, geometry, final_objects
 
-def check_part(obj_name, part_count_final, part_color_final):
-    keep = True
-    if "wheel" in part_count_final.keys() and obj_name in ['Chair', 'Table']:
-      if "leg" in part_count_final.keys():
-        part_count_final["wheel"] = part_count_final["leg"]
-      else:
-        print ("wheel not paired with leg")
-        keep = False
-
-    if obj_name == 'Chair' and not ('leg' in part_color_final.keys() or 'central_support' in part_color_final.keys() or 'pedestal' in part_color_final.keys()):
-      print ("lack base of chair")
-      keep = False
-
-    if obj_name == 'Refrigerator' and not 'door' in part_color_final.keys():
-      print ("lack door of fridge")
-      keep = False
-
-    if obj_name == 'Chair' and ('arm' in part_color_final.keys() and ('arm vertical bar' in part_color_final.keys() or 'arm horizontal bar' in part_color_final.keys())):
-      print ("duplicate arm entry")
-      keep = False
-    return keep
-
 def compute_all_relationships(scene_struct, eps=0.2):
   """
   Computes relationships between all pairs of objects in the scene.
@@ -5,6 +5,8 @@ from datetime import datetime as dt
 from collections import Counter
 sys.path.append('.')
 from add_parts import *
+import rle_masks
+import placement
 import pathlib
 import pybullet as p
 from PIL import Image
@@ -74,6 +76,9 @@ parser.add_argument('--min_pixels_per_object', default=200, type=int,
 parser.add_argument('--max_retries', default=20000, type=int,
     help="The number of times to try placing an object before giving up and " +
          "re-placing all objects in the scene.")
+parser.add_argument('--max_restarts', default=10, type=int,
+    help="The number of times all objects of a scene are placed again " +
+         "before the scene gets one object fewer.")
 
 # Output settings
 parser.add_argument('--start_idx', default=0, type=int,
@@ -150,8 +155,65 @@ parser.add_argument('--render_tile_size', default=256, type=int,
 
 parser.add_argument('--data_dir', default='./data_v0', type=str)
 parser.add_argument('--mobility_dir', default='./cart', type=str)
+parser.add_argument('--mesh_cache_dir', default=None, type=str,
+    help="Directory of an on-disk cache of parsed PartNet leaf meshes, which " +
+         "can be shared by renderers running in parallel. Meshes are parsed " +
+         "from their .obj files every time if not given.")
+parser.add_argument('--mesh_cache_size', default=20.0, type=float,
+    help="Size bound of the mesh cache in GB; least recently used meshes are " +
+         "removed once it is exceeded.")
+parser.add_argument('--annotation_cache_dir', default=None, type=str,
+    help="Directory where the placement independent annotations of each shape " +
+         "(parts, counts, lines and planes, check_part verdict) are kept, so " +
+         "they are derived once per shape across runs. They are only kept in " +
+         "memory for the current run if not given.")
+parser.add_argument('--plane_flatness', default=0, type=int,
+    help="Setting --plane_flatness 1 only takes a part as a plane when its " +
+         "vertices are thin across the fitted plane (add_parts.PLANE_FLATNESS), " +
+         "in addition to the axis test of the original classifier.")
+parser.add_argument('--shape_catalog', default=None, type=str,
+    help="Shape catalog written by part_utils/build_shape_catalog.py. Shapes " +
+         "are then sampled among those passing check_part, and their leaf " +
+         "part ids and hierarchy are taken from it instead of the dataset. " +
+         "The category lists in data/ are used if not given.")
+parser.add_argument('--import_parts', default=0, type=int,
+    help="Setting --import_parts 1 builds the parts of each object by " +
+         "importing their .obj files into a .blend file in tmp_dir, one " +
+         "Blender process per part, as before. By default they are built " +
+         "directly in the running scene.")
+parser.add_argument('--shape_library_dir', default=None, type=str,
+    help="Directory of the .blend libraries written by " +
+         "part_utils/build_shape_library.py. Shapes found there are appended " +
+         "with their parts and annotations in one go instead of being built " +
+         "from their leaf meshes.")
+parser.add_argument('--mask_render_profile', default=1, type=int,
+    help="Setting --mask_render_profile 0 renders the part masks of each " +
+         "placement attempt with the full render settings instead of with " +
+         "1 sample, no bounces, no lamps and no world.")
+parser.add_argument('--mask_render_border', default=1, type=int,
+    help="Setting --mask_render_border 0 renders the part masks of each " +
+         "placement attempt over the full frame instead of only around the " +
+         "projected bounding box of the object.")
+parser.add_argument('--frustum_sampling', default=1, type=int,
+    help="Setting --frustum_sampling 0 draws the positions of objects on " +
+         "the floor from the whole placement area. By default they are only " +
+         "drawn where the bounding sphere of the object is in view of the " +
+         "jittered camera.")
+parser.add_argument('--persistent_render_data', default=1, type=int,
+    help="Setting --persistent_render_data 0 makes Cycles synchronize the " +
+         "scene and build its BVH from scratch for every render, instead of " +
+         "keeping them between the renders of one image, which then all " +
+         "use the dynamic BVH.")
 
 def main(args):
+  set_mesh_cache(args.mesh_cache_dir, int(args.mesh_cache_size * 1e9))
+  set_annotation_cache(args.annotation_cache_dir)
+  set_plane_flatness(args.plane_flatness)
+  set_shape_catalog(args.shape_catalog)
+  set_shape_library(args.shape_library_dir)
+  utils.set_mask_render_profile(args.mask_render_profile)
+  utils.set_mask_render_border(args.mask_render_border)
+  utils.enable_render_timer()
   num_digits = 6
   prefix = '%s_%s_' % (args.filename_prefix, args.split)
   img_template = '%s%%0%dd.png' % (prefix, num_digits)
@@ -196,6 +258,13 @@ def main(args):
       output_blendfile=blend_path,
       split = split
     )
+  stats = utils.mask_render_stats
+  print ("%d placement attempts, %d mask renders in %.1fs, %.2fs per attempt (mask render profile %d)"
+         % (stats['attempts'], stats['renders'], stats['time'], stats['time'] / max(stats['attempts'], 1), args.mask_render_profile))
+  print ("mask renders covered %.1f%% of the frame pixels (mask render border %d)"
+         % (100.0 * stats['pixels'] / max(stats['frame_pixels'], 1), args.mask_render_border))
+  print ("persistent render data %d" % args.persistent_render_data)
+  print (utils.render_time_report())
 
   # After rendering all images, combine the JSON files for each scene into a
   # single JSON file.
@@ -242,6 +311,9 @@ def render_scene(args,
   render_args.resolution_percentage = 100
   render_args.tile_x = args.render_tile_size
   render_args.tile_y = args.render_tile_size
+  # Keep the synchronized scene between the mask renders of the placement
+  # attempts and the final render
+  utils.set_persistent_render_data(bpy.context.scene, args.persistent_render_data)
   if args.use_gpu == 1:
     # Blender changed the API for enabling CUDA at some point
     if bpy.app.version < (2, 78, 0):
@@ -590,9 +662,17 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
   urdf_objects = []
   obj_modes = []
   normals = []
+  P = np.array(get_3x4_P_matrix_from_blender(camera)[0])
+  # Footprints of the objects on the floor; side wall and support objects
+  # are positioned by add_object2
+  scales = {'Bed': 1.5, 'Table': 1.5, 'Refrigerator': 1.5, 'Chair': 1, 'Cart': 1.25}
+  footprints = placement.FootprintHash(2 * max(scales.values()) + args.min_dist)
+  # Ground polygon of the positions in view, per object radius
+  floors = dict()
 
   i = 0
   tries = dict()
+  restarts = 0
   from numpy.random import choice 
 
   invalid = 0
@@ -623,30 +703,30 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
     while (mode == 'normal' and obj_name == 'Cart') or (mode == "support" and obj_name == 'Bed'):
       obj_name = choice(object_list, 1, p=weight_list)[0]
 
-    scales = {'Bed': 1.5, 'Table': 1.5, 'Refrigerator': 1.5, 'Chair': 1, 'Cart': 1.25}
     # Choose random orientation for the object.
         
     num_tries = 0
     r = scales[obj_name]
+    floor_mode = mode in ["normal", "ground"]
+    if floor_mode and r not in floors:
+      floors[r] = placement.visible_floor(P, args.width, args.height, r) if args.frustum_sampling else np.zeros((0, 2))
+      if args.frustum_sampling and len(floors[r]) < 3:
+        print ("no room in view for objects of radius %.2f, drawing from the whole placement area" % r)
+    print ("place %d-th object"%i)
+    restart = False
     while True:
-      print ("place %d-th object"%i)
       # If we try and fail to place an object too many times, then delete all
       # the objects in the scene and start over.
       num_tries += 1
       if num_tries > args.max_retries:
-        for obj in bpy.data.objects:
-          if 'Table' in obj.name or 'Chair' in obj.name or 'Refrigerator' in obj.name or 'Cart' in obj.name or 'Bed' in obj.name:
-            delete_object(obj)
-          cmd = 'rm -rf %s'%args.tmp_dir
-          call(cmd, shell=True)
-        return add_random_objects(scene_struct, num_objects, args, camera)
-      
-      x = random.uniform(-3, 3)
-      
-      y = random.uniform(-8, 1)
+        restart = True
+        break
 
-      dists_good = True
-      margins_good = True
+      if floor_mode and len(floors[r]) >= 3:
+        x, y = placement.sample_in_polygon(floors[r])
+      else:
+        x = random.uniform(-3, 3)
+        y = random.uniform(-8, 1)
 
       p_type = "static"
       if obj_name in ['Chair']:
@@ -657,18 +737,35 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
 
       rot = get_rot(obj_name, mode, p_type)
 
-      # try to place the object
-      for (m,(xx, yy, rr)) in enumerate(positions):
-        dx, dy = abs(x - xx), abs(y - yy)
-        dist = math.sqrt(dx * dx + dy * dy)
-
-        if abs(dx) < 0:
-            print('BROKEN MARGIN!')
-            margins_good = False
-
-      if dists_good and margins_good:
+      if not floor_mode:
+        break
+      if footprints.fits(x, y, r, args.min_dist) and placement.margins_good(scene_struct, footprints, x, y, args.margin):
         break
 
+    if restart:
+      print ("could not place the %d-th object, placing all objects again" % i)
+      for obj in list(bpy.data.objects):
+        if 'Table' in obj.name or 'Chair' in obj.name or 'Refrigerator' in obj.name or 'Cart' in obj.name or 'Bed' in obj.name:
+          delete_object(obj)
+      cmd = 'rm -rf %s'%args.tmp_dir
+      call(cmd, shell=True)
+      positions, objects, obj_masks, obj_names, blender_objects = [], [], [], [], []
+      urdf_objects, obj_modes, normals = [], [], []
+      footprints = placement.FootprintHash(footprints.cell_size)
+      restarts += 1
+      if restarts > args.max_restarts:
+        # The scene cannot hold that many objects
+        if num_objects == 1:
+          raise RuntimeError("could not place a single object in %d restarts of %d retries each; "
+                             "check --min_dist, --margin and the camera" % (args.max_restarts, args.max_retries))
+        num_objects -= 1
+        restarts = 0
+        print ("%d restarts, placing %d objects in this scene instead" % (args.max_restarts, num_objects))
+      i = 0
+      tries = dict()
+      invalid = 0
+      continue
+
     theta = random.random() * 3.14
 
     if obj_name == 'Cart':
@@ -679,61 +776,62 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
     if mode == "support":
       theta = normals[-1][2]
 
-    category_path = "./data/%s.json" % obj_name.lower()
+    list_name = obj_name.lower()
     if obj_name in ['Chair']:
       if p_type == "static":
-        category_path = "./data/%s_static.json" % obj_name.lower()
+        list_name = "%s_static" % obj_name.lower()
       if p_type == "physics":
-        category_path = "./data/%s_physics.json" % obj_name.lower()
-
-    f = open(category_path)
-    objs = json.load(f)
-    if split == "val": objs = objs[:int (len(objs) * 0.14286) - 1]
-    if split == "test": objs = objs[int (len(objs) * 0.14286) - 1: int (len(objs) * 0.28571) - 1]
-    if split == "train": objs = objs[int (len(objs) * 0.28571) - 1:]
-    if obj_name in ['Chair', 'Table', 'Bed', 'Cart']:
-      id2 = random.choice(objs)
+        list_name = "%s_physics" % obj_name.lower()
+
+    if has_shape_catalog():
+      # Only shapes that pass check_part are sampled from the catalog
+      id2 = random.choice(catalog_shape_ids(list_name, split, 'physics'))
     else:
-      obj = random.choice(objs)
-      id2 = obj['anno_id']
+      category_path = "./data/%s.json" % list_name
+      f = open(category_path)
+      objs = json.load(f)
+      if split == "val": objs = objs[:int (len(objs) * 0.14286) - 1]
+      if split == "test": objs = objs[int (len(objs) * 0.14286) - 1: int (len(objs) * 0.28571) - 1]
+      if split == "train": objs = objs[int (len(objs) * 0.28571) - 1:]
+      if obj_name in ['Chair', 'Table', 'Bed', 'Cart']:
+        id2 = random.choice(objs)
+      else:
+        obj = random.choice(objs)
+        id2 = obj['anno_id']
  
     if obj_name == 'Cart' or p_type == "physics":
       cur_shape_dir = "%s/%s"%(args.mobility_dir, id2)
       cur_part_dir = os.path.join(cur_shape_dir, 'textured_objs')
+      catalog_entry = catalog_shape('mobility', id2)
     else:
       cur_shape_dir = "%s/%s"%(args.data_dir, id2)
       cur_part_dir = os.path.join(cur_shape_dir, 'objs')
+      catalog_entry = catalog_shape('partnet', id2)
 
-    leaf_part_ids = [item.split('.')[0] for item in os.listdir(cur_part_dir) if item.endswith('.obj')]
+    if catalog_entry is not None:
+      leaf_part_ids = catalog_entry['leaf_part_ids']
+    else:
+      leaf_part_ids = [item.split('.')[0] for item in os.listdir(cur_part_dir) if item.endswith('.obj')]
     cur_render_dir = args.tmp_dir
 
-    root_v_list = []; root_f_list = []; tot_v_num = 0;
-    for idx in leaf_part_ids:
-        v, f = load_obj(os.path.join(cur_part_dir, str(idx)+'.obj'))
-        mesh = dict();
-        mesh['v'] = v; mesh['f'] = f;
-        root_v_list.append(v);
-        root_f_list.append(f+tot_v_num);
-        tot_v_num += v.shape[0];
-
-    root_v = np.vstack(root_v_list)
-    root_f = np.vstack(root_f_list)
-
-    scale = np.sqrt(np.max(np.sum(root_v**2, axis=1)))
-    scale /= scales[obj_name]
-    root_v /= scale
-    # center = np.min(root_v, axis=0) 
-    # root_v -= center
-
-    try:
-      cur_result_json = os.path.join(cur_shape_dir, 'result_after_merging.json')
-      with open(cur_result_json, 'r') as fin:
-          tree_hier = json.load(fin)[0]
-    except:
-      cur_result_json = os.path.join(cur_shape_dir, 'result.json')
-      with open(cur_result_json, 'r') as fin:
-          tree_hier = json.load(fin)[0]
-      
+    # A shape annotated before only needs its rotation applied, and one that
+    # failed check_part is skipped before loading its meshes. Only shapes
+    # passing check_part are written to the shape library; their meshes are
+    # still loaded for the URDF model.
+    shape_key = annotation_key('physics', obj_name, cur_part_dir)
+    library = shape_library_entry(shape_key, scales[obj_name])
+    if library is not None:
+      leaf_part_ids = library['leaf_part_ids']
+      cached = {'annotation': library['annotation'], 'keep': True}
+    else:
+      cached = cached_annotation(shape_key)
+    if cached is not None and not cached['keep']:
+      print ("shape %s failed check_part before" % id2)
+      i -= 1
+      continue
+
+    scale, meshes = load_part_meshes(cur_part_dir, leaf_part_ids, scales[obj_name])
+
     obj_name2 = obj_name + str(i)
     color_dict = dict()
 
@@ -741,21 +839,35 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
 
     os.mkdir(os.path.join("%s_urdf", obj_name2)%args.tmp_dir) 
 
-    part_dict = dict()
-    count_dict = dict()
-    objs_dict = dict()
-    line_dict = dict()
-    plane_dict = dict()
-    final_objs = []
+    if cached is None:
+      if catalog_entry is not None:
+        tree_hier = catalog_entry['hierarchy']
+      else:
+        try:
+          cur_result_json = os.path.join(cur_shape_dir, 'result_after_merging.json')
+          with open(cur_result_json, 'r') as fin:
+              tree_hier = json.load(fin)[0]
+        except:
+          cur_result_json = os.path.join(cur_shape_dir, 'result.json')
+          with open(cur_result_json, 'r') as fin:
+              tree_hier = json.load(fin)[0]
+      annotation = annotate_parts_physics(meshes, tree_hier, obj_name2, part_list, geo_list1, geo_list2)
+    else:
+      annotation = cached['annotation']
 
-    _, _, part_color, part_count, part_objs, all_objects, line_geo, plane_geo = add_one_part_physics(scale, tree_hier, cur_part_dir, cur_render_dir, obj_name2, part_list, geo_list1, geo_list2, args.tmp_dir, part_dict, count_dict, objs_dict, final_objs, line_dict, plane_dict)    
+    set_mesh_builder(mesh_builder_for(library, args.import_parts))
+    part_color, part_count, part_objs, all_objects, line_geo, plane_geo = add_one_part_physics(meshes, annotation, obj_name2, args.tmp_dir)
 
     line_geo_final, plane_geo_final, part_color_all, part_color_final, part_count_final,  geometry, final_objects = revise_annotations(line_geo, plane_geo, part_color, part_count, all_objects, obj_name, part_list2, count_list, theta) 
 
     keep = check_part(obj_name, part_count_final, part_color_final)
+    if cached is None:
+      cache_annotation(shape_key, annotation, keep)
 
     if not keep:
       i -= 1
+      if not args.import_parts or library is not None:
+        delete_parts(obj_name2)
       cmd = 'rm -rf %s'%args.tmp_dir
       call(cmd, shell=True)
       continue
@@ -773,21 +885,12 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
     for obj_file in leaf_part_ids:
       if not obj_file in rendered_objs:
         part_objs['other'].append(obj_file)
-        cur_v_list = []; cur_f_list = []; cur_v_num = 0; 
-        v, f = load_obj(os.path.join(cur_part_dir, obj_file+'.obj'))
-        # v -= center
-        v /= scale
-        cur_v_list.append(v)
-        cur_f_list.append(f+cur_v_num)
-        cur_v_num += v.shape[0]
-
-        part_v = np.vstack(cur_v_list)
-        part_f = np.vstack(cur_f_list)
+        part_v, part_f = meshes[obj_file]
 
         final_objects.append('other')
         add_mesh2 (obj_name2, 'other', part_v, part_f, args.tmp_dir, color=rgba)
 
-    loc, ori, norm, valid = add_object2(obj_name2, (x, y), rot, normals, args.tmp_dir, theta=theta, mode=mode)
+    loc, ori, norm, valid, masks, support_masks = add_object2(obj_name2, (x, y), rot, normals, args.tmp_dir, theta=theta, mode=mode)
     final_location = loc
     final_orientation = ori
 
@@ -850,23 +953,17 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
     part_color_occluded = part_color_final.copy()
     part_count_occluded = part_count_final.copy()
 
-    ims = os.listdir(args.tmp_dir)
-    images = [image for image in ims if (image.endswith(".png") and not image == "Image0001.png")]
-    images.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
-
+    # masks[idx] is the mask of the part added as final_objects[idx]
     obj_img = np.zeros((args.height, args.width))
 
-    assert len(images) == len(final_objects)
+    assert len(masks) == len(final_objects)
 
     keep = True
 
     part_masks = dict()
 
-    for (idx, image) in enumerate(images):
+    for (idx, img) in enumerate(masks):
       part = final_objects[idx]
-      img = Image.open('%s/'%args.tmp_dir + image).convert('L')
-
-      img = np.asarray(img)
       obj_img += img
       if len(np.where(img > 0)[0]) == 0:
 
@@ -890,7 +987,7 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
     if keep:
       obj_img = np.clip(obj_img, 0, 1).astype('uint8')
       try:
-        if np.min(np.where(obj_img > 0)[1]) == 0 or np.max(np.where(obj_img > 0)[1]) == 799 or np.max(np.where(obj_img > 0)[0]) == 599:
+        if np.min(np.where(obj_img > 0)[1]) == 0 or np.max(np.where(obj_img > 0)[1]) == args.width - 1 or np.max(np.where(obj_img > 0)[0]) == args.height - 1:
           print ("out of boundary")
           keep = False
       except:
@@ -905,13 +1002,11 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
 
       for (im, prev_mask) in enumerate(obj_masks):
         if mode == "support" and im == len(obj_masks) - 1: continue
-        overlapping_area = prev_mask & obj_img
-        img = Image.fromarray(overlapping_area*255, 'L')
         # prev1 = len(np.where(prev_mask > 0)[0])
         # print (prev1)
         # obj1 = len(np.where(obj_img > 0)[0])
         # print (obj1)
-        ov = len(np.where(overlapping_area > 0)[0])
+        ov = rle_masks.overlap(prev_mask, obj_mask)
         # print (mask1 - mask2)
 
         if ov > 5:
@@ -946,17 +1041,10 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
       part_count_occluded2 = objects[-1]["part_count"]
       final_objects = normals[-1][1]
 
-      ims = os.listdir('%s_normal'%args.tmp_dir)
-      images = [image for image in ims if (image.endswith(".png") and not image == "Image0001.png")]
-      images.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
-
-      assert len(final_objects) == len(images)
+      assert len(final_objects) == len(support_masks)
 
-      for (idx, image) in enumerate(images):
+      for (idx, img) in enumerate(support_masks):
         part = final_objects[idx]
-        img = Image.open('%s_normal/'%args.tmp_dir + image).convert('L')
-
-        img = np.asarray(img)
         obj_img += img
         if len(np.where(img > 0)[0]) == 0:
           print ("occluded part: %s" %part)
@@ -984,11 +1072,14 @@ def add_random_objects(scene_struct, num_objects, args, camera, split):
       objects[-1]["part_color_occluded"] = part_color_occluded2
       objects[-1]["part_count_occluded"] = part_count_occluded2
       
-    obj_masks.append(obj_img)
+    # Run-length encoded, only kept for the overlap tests
+    obj_masks.append(rle_masks.encode(obj_img > 0))
     obj_names.append(obj_name)
     obj = bpy.context.object
     blender_objects.append(obj)
     positions.append((x, y, r))
+    if floor_mode:
+      footprints.add(x, y, r)
 
     urdf_file = create_urdf_object(obj_name, obj_name2, args.tmp_dir, ori, cur_shape_dir, p_type, id2)
 
@@ -1,4 +1,5 @@
-import sys, random, os
+import sys, random, os, time
+import contextlib
 import bpy, bpy_extras
 
 # """
@@ -7,26 +8,18 @@ import bpy, bpy_extras
 import numpy as np
 import math
 from mathutils import Matrix
+try:
+  from add_parts import get_list, rename_part, check_part, index_masks
+  import rle_masks
+except ImportError:
+  from image_generation.add_parts import get_list, rename_part, check_part, index_masks
+  import image_generation.rle_masks as rle_masks
 
 def binary_mask_to_rle(binary_mask):
-    rle = {'counts': [], 'size': list(binary_mask.shape)}
-    counts = rle.get('counts')
-
-    last_elem = 0
-    running_length = 0
-
-    for i, elem in enumerate(binary_mask.ravel(order='F')):
-        if elem == last_elem:
-            pass
-        else:
-            counts.append(running_length)
-            running_length = 0
-            last_elem = elem
-        running_length += 1
-
-    counts.append(running_length)
-
-    return rle
+  """
+  Uncompressed COCO run-length encoding of a mask, see rle_masks.encode.
+  """
+  return rle_masks.encode(binary_mask)
     
 def create_sub_mask_annotation(sub_mask):
     # Find contours (boundary lines) around each sub-mask
@@ -129,6 +122,311 @@ def set_layer(obj, layer_idx):
   for i in range(len(obj.layers)):
     obj.layers[i] = (i == layer_idx)
 
+def part_material(color):
+  """
+  Material of a part of the given color, as the .obj importer makes it from
+  the Kd line of the part's .mtl file.
+  """
+  mat = bpy.data.materials.new('m1')
+  mat.diffuse_color = color[:3]
+  mat.diffuse_intensity = 1.0
+  return mat
+
+def add_part_mesh(name, v, f, color):
+  """
+  Builds a part in the scene from its vertices v and 1-based triangles f, as
+  importing it from an .obj file with a single Kd color would: the object is
+  named name (Blender makes it unique), keeps the .obj coordinates and is
+  rotated from the .obj axes (Y up) to Blender's (Z up).
+  """
+  v = np.ascontiguousarray(v, dtype=np.float32)
+  f = np.ascontiguousarray(f - 1, dtype=np.int32)
+
+  mesh = bpy.data.meshes.new(name)
+  mesh.vertices.add(v.shape[0])
+  mesh.vertices.foreach_set('co', v.ravel())
+  mesh.loops.add(f.size)
+  mesh.loops.foreach_set('vertex_index', f.ravel())
+  mesh.polygons.add(f.shape[0])
+  mesh.polygons.foreach_set('loop_start', np.arange(0, f.size, 3, dtype=np.int32))
+  mesh.polygons.foreach_set('loop_total', np.full(f.shape[0], 3, dtype=np.int32))
+  mesh.update(calc_edges=True)
+  mesh.validate()
+
+  mesh.materials.append(part_material(color))
+
+  obj = bpy.data.objects.new(name, mesh)
+  obj.rotation_euler = (math.pi / 2, 0, 0)
+  bpy.context.scene.objects.link(obj)
+  return obj
+
+class ShapeLibrary(object):
+  """
+  Mesh builder (see add_parts.set_mesh_builder) that appends the parts of a
+  shape from the .blend library written by part_utils/build_shape_library.py
+  instead of building them from their meshes. The library is loaded with a
+  single bpy.data.libraries.load; each call then takes the next part, names
+  it as add_part_mesh would and swaps its placeholder material for one of
+  the part color.
+  """
+  def __init__(self, path):
+    with bpy.data.libraries.load(path) as (data_from, data_to):
+      data_to.objects = sorted(data_from.objects)
+    self.objects = list(reversed(data_to.objects))
+
+  def __call__(self, name, v, f, color):
+    obj = self.objects.pop()
+    obj.name = name
+    obj.data.materials[0] = part_material(color)
+    bpy.context.scene.objects.link(obj)
+    return obj
+
+def mesh_builder_for(library, import_parts=0):
+  """
+  Mesh builder adding the parts of a shape: from its library when library
+  (see add_parts.shape_library_entry) is not None, otherwise add_part_mesh,
+  or None to import them from .obj files when import_parts is set.
+  """
+  if library is not None:
+    return ShapeLibrary(library['blend'])
+  if import_parts:
+    return None
+  return add_part_mesh
+
+def delete_parts(name):
+  """
+  Removes the parts of name built by add_part_mesh, for an object that is
+  given up on before add_object or add_object2 places it.
+  """
+  for obj in list(bpy.data.objects):
+    if name in obj.name:
+      bpy.data.objects.remove(obj, do_unlink=True)
+
+# Cycles settings of the mask renders of add_object and add_object2; the
+# IndexOB pass the masks are decoded from is written by the first sample of
+# the camera rays, so samples and bounces only cost time there
+MASK_RENDER_SETTINGS = {
+  'progressive': 'PATH',
+  'samples': 1,
+  'use_square_samples': False,
+  'min_bounces': 0,
+  'max_bounces': 0,
+  'diffuse_bounces': 0,
+  'glossy_bounces': 0,
+  'transmission_bounces': 0,
+  'volume_bounces': 0,
+  'transparent_min_bounces': 0,
+  'transparent_max_bounces': 0,
+  'blur_glossy': 0.0,
+}
+
+use_mask_render_profile = True
+
+# Pixels kept around the projected bounding box of the objects whose masks
+# are rendered, see mask_render_box
+MASK_RENDER_MARGIN = 4
+
+use_mask_render_border = True
+
+# Placement attempts, mask renders, the time spent in them and the pixels
+# they rendered out of those of the full frames
+mask_render_stats = {'attempts': 0, 'renders': 0, 'time': 0.0, 'pixels': 0, 'frame_pixels': 0}
+
+def set_mask_render_profile(enabled):
+  """
+  Makes the mask renders use the scene's own render settings when enabled
+  is false, e.g. to compare their timing.
+  """
+  global use_mask_render_profile
+  use_mask_render_profile = enabled
+
+# Renders and their time, for mask renders and for final images; see
+# enable_render_timer. Blender gives no hook at the end of scene sync (the
+# render_stats handlers of 2.7x get None), so the cost of sync and BVH
+# builds is measured by comparing runs with and without
+# --persistent_render_data, see part_utils/benchmark_mask_render.py
+render_time_stats = {kind: {'renders': 0, 'time': 0.0} for kind in ['mask', 'final']}
+
+current_render = {'kind': 'final', 'start': None}
+
+@bpy.app.handlers.persistent
+def render_timer_pre(scene):
+  current_render['start'] = time.time()
+
+@bpy.app.handlers.persistent
+def render_timer_post(scene):
+  if current_render['start'] is None:
+    return
+  entry = render_time_stats[current_render['kind']]
+  entry['renders'] += 1
+  entry['time'] += time.time() - current_render['start']
+  current_render['start'] = None
+
+def enable_render_timer():
+  """
+  Registers the render handlers filling render_time_stats; they are
+  persistent, so they survive loading the base scene of every image.
+  """
+  handlers = bpy.app.handlers
+  for handler_list, handler in [(handlers.render_pre, render_timer_pre),
+                                (handlers.render_post, render_timer_post)]:
+    if handler not in handler_list:
+      handler_list.append(handler)
+
+def render_time_report(since=None):
+  """
+  One line per kind of render on their number and time, counting from a
+  copy.deepcopy of render_time_stats when since is given.
+  """
+  lines = []
+  for kind, name in [('mask', 'mask renders'), ('final', 'final renders')]:
+    entry = dict(render_time_stats[kind])
+    if since is not None:
+      for key in entry:
+        entry[key] -= since[kind][key]
+    lines.append("%s: %d in %.1fs (%.2fs per render)"
+                 % (name, entry['renders'], entry['time'], entry['time'] / max(entry['renders'], 1)))
+  return '\n'.join(lines)
+
+def set_persistent_render_data(scene, enabled):
+  """
+  Makes Cycles keep the synchronized scene between the renders of an image
+  when enabled, i.e. between the mask renders of the placement attempts and
+  the final render. All of them then use the two-level (dynamic) BVH, so the
+  BVH of every mesh that did not change is kept and only the top level is
+  built again; the scene parameters, and with them the BVH type, must not
+  differ between the renders, or Cycles builds everything again.
+  """
+  scene.render.use_persistent_data = bool(enabled)
+  if enabled:
+    scene.cycles.debug_bvh_type = 'DYNAMIC_BVH'
+
+def set_mask_render_border(enabled):
+  """
+  Makes the mask renders cover the full frame when enabled is false.
+  """
+  global use_mask_render_border
+  use_mask_render_border = enabled
+
+def frame_shape():
+  render = bpy.context.scene.render
+  scale = render.resolution_percentage / 100
+  return int(render.resolution_y * scale), int(render.resolution_x * scale)
+
+def mask_render_box(objects):
+  """
+  Pixel box (row0, row1, col0, col1), rows from the top and ends excluded,
+  of the camera image containing the given objects: the projection of the
+  corners of their bounding boxes through get_3x4_P_matrix_from_blender,
+  with MASK_RENDER_MARGIN pixels around it and clipped to the frame. None
+  when the full frame has to be rendered: the border is disabled, a corner
+  is behind the camera or the box misses the frame.
+  """
+  if not use_mask_render_border or not objects:
+    return None
+  scene = bpy.context.scene
+  scene.update()
+  height, width = frame_shape()
+  P = np.array(get_3x4_P_matrix_from_blender(scene.camera)[0])
+  points = []
+  for obj in objects:
+    corners = np.array([corner[:] for corner in obj.bound_box])
+    corners = np.hstack([corners, np.ones((len(corners), 1))])
+    points.append(corners.dot(np.array(obj.matrix_world).T))
+  proj = np.vstack(points).dot(P.T)
+  if np.any(proj[:, 2] <= 0):
+    return None
+  u = proj[:, 0] / proj[:, 2]
+  v = proj[:, 1] / proj[:, 2]
+  row0 = max(int(np.floor(v.min())) - MASK_RENDER_MARGIN, 0)
+  row1 = min(int(np.ceil(v.max())) + MASK_RENDER_MARGIN, height)
+  col0 = max(int(np.floor(u.min())) - MASK_RENDER_MARGIN, 0)
+  col1 = min(int(np.ceil(u.max())) + MASK_RENDER_MARGIN, width)
+  if row0 >= row1 or col0 >= col1:
+    return None
+  return row0, row1, col0, col1
+
+@contextlib.contextmanager
+def mask_render_profile(box=None):
+  """
+  Renders inside the block are mask renders: they use MASK_RENDER_SETTINGS,
+  no lamps and no world, and only cover box (see mask_render_box) when it
+  is given. The scene settings are restored afterwards for the final image.
+  Their time and pixels add up in mask_render_stats.
+  """
+  scene = bpy.context.scene
+  render = scene.render
+  saved = {name: getattr(scene.cycles, name) for name in MASK_RENDER_SETTINGS}
+  saved_border = (render.use_border, render.use_crop_to_border, render.border_min_x,
+                  render.border_max_x, render.border_min_y, render.border_max_y)
+  world = scene.world
+  lamps = [obj for obj in scene.objects if obj.type == 'LAMP' and not obj.hide_render]
+  height, width = frame_shape()
+  tic = time.time()
+  current_render['kind'] = 'mask'
+  try:
+    if use_mask_render_profile:
+      for name, value in MASK_RENDER_SETTINGS.items():
+        setattr(scene.cycles, name, value)
+      scene.world = None
+      for obj in lamps:
+        obj.hide_render = True
+    if box is not None:
+      # Blender truncates the border to whole pixels, and counts rows from
+      # the bottom; a quarter pixel keeps the truncation on the box
+      row0, row1, col0, col1 = box
+      render.use_border = True
+      render.use_crop_to_border = True
+      render.border_min_x = (col0 + 0.25) / width
+      render.border_max_x = min((col1 + 0.25) / width, 1.0)
+      render.border_min_y = (height - row1 + 0.25) / height
+      render.border_max_y = min((height - row0 + 0.25) / height, 1.0)
+    yield
+  finally:
+    for name, value in saved.items():
+      setattr(scene.cycles, name, value)
+    (render.use_border, render.use_crop_to_border, render.border_min_x,
+     render.border_max_x, render.border_min_y, render.border_max_y) = saved_border
+    scene.world = world
+    for obj in lamps:
+      obj.hide_render = False
+    current_render['kind'] = 'final'
+    mask_render_stats['renders'] += 1
+    mask_render_stats['time'] += time.time() - tic
+    if box is not None:
+      mask_render_stats['pixels'] += (box[1] - box[0]) * (box[3] - box[2])
+    else:
+      mask_render_stats['pixels'] += height * width
+    mask_render_stats['frame_pixels'] += height * width
+
+def render_masks(index_path, indices, objects):
+  """
+  Renders the IndexOB pass to index_path (see add_index_output) with the
+  mask render profile, only around objects, and returns the full frame
+  masks of the given pass indices.
+  """
+  box = mask_render_box(objects)
+  with mask_render_profile(box):
+    bpy.ops.render.render()
+  return index_masks(index_path, indices, box, frame_shape())
+
+def add_index_output(base_path):
+  """
+  Makes the next render write its IndexOB pass to a single uncompressed EXR
+  file in base_path, and returns the path of that file; see
+  add_parts.index_masks to decode it.
+  """
+  tree = bpy.context.scene.node_tree
+  output_node = tree.nodes.new('CompositorNodeOutputFile')
+  output_node.base_path = base_path
+  output_node.format.file_format = 'OPEN_EXR'
+  output_node.format.color_mode = 'BW'
+  output_node.format.color_depth = '32'
+  output_node.format.exr_codec = 'NONE'
+  output_node.file_slots[0].path = 'index'
+  tree.links.new(tree.nodes['Render Layers'].outputs['IndexOB'], output_node.inputs[0])
+  return os.path.join(base_path, 'index%04d.exr' % bpy.context.scene.frame_current)
+
 def add_object(name, loc, cur_render_dir, theta=0):
   """
   Load an object from a file. We assume that in the directory object_dir, there
@@ -138,14 +436,18 @@ def add_object(name, loc, cur_render_dir, theta=0):
   - scale: scalar giving the size that the object should be in the scene
   - loc: tuple (x, y) giving the coordinates on the ground plane where the
     object should be placed.
+
+  Also returns the masks of its parts, in the order they were added.
   """
-  files = []
-  with bpy.data.libraries.load("%s/"%cur_render_dir+name+".blend") as (data_from, data_to):
-    for n in data_from.objects:
-      if name in n:
-        files.append({'name': n})
+  # Parts built by add_part_mesh are already in the scene
+  if os.path.exists("%s/"%cur_render_dir+name+".blend"):
+    files = []
+    with bpy.data.libraries.load("%s/"%cur_render_dir+name+".blend") as (data_from, data_to):
+      for n in data_from.objects:
+        if name in n:
+          files.append({'name': n})
 
-  bpy.ops.wm.append(directory="%s/"%cur_render_dir+name+".blend"+"/Object/", files = files)
+    bpy.ops.wm.append(directory="%s/"%cur_render_dir+name+".blend"+"/Object/", files = files)
 
   # Set the new object as active, then rotate, and translate it
   x, y = loc
@@ -168,9 +470,7 @@ def add_object(name, loc, cur_render_dir, theta=0):
   render = tree.nodes['Render Layers']
   links = tree.links
 
-  output_node = bpy.context.scene.node_tree.nodes.new('CompositorNodeOutputFile')
-  output_node.base_path = cur_render_dir
-  # link = links.new(render.outputs["Image"], output_node.inputs[0])
+  index_path = add_index_output(cur_render_dir)
 
   i = 0
 
@@ -194,17 +494,13 @@ def add_object(name, loc, cur_render_dir, theta=0):
       # mx.translation.z -= minz
       i += 1
       obj.pass_index = i
-      mask_node = bpy.context.scene.node_tree.nodes.new('CompositorNodeIDMask')
-      mask_node.index = i
-      link = links.new(render.outputs["IndexOB"], mask_node.inputs["ID value"])
-      output_node.layer_slots.new(str(i))
-      link = links.new(mask_node.outputs[0], output_node.inputs[i])
       obs.append(obj)
       ctx['active_object'] = obj
     else:
       obj.hide_render = True
   
-  bpy.ops.render.render()
+  mask_render_stats['attempts'] += 1
+  masks = render_masks(index_path, range(1, i + 1), obs)
       
   # bpy.context.area.type = prev
   for node in bpy.context.scene.node_tree.nodes:
@@ -230,7 +526,7 @@ def add_object(name, loc, cur_render_dir, theta=0):
 
   bpy.context.scene.objects.active = bpy.data.objects[name]
   
-  return location, rotation
+  return location, rotation, masks
 
 def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
   rot0 = np.array([  [1.0000000,  0.0000000,  0.0000000],
@@ -261,6 +557,9 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
   - scale: scalar giving the size that the object should be in the scene
   - loc: tuple (x, y) giving the coordinates on the ground plane where the
     object should be placed.
+
+  Also returns the masks of its parts, in the order they were added, and in
+  support mode those of the parts of the supporting object.
   """
   import math
   def rotation_matrix_from_vectors(vec1, vec2):
@@ -321,13 +620,15 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
   rot3 = Rz(theta)
 
 
-  files = []
-  with bpy.data.libraries.load("%s/"%tmp_dir+name+".blend") as (data_from, data_to):
-    for n in data_from.objects:
-      if name in n:
-        files.append({'name': n})
+  # Parts built by add_part_mesh are already in the scene
+  if os.path.exists("%s/"%tmp_dir+name+".blend"):
+    files = []
+    with bpy.data.libraries.load("%s/"%tmp_dir+name+".blend") as (data_from, data_to):
+      for n in data_from.objects:
+        if name in n:
+          files.append({'name': n})
 
-  bpy.ops.wm.append(directory="%s/"%tmp_dir+name+".blend"+"/Object/", files = files)
+    bpy.ops.wm.append(directory="%s/"%tmp_dir+name+".blend"+"/Object/", files = files)
 
   # Set the new object as active, then rotate, and translate it
   x, y = loc
@@ -350,10 +651,7 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
   render = tree.nodes['Render Layers']
   links = tree.links
 
-  output_node = bpy.context.scene.node_tree.nodes.new('CompositorNodeOutputFile')
-  output_node.base_path = tmp_dir
-
-  # link = links.new(render.outputs["Image"], output_node.inputs[0])
+  index_path = add_index_output(tmp_dir)
 
   minz = 100000.0
   first_min = []
@@ -526,18 +824,15 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
       # mx.translation.z -= minz
       i += 1
       obj.pass_index = i
-      mask_node = bpy.context.scene.node_tree.nodes.new('CompositorNodeIDMask')
-      mask_node.index = i
-      link = links.new(render.outputs["IndexOB"], mask_node.inputs["ID value"])
-      output_node.layer_slots.new(str(i))
-      link = links.new(mask_node.outputs[0], output_node.inputs[i])
       obs.append(obj)
       ctx['active_object'] = obj
     else:
       if len(normals) and not normals[-1][0] in obj.name:
         obj.hide_render = True
 
-  bpy.ops.render.render()
+  mask_render_stats['attempts'] += 1
+  masks = render_masks(index_path, range(1, i + 1), obs)
+  support_masks = None
       
   # bpy.context.area.type = prev
   for node in bpy.context.scene.node_tree.nodes:
@@ -551,8 +846,7 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
   if mode == "support":
     obs2 = []
     os.mkdir("%s_normal"%tmp_dir)
-    output_node2 = bpy.context.scene.node_tree.nodes.new('CompositorNodeOutputFile')
-    output_node2.base_path = "%s_normal"%tmp_dir
+    index_path2 = add_index_output("%s_normal"%tmp_dir)
 
     k = 0
     for obj in bpy.data.objects:      
@@ -562,17 +856,12 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
         k += 1
         i += 1
         obj.pass_index = i
-        mask_node = bpy.context.scene.node_tree.nodes.new('CompositorNodeIDMask')
-        mask_node.index = i
-        link = links.new(render.outputs["IndexOB"], mask_node.inputs["ID value"])
-        output_node2.layer_slots.new(str(k))
-        link = links.new(mask_node.outputs[0], output_node2.inputs[k])
         obs2.append(obj)
       else:
         if not name in obj.name:
           obj.hide_render = True
 
-    bpy.ops.render.render()
+    support_masks = render_masks(index_path2, range(i - k + 1, i + 1), obs2)
 
     for node in bpy.context.scene.node_tree.nodes:
       if node.name == "Render Layers": continue
@@ -629,7 +918,7 @@ def add_object2(name, loc, rot1, normals, tmp_dir, theta=0.0, mode="ground"):
   if not mode == "normal":
     bpy.context.scene.objects.active = bpy.data.objects[name]
   
-  return location, rotation, normal, valid
+  return location, rotation, normal, valid, masks, support_masks
 
 def Rx(theta):
   return np.matrix([[ 1, 0           , 0           ],
@@ -695,28 +984,6 @@ def revise_annotations(line_geo, plane_geo, part_color, part_count, all_objects,
 
     return line_geo_final, plane_geo_final, part_color_all, part_color_final, part_count_final, geometry, final_objects
 
-def check_part(obj_name, part_count_final, part_color_final):
-    keep = True
-    if "wheel" in part_count_final.keys() and obj_name in ['Chair', 'Table']:
-      if "leg" in part_count_final.keys():
-        part_count_final["wheel"] = part_count_final["leg"]
-      else:
-        print ("wheel not paired with leg")
-        keep = False
-        
-    if obj_name == 'Chair' and not ('leg' in part_color_final.keys() or 'central_support' in part_color_final.keys() or 'pedestal' in part_color_final.keys()):
-      print ("lack base of chair")
-      keep = False
-
-    if obj_name == 'Refrigerator' and not 'door' in part_color_final.keys():
-      print ("lack door of fridge")
-      keep = False
-
-    if obj_name == 'Chair' and ('arm' in part_color_final.keys() and ('arm vertical bar' in part_color_final.keys() or 'arm horizontal bar' in part_color_final.keys())):
-      print ("duplicate arm entry")
-      keep = False
-    return keep
-
 def check_g(g):
   geometry = True
   stand = g[0]
@@ -835,69 +1102,6 @@ def create_urdf_object(obj_name, obj_name2, tmp_dir, ori, cur_shape_dir, p_type,
     return urdf_file
 
 
-def get_list(obj_name):
-    if obj_name == 'Chair':
-      part_list = ['chair_head', 'chair_back', 'chair_seat', 'leg', 'footrest', 'central_support', 'pedestal', 'leg bar', 'foot', 'mechanical_control', 'caster', 'connector', 'chair_arm', 'arm_near_vertical_bar', 'arm_horizontal_bar']
-      part_list2 = ['arm', 'leg', 'back', 'seat', 'central support', 'pedestal', 'leg bar', 'wheel', 'arm vertical bar', 'arm horizontal bar']
-      count_list = ['arm', 'leg', 'leg bar', 'wheel', 'arm vertical bar', 'arm horizontal bar', 'central support', 'seat', 'back']
-      geo_list1 = ['arm_near_vertical_bar', 'arm_horizontal_bar', 'leg', 'leg bar', 'central_support']
-      geo_list2 = ['chair_back', 'chair_seat', 'pedestal']
-
-    if obj_name == 'Refrigerator':
-      part_list = ['door_frame', 'frame', 'body_interior', 'base', 'handle']
-      part_list2 = ['door', 'body']
-      count_list = ['door']
-      geo_list1 = []
-      geo_list2 = ['door_frame']
-
-    if obj_name == 'Bed':
-      part_list = ['bed_sleep_area', 'headboard', 'surface_base', 'leg', 'bar_stretcher']
-      part_list2 = ['sleep area', 'back', 'leg']
-      count_list = ['leg', 'leg bar']
-      geo_list1 = ['leg', 'leg bar']
-      geo_list2 = ['headboard']
-
-    if obj_name == 'Table':
-      part_list = ['tabletop', 'leg', 'central_support', 'pedestal', 'foot',  'leg bar', 'cabinet_door_surface', 'handle',\
-        'shelf', 'drawer_box', 'keyboard_tray', 'foot', 'caster', 'frame']      
-      count_list = ['drawer', 'leg', 'door', 'leg bar', 'shelf', 'wheel', 'central support', 'top']
-      part_list2 = ['top', 'drawer', 'door', 'central support', 'leg', 'pedestal', 'shelf', 'leg bar', 'wheel']
-      geo_list1 = ['leg', 'central_support', 'leg bar']
-      geo_list2 = ['pedestal', 'cabinet_door_surface', 'drawer_box', 'tabletop', 'shelf']
-
-    if obj_name == 'Cart':
-      part_list = ['base_body', 'handle', 'wheel']
-      part_list2 = ['body', 'wheel']
-      count_list = ['wheel']
-      geo_list1 = []
-      geo_list2 = []
-
-    return part_list, part_list2, count_list, geo_list1, geo_list2
-
-
-def rename_part(part, obj_name):
-  if part in ['bar_stretcher', 'circular_stretcher', 'runner', 'rocker']:
-    part = 'leg bar'
-  if part in ['back_panel', 'vertical_side_panel', 'bottom_panel', 'vertical_divider_panel', 'vertical_front_panel']:
-    part = 'frame'
-  if part in ['drawer_box']: part = 'drawer'
-  if part in ['cabinet_door_surface']: part = 'door'
-  if part in ['back_surface']: part='chair_back'
-  if part in ['door_frame']: part = 'door'
-  if part in ['headboard']: part = 'back'
-  if part in ['bed_post']: part = 'leg'
-  if part in ['surface_base']: part = 'base'
-  if part in ['base_body']: part = 'body'
-  if part in ['frame'] and 'Refrigerator' in obj_name: part = 'body'
-  if part in ['caster']: part = 'wheel'
-  if part in ['arm_near_vertical_bar']: part = 'arm vertical bar'
-  if part in ['back_frame_vertical_bar']: part = 'back vertical bar'
-  if part in ['back_frame_horizontal_bar']: part = 'back horizontal bar'
-  part = part.replace("chair_", "").replace("table", "").replace("bed", "").replace("_", " ").replace("bed", "")
-  part = part.strip()
-
-  return part
-
 def get_calibration_matrix_K_from_blender(camd):
     f_in_mm = camd.lens
     scene = bpy.context.scene
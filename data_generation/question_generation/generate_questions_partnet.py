@@ -59,6 +59,9 @@ parser.add_argument('--time_dfs', action='store_true',
                     help="Time each depth-first search; must be given with --verbose")
 parser.add_argument('--profile', action='store_true',
                     help="If given then run inside cProfile")
+parser.add_argument('--goal_directed', action='store_true',
+                    help="Prune DFS branches that can only produce answers the answer " +
+                         "balancing would reject, instead of building and discarding them")
 # args = parser.parse_args()
 
 
@@ -253,11 +256,106 @@ def other_heuristic(text, param_vals):
   return text
 
 
+def find_deficit_answers(answer_counts):
+  """
+  Answers that would currently pass the rejection sampling heuristics at the
+  end of instantiate_templates_dfs; a finished question is only kept if its
+  answer is one of these.
+  """
+  answer_counts_sorted = sorted(answer_counts.values())
+  median_count = answer_counts_sorted[len(answer_counts_sorted) // 2]
+  median_count = max(median_count, 5)
+
+  deficit = set()
+  for answer, count in answer_counts.items():
+    if count > 1.1 * answer_counts_sorted[-2]: continue
+    if count > 1.5 * median_count: continue
+    deficit.add(answer)
+  return deficit
+
+
+def reachable_answers(node_type, value, scene_struct):
+  """
+  Over-approximates the answers a final template node of type node_type can
+  produce when it is fed value, the output of the node before it. Returns
+  None if nothing useful can be said about the node.
+  """
+  if isinstance(value, list):
+    if node_type == 'count':
+      return {len(value)} if len(value) < 10 else set()
+    if node_type == 'exist':
+      return {len(value) > 0}
+    if node_type == 'filter_object_count':
+      return set(range(0, min(len(value), 9) + 1))
+    if node_type == 'filter_object_exist':
+      return {True, False} if len(value) else {False}
+    return None
+
+  if not isinstance(value, int) or isinstance(value, bool):
+    return None
+  obj = scene_struct['objects'][value]
+  if node_type == 'query_object-category':
+    if isinstance(obj['category'], list):
+      return set(obj['category'])
+    return {obj['category']}
+  if node_type == 'query_part-color':
+    return {v[0] for v in obj['part_color_occluded'].values()}
+  if node_type == 'query_part-count':
+    return {v for v in obj['part_count_occluded'].values() if v < 10}
+  if node_type == 'query_part-category':
+    return set(obj['part_color_occluded'].keys())
+  return None
+
+
+def option_reachable_answers(template, state, next_node, option, objs, scene_struct):
+  """
+  Answers still reachable after expanding the special node next_node with the
+  filter option whose matching objects are objs, or None if unknown.
+  """
+  num_nodes = len(template['nodes'])
+  node_type = next_node['type']
+
+  if state['next_template_node'] == num_nodes - 1 and node_type in (
+      'filter_object_count', 'filter_object_exist', 'relate_filter_count', 'relate_filter_exist'):
+    # Filters whose parameter is not in the text are dropped when the option
+    # is expanded, so objs is only the final object set if none was dropped
+    side_inputs = next_node['side_inputs']
+    if node_type.startswith('relate'):
+      side_inputs = side_inputs[1:]
+      option = option[1]
+    for param_name, param_val in zip(side_inputs, json.loads(option)):
+      if param_val is not None and param_name not in template['text'][0]:
+        return None
+    if node_type.endswith('count'):
+      return {len(objs)} if len(objs) < 10 else set()
+    return {len(objs) > 0}
+
+  final_node = template['nodes'][-1]
+  if (state['next_template_node'] == num_nodes - 2 and final_node['inputs'] == [num_nodes - 2]
+      and node_type in ('filter_object_unique', 'relate_filter_unique') and len(objs) == 1):
+    # Dropped filters can only grow the set, so the unique object is either
+    # objs[0] or the state becomes invalid
+    return reachable_answers(final_node['type'], objs[0], scene_struct)
+  return None
+
+
 def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
-                              synonyms, max_instances=None, verbose=False):
+                              synonyms, max_instances=None, verbose=False,
+                              goal_directed=False, dfs_stats=None):
   # print (template)
   param_name_to_type = {p['name']: p['type'] for p in template['params']}
 
+  # With goal_directed set, branches that can only end in answers the
+  # rejection sampling below would discard are pruned as early as possible
+  if dfs_stats is None:
+    dfs_stats = {}
+  for key in ['states', 'rejected', 'pruned_states', 'pruned_options']:
+    dfs_stats.setdefault(key, 0)
+  if goal_directed:
+    deficit = find_deficit_answers(answer_counts)
+  final_node = template['nodes'][-1]
+  final_input = len(template['nodes']) - 2
+
   initial_state = {
     'nodes': [node_shallow_copy(template['nodes'][0])],
     'vals': {},
@@ -274,6 +372,7 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
 
     # print (q)
     outputs = qeng.answer_question(q, metadata, scene_struct, all_outputs=True)
+    dfs_stats['states'] += 1
 
     answer = outputs[-1]
 
@@ -406,6 +505,13 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
     if skip_state:
       continue
 
+    if goal_directed and state['next_template_node'] == len(template['nodes']) - 1 \
+        and final_node['inputs'] == [final_input]:
+      reachable = reachable_answers(final_node['type'], answer, scene_struct)
+      if reachable is not None and not (reachable & deficit):
+        dfs_stats['pruned_states'] += 1
+        continue
+
     # We have already checked to make sure the answer is valid, so if we have
     # processed all the nodes in the template then the current state is a valid
     # question, so add it if it passes our rejection sampling tests.
@@ -422,9 +528,11 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
 
       if cur_answer_count > 1.1 * answer_counts_sorted[-2]:
         if verbose: print('skipping due to second count')
+        dfs_stats['rejected'] += 1
         continue
       if cur_answer_count > 1.5 * median_count:
         if verbose: print('skipping due to median')
+        dfs_stats['rejected'] += 1
         continue
 
       # If the template contains a raw relate node then we need to check for
@@ -439,6 +547,8 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
           continue
 
       answer_counts[answer] += 1
+      if goal_directed:
+        deficit = find_deficit_answers(answer_counts)
       state['answer'] = answer
       final_states.append(state)
       if max_instances is not None and len(final_states) == max_instances:
@@ -497,6 +607,17 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
       filter_option_keys = list(filter_options.keys())
       random.shuffle(filter_option_keys)
 
+      if goal_directed:
+        kept_keys = []
+        for k in filter_option_keys:
+          reachable = option_reachable_answers(template, state, next_node, k,
+                                               filter_options[k], scene_struct)
+          if reachable is not None and not (reachable & deficit):
+            dfs_stats['pruned_options'] += 1
+            continue
+          kept_keys.append(k)
+        filter_option_keys = kept_keys
+
       for k in filter_option_keys:
         try:
           k = json.loads(k)
@@ -724,67 +845,16 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
   # Actually instantiate the template with the solutions we've found
   text_questions, structured_questions, answers = [], [], []
 
-  category = ""
-  count = dict()
+  compiled_texts = template.get('_compiled_text')
+  if compiled_texts is None:
+    compiled_texts = [compile_template_text(t) for t in template['text']]
+    template['_compiled_text'] = compiled_texts
+
   for state in final_states:
     structured_questions.append(state['nodes'])
     answers.append(state['answer'])
-    text = random.choice(template['text'])
-
-    for name, val in state['vals'].items():
-      if isinstance(val, dict):
-        val = str(list(val.values())[0])
-      if isinstance(val, list) or isinstance(val, tuple):
-        val = val[0]
-      if isinstance(val, int):
-        val = str(val)
-      # print (name, val)
-
-      if 'S' in name:
-        if val == "":
-          val = "thing"
-          state['vals'][name] = val
-        p = name.replace('S', 'P')
-        try:
-          if state['vals'][p] == '': text = text.replace(name + " with", name).replace(name + "s with", name + 's')
-        except:
-          pass
-
-        category = val
-      if 'CT' in name and val != '': count[name] = int(val)
-
-      if val in synonyms:
-        val = random.choice(synonyms[val])
-
-      if 'P' in name:
-        if not val == '':
-          ct = name.replace('P', 'CT')
-          if ct in state['vals'].keys() and state['vals'][ct] != "" :
-            if int(state['vals'][ct][val]) > 1:
-              val += "s"
-              text = text.replace("is the %s"%name, "are the %s"%name)
-          else:
-            if not name + "s" in text:
-              if val in ["arm", "leg", "leg bar", "wheel", "arm vertical bar", "arm horizontal bar", "back vertical bar", "back horizontal bar", "door", "drawer", "shelf"]:
-                val += "s"
-                text = text.replace("is the %s"%name, "are the %s"%name)
-              if val in ["arm", "arm vertical bar", "arm horizontal bar"]: text = text.replace("a %s"%val, "an %s"%val)
-
-      text = text.replace(name, val)
-      text = ' '.join(text.split())
-
-    # text = replace_optionals(text)
-    # text = ' '.join(text.split())
-    # text = other_heuristic(text, state['vals'])
-    text = text.lower()
-    # text = text.replace("leg", "visible leg")
-    if "<s" in text:
-      if "stable" in text: text = text.replace("<s> with <ct> <cl> <p>", "unstable object")
-      text = text.replace("<s1> with <ct1> <cl1> <p1>", "object").replace("<s1>s with <ct1> <cl1> <p1>", "objects").replace("<s2> with <ct2> <cl2> <p2>", "object").replace("<s3> with <ct3> <cl3> <p3>", "thing").replace("<s2>s with <ct2> <cl2> <p2>", "things").replace("<s3>s with <ct3> <cl3> <p3>", "objects").replace("<s1>", "object").replace("<s1>s", "things").replace("<s2>", "object").replace("<s2>s", "things").replace("<s>", "thing").replace("<s>s", "objects").replace("<s> with <ct> <cl> <p>", "thing").replace("<s>s with <ct> <cl> <p>", "objects")
-    # text = text.replace("leg", "visible leg").replace("wheel", "visible wheel").replace("arm", "visible arm")
-    text = text.replace("make the thing stable", "make the unstable object stable").replace("make the object stable", "make the unstable object stable")
-    text = text.replace("shelfs", "shelves")
-    # print (text)
+    compiled = random.choice(compiled_texts)
+    text = realize_template_text(compiled, state['vals'], synonyms)
     text_questions.append(text)
 
     if answers[0] in ["red", "yellow", "blue", "green", "cyan", "gray", "brown", "purple"] and answers[0] in text_questions[0] and ("perpendicular" in text_questions[0] or "parallel" in text_questions[0] or "geome" in text_questions[0]):
@@ -793,6 +863,128 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
 
   return text_questions, structured_questions, answers
 
+
+PLACEHOLDER_RE = re.compile(r'(<[A-Z]+\d*>)')
+
+# Parts that are referred to in the plural when the template gives no count
+# for them; all other parts stay singular in that case
+PLURAL_PARTS = frozenset([
+  "arm", "leg", "leg bar", "wheel", "arm vertical bar", "arm horizontal bar",
+  "back vertical bar", "back horizontal bar", "door", "drawer", "shelf",
+])
+IRREGULAR_PLURALS = {'shelf': 'shelves'}
+
+# Stand-ins for object descriptions whose parameters were never bound, keyed
+# by the lower-cased placeholder text they replace. The bare '<s>' with its
+# part description is handled separately since it depends on the question.
+UNBOUND_PHRASES = {
+  '<s1> with <ct1> <cl1> <p1>': 'object',
+  '<s1>s with <ct1> <cl1> <p1>': 'objects',
+  '<s2> with <ct2> <cl2> <p2>': 'object',
+  '<s2>s with <ct2> <cl2> <p2>': 'things',
+  '<s3> with <ct3> <cl3> <p3>': 'thing',
+  '<s3>s with <ct3> <cl3> <p3>': 'objects',
+  '<s> with <ct> <cl> <p>': 'unstable object',
+  '<s1>': 'object',
+  '<s2>': 'object',
+  '<s>': 'thing',
+}
+CLEANUP_PHRASES = {
+  'make the thing stable': 'make the unstable object stable',
+  'make the object stable': 'make the unstable object stable',
+  'shelfs': 'shelves',
+}
+
+
+def phrase_pattern(phrases):
+  # Longest first so that a phrase wins over any of its prefixes
+  keys = sorted(phrases, key=len, reverse=True)
+  return re.compile('|'.join(re.escape(k) for k in keys))
+
+UNBOUND_RE = phrase_pattern(UNBOUND_PHRASES)
+CLEANUP_RE = phrase_pattern(CLEANUP_PHRASES)
+
+
+def pluralize(word):
+  return IRREGULAR_PLURALS.get(word, word + 's')
+
+
+def compile_template_text(text):
+  """
+  Splits a template text once into literal chunks and parameter slots so
+  that instantiating it is a single pass over the chunks. Returns a dict with
+
+  - parts: list alternating literal chunks and placeholder names, starting
+    and ending with a (possibly empty) literal
+  - slots: maps each placeholder name to its indices in parts
+  """
+  parts = PLACEHOLDER_RE.split(text)
+  slots = {}
+  for idx in range(1, len(parts), 2):
+    slots.setdefault(parts[idx], []).append(idx)
+  return {'parts': parts, 'slots': slots}
+
+
+def realize_template_text(compiled, vals, synonyms):
+  """
+  Fills the slots of a compiled template text with the parameter values of a
+  final DFS state, drawing synonyms in the order the values were bound.
+  Placeholders without a value are replaced by generic stand-ins.
+  """
+  parts = list(compiled['parts'])
+  slots = compiled['slots']
+  for name, val in vals.items():
+    if isinstance(val, dict):
+      val = str(list(val.values())[0])
+    if isinstance(val, list) or isinstance(val, tuple):
+      val = val[0]
+    if isinstance(val, int):
+      val = str(val)
+    idxs = slots.get(name, ())
+
+    if 'S' in name:
+      if val == "":
+        val = "thing"
+      # Drop the part description of an object that is not filtered by part
+      if vals.get(name.replace('S', 'P'), None) == '':
+        for idx in idxs:
+          after = parts[idx + 1]
+          if after.startswith(' with'):
+            parts[idx + 1] = after[5:]
+          elif after.startswith('s with'):
+            parts[idx + 1] = 's' + after[6:]
+
+    if val in synonyms:
+      val = random.choice(synonyms[val])
+
+    if 'P' in name and val != '':
+      ct = name.replace('P', 'CT')
+      if ct in vals and vals[ct] != "":
+        plural = int(vals[ct][val]) > 1
+      else:
+        # The template pluralizes the part itself with a trailing 's'
+        plural = val in PLURAL_PARTS and not any(parts[idx + 1].startswith('s') for idx in idxs)
+      if plural:
+        val = pluralize(val)
+        for idx in idxs:
+          if parts[idx - 1].endswith('is the '):
+            parts[idx - 1] = parts[idx - 1][:-len('is the ')] + 'are the '
+
+    for idx in idxs:
+      parts[idx] = val
+
+  text = ' '.join(''.join(parts).split()).lower()
+  if '<s' in text:
+    stable = 'stable' in text
+    def unbound(match):
+      phrase = match.group(0)
+      if phrase == '<s> with <ct> <cl> <p>' and not stable:
+        return 'thing' + phrase[len('<s>'):]
+      return UNBOUND_PHRASES[phrase]
+    text = UNBOUND_RE.sub(unbound, text)
+  return CLEANUP_RE.sub(lambda match: CLEANUP_PHRASES[match.group(0)], text)
+
+
 def replace_optionals(s):
   """
   Each substring of s that is surrounded in square brackets is treated as
@@ -903,6 +1095,7 @@ def main(args):
 
   questions = []
   scene_count = 0
+  dfs_stats = {}
   for i, scene in tqdm(enumerate(all_scenes)):
     if "question" in scene and scene["question"] == False: continue
     scene_fn = scene['image_filename']
@@ -911,13 +1104,7 @@ def main(args):
     scene_questions = []
     if question_fn in os.listdir(args.output_dir): continue
 
-    scene_struct = scene
-
-    for (i, obj) in enumerate(scene_struct['objects']):
-      try:
-        if obj['line_geo'] == dict() and obj['plane_geo'] == dict(): scene_struct['objects'][i]['question_type'].remove("geometry")
-      except:
-        obj['question_type'] = ['perception']
+    scene_struct = qeng.prepare_scene(scene)
 
     print('starting image %s (%d / %d)'
           % (scene_fn, i + 1, len(all_scenes)))
@@ -949,7 +1136,9 @@ def main(args):
         template_answer_counts[(fn, idx)],
         synonyms,
         max_instances=args.instances_per_template,
-        verbose=False)
+        verbose=False,
+        goal_directed=args.goal_directed,
+        dfs_stats=dfs_stats)
       if args.time_dfs and args.verbose:
         toc = time.time()
         print('that took ', toc - tic)
@@ -999,6 +1188,13 @@ def main(args):
         'questions': scene_questions,
       }, f)
 
+  if dfs_stats:
+    print('DFS executed %d states; %d finished questions were rejected by answer balancing'
+          % (dfs_stats['states'], dfs_stats['rejected']))
+    if args.goal_directed:
+      print('goal-directed DFS pruned %d states and %d filter options before executing them'
+            % (dfs_stats['pruned_states'], dfs_stats['pruned_options']))
+
 
 # Code below might not be necessary, why change the name of side_inputs to value_inputs
 # and write the file again in current working directory?
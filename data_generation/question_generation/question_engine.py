@@ -15,6 +15,79 @@ in a JSON metadata file.
 # value from this node.
 
 
+class SceneIndex(object):
+  """
+  Lookup tables derived from one scene, each built the first time a handler
+  asks for it. Only the index of the most recently queried scene is kept
+  (see get_scene_index), so nothing is stored in the scene itself and the
+  tables go away once the next scene is processed.
+  """
+  def __init__(self, scene_struct):
+    self.scene_struct = scene_struct
+    self._relation_masks = None
+    self._classes = {}
+
+  def equivalence_classes(self, attribute, part=None):
+    """
+    Groups objects by their value of attribute, or of attribute[part] when a
+    part is given, in which case objects without that part are left out.
+    Returns a dict mapping each value (see hashable_value) to the sorted
+    indices of the objects that have it.
+    """
+    key = (attribute, part)
+    if key not in self._classes:
+      classes = {}
+      for idx, obj in enumerate(self.scene_struct['objects']):
+        if part is None:
+          value = obj[attribute]
+        elif part in obj[attribute]:
+          value = obj[attribute][part]
+        else:
+          continue
+        classes.setdefault(hashable_value(value), []).append(idx)
+      self._classes[key] = classes
+    return self._classes[key]
+
+  def relation_masks(self):
+    """
+    Returns (names, bits, masks, decoded): the relation names, the bit of
+    each relation, an N x N integer array whose entry [i, j] has the bit of
+    every relation r with j in relationships[r][i] set, and a cache mapping
+    a mask to its list of relation names in scene order.
+    """
+    if self._relation_masks is None:
+      relationships = self.scene_struct['relationships']
+      names = list(relationships.keys())
+      bits = {name: 1 << i for i, name in enumerate(names)}
+      num_objects = len(self.scene_struct['objects'])
+      masks = np.zeros((num_objects, num_objects), dtype=np.int64)
+      for name, related in relationships.items():
+        for idx1, idxs2 in enumerate(related):
+          if idxs2:
+            masks[idx1, idxs2] |= bits[name]
+      self._relation_masks = (names, bits, masks, {})
+    return self._relation_masks
+
+
+_scene_index = None
+
+
+def hashable_value(value):
+  # Scene attributes are JSON values; lists and dicts compare by content
+  if isinstance(value, list):
+    return tuple(hashable_value(v) for v in value)
+  if isinstance(value, dict):
+    return tuple(sorted((k, hashable_value(v)) for k, v in value.items()))
+  return value
+
+
+def get_scene_index(scene_struct):
+  global _scene_index
+  if _scene_index is None or _scene_index.scene_struct is not scene_struct:
+    _scene_index = SceneIndex(scene_struct)
+  return _scene_index
+
+
 def scene_handler(scene_struct, inputs, side_inputs):
   # Just return all objects in the scene
   return list(range(len(scene_struct['objects'])))
@@ -110,39 +183,22 @@ def count_handler(scene_struct, inputs, side_inputs):
 
 def make_same_attr_handler(attribute):
   def same_attr_handler(scene_struct, inputs, side_inputs):
-    cache_key = '_same_%s' % attribute
-    
-    if cache_key not in scene_struct:
-      cache = {}
-      for i, obj1 in enumerate(scene_struct['objects']):
-        same = []
-        for j, obj2 in enumerate(scene_struct['objects']):
-          if i != j and obj1["category"] == obj2["category"]:
-            same.append(j)
-        cache[i] = same
-      scene_struct[cache_key] = cache
-
-    cache = scene_struct[cache_key]
     assert len(inputs) == 1
     assert len(side_inputs) == 0
-    return cache[inputs[0]]
+    i = inputs[0]
+    classes = get_scene_index(scene_struct).equivalence_classes('category')
+    value = hashable_value(scene_struct['objects'][i]['category'])
+    return [j for j in classes[value] if j != i]
   return same_attr_handler
 
 def make_same_part_attr_handler(attribute):
   def same_attr_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
     part = side_inputs[0]
-
     i = inputs[0]
-    obj1 = scene_struct['objects'][i]
-    
-    same = []
-    for j, obj2 in enumerate(scene_struct['objects']):
-      
-      if i != j and part in obj2[attribute].keys() and obj1[attribute][part] == obj2[attribute][part]:
-        same.append(j)
-
-    assert len(inputs) == 1
-    return same
+    classes = get_scene_index(scene_struct).equivalence_classes(attribute, part)
+    value = hashable_value(scene_struct['objects'][i][attribute][part])
+    return [j for j in classes[value] if j != i]
   return same_attr_handler
 
 
@@ -374,13 +430,12 @@ def query_position_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 2
   idx1 = inputs[0]
   idx2 = inputs[1]
-  rels = []
-  for rel, value in scene_struct["relationships"].items():
-    idx1_rel = value[idx1]
-    if idx2 in idx1_rel:
-      rels.append(rel)
-  
-  return rels
+  names, bits, masks, decoded = get_scene_index(scene_struct).relation_masks()
+  mask = int(masks[idx1, idx2])
+  if mask not in decoded:
+    decoded[mask] = [rel for rel in names if mask & bits[rel]]
+  # Copy since the output is cached on the program node
+  return list(decoded[mask])
 
 def query_position_analogy_handler(attribute):
   def query_handler(scene_struct, inputs, side_inputs):
@@ -389,14 +444,14 @@ def query_position_analogy_handler(attribute):
 
     idx1 = inputs[1]
 
-    same_rels = []
-    for idx2 in range(len(scene_struct["objects"])):
-      if idx1 == idx2: continue
-      same_related = True
-      for rel in rels:
-        if not idx2 in scene_struct["relationships"][rel][idx1]: same_related = False
-      if same_related:
-        same_rels.append(idx2)
+    names, bits, masks, decoded = get_scene_index(scene_struct).relation_masks()
+    required = 0
+    for rel in rels:
+      required |= bits[rel]
+    row = masks[idx1]
+    same = (row & required) == required
+    same[idx1] = False
+    same_rels = np.flatnonzero(same).tolist()
 
     if 'count' in attribute: return len(same_rels)
     elif 'exist' in attribute: return len(same_rels) > 0
@@ -766,6 +821,20 @@ def is_degenerate(question, metadata, scene_struct, answer=None, verbose=False):
 
   return False
 
+def prepare_scene(scene_struct):
+  """
+  Normalize the per-object question types of a scene loaded from disk before
+  any question is instantiated or re-answered on it: objects without any
+  line or plane geometry cannot be asked geometry questions, and objects
+  missing the annotations entirely only support perception questions.
+  """
+  for obj in scene_struct['objects']:
+    try:
+      if obj['line_geo'] == dict() and obj['plane_geo'] == dict(): obj['question_type'].remove("geometry")
+    except:
+      obj['question_type'] = ['perception']
+  return scene_struct
+
 def getTemplateTypes(args):
   if args.template_types == '*':
     template_types_list = os.listdir(args.template_dir)
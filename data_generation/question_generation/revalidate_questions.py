@@ -0,0 +1,213 @@
+"""
+Re-executes the program of every generated question against its scene and
+reports answers that no longer match, e.g. after the scene annotations or the
+question engine handlers have changed. Each worker handles one question file
+(one scene) at a time, so the scene is loaded once and every program executed
+on it is memoized.
+"""
+
+from __future__ import print_function
+import argparse, json, os, time
+from multiprocessing import Pool
+import question_engine as qeng
+
+parser = argparse.ArgumentParser()
+
+# Inputs
+parser.add_argument('--input_scene_files', default='../output/scenes/',
+                    help="Directory containing the JSON scene files the questions were " +
+                         "generated from")
+parser.add_argument('--input_question_dir', default='out/',
+                    help="Directory containing the *_question.json files written by " +
+                         "generate_questions_partnet.py")
+parser.add_argument('--metadata_file', default='question_generation/metadata_partnet.json',
+                    help="JSON file containing metadata about functions")
+
+# Control
+parser.add_argument('--num_workers', default=os.cpu_count(), type=int,
+                    help="Number of worker processes used to re-answer questions")
+parser.add_argument('--rewrite', action='store_true',
+                    help="Rewrite mismatching answers in place with the re-computed ones")
+parser.add_argument('--max_report', default=20, type=int,
+                    help="Maximum number of mismatches to print; 0 prints all of them")
+parser.add_argument('--verbose', action='store_true',
+                    help="Print one line per question file")
+
+
+_metadata = None
+
+
+def init_worker(metadata_file):
+  global _metadata
+  with open(metadata_file, 'r') as f:
+    _metadata = json.load(f)
+
+
+def normalize(value):
+  # Answers round-trip through JSON on disk, so compare them in that form
+  return json.loads(json.dumps(value))
+
+
+def strip_outputs(program):
+  """
+  Programs are dumped with the '_output' values cached on their nodes during
+  the DFS; drop those so every node is executed again on the current scene.
+  """
+  nodes = []
+  for node in program:
+    nodes.append({k: v for k, v in node.items() if k != '_output'})
+  return nodes
+
+
+def revalidate_file(task):
+  question_path, scene_dir, rewrite = task
+  tic = time.time()
+  with open(question_path, 'r') as f:
+    question_data = json.load(f)
+  questions = question_data['questions']
+
+  stats = {
+    'path': question_path,
+    'questions': len(questions),
+    'mismatches': [],
+    'invalid': 0,
+    'errors': [],
+    'memo_hits': 0,
+    'missing_scene': False,
+    'rewritten': False,
+  }
+  if not questions:
+    stats['time'] = time.time() - tic
+    return stats
+
+  scene_fn = questions[0]['image_filename'].replace('.png', '.json')
+  scene_path = os.path.join(scene_dir, scene_fn)
+  if not os.path.isfile(scene_path):
+    stats['missing_scene'] = True
+    stats['time'] = time.time() - tic
+    return stats
+  with open(scene_path, 'r') as f:
+    scene_struct = qeng.prepare_scene(json.load(f))
+
+  # Identical programs are common across templates of one scene
+  memo = {}
+  changed = False
+  for q in questions:
+    nodes = strip_outputs(q['program'])
+    key = json.dumps(nodes, sort_keys=True)
+    if key in memo:
+      stats['memo_hits'] += 1
+      answer, outputs = memo[key]
+    else:
+      try:
+        outputs = qeng.answer_question({'nodes': nodes}, _metadata, scene_struct,
+                                       all_outputs=True)
+      except Exception as err:
+        # Stale side inputs (e.g. a part that is no longer visible) can make
+        # a handler fail outright instead of returning __INVALID__
+        stats['errors'].append({
+          'question_index': q.get('question_index'),
+          'question': q['question'],
+          'error': repr(err),
+        })
+        continue
+      answer = normalize(outputs[-1])
+      outputs = normalize(outputs)
+      memo[key] = (answer, outputs)
+
+    if answer == '__INVALID__':
+      stats['invalid'] += 1
+    if answer != normalize(q['answer']):
+      stats['mismatches'].append({
+        'question_index': q.get('question_index'),
+        'question': q['question'],
+        'old_answer': q['answer'],
+        'new_answer': answer,
+      })
+      if rewrite and answer != '__INVALID__':
+        q['answer'] = answer
+        for node, output in zip(q['program'], outputs):
+          if '_output' in node:
+            node['_output'] = output
+        changed = True
+
+  if changed:
+    # Write next to the original and swap it in so readers never see a
+    # partially written file
+    tmp_path = question_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(question_data, f)
+    os.replace(tmp_path, question_path)
+    stats['rewritten'] = True
+
+  stats['time'] = time.time() - tic
+  return stats
+
+
+def main(args):
+  question_files = sorted(fn for fn in os.listdir(args.input_question_dir)
+                          if fn.endswith('_question.json'))
+  tasks = [(os.path.join(args.input_question_dir, fn), args.input_scene_files, args.rewrite)
+           for fn in question_files]
+  print('Re-validating %d question files with %d workers'
+        % (len(tasks), args.num_workers))
+
+  num_questions = 0
+  num_invalid = 0
+  num_memo_hits = 0
+  num_rewritten = 0
+  missing_scenes = []
+  mismatches = []
+  errors = []
+
+  tic = time.time()
+  pool = Pool(args.num_workers, initializer=init_worker,
+              initargs=(args.metadata_file,))
+  try:
+    for stats in pool.imap_unordered(revalidate_file, tasks, chunksize=4):
+      num_questions += stats['questions']
+      num_invalid += stats['invalid']
+      num_memo_hits += stats['memo_hits']
+      if stats['missing_scene']:
+        missing_scenes.append(stats['path'])
+      if stats['rewritten']:
+        num_rewritten += 1
+      for m in stats['mismatches']:
+        m['path'] = stats['path']
+        mismatches.append(m)
+      for e in stats['errors']:
+        e['path'] = stats['path']
+        errors.append(e)
+      if args.verbose:
+        print('%s: %d questions, %d mismatches (%.3fs)'
+              % (stats['path'], stats['questions'], len(stats['mismatches']), stats['time']))
+  finally:
+    pool.close()
+    pool.join()
+  toc = time.time()
+
+  shown = mismatches if args.max_report == 0 else mismatches[:args.max_report]
+  for m in shown:
+    print('MISMATCH %s [%s] "%s": %r -> %r'
+          % (m['path'], m['question_index'], m['question'], m['old_answer'], m['new_answer']))
+  if len(shown) < len(mismatches):
+    print('... %d more mismatches not shown' % (len(mismatches) - len(shown)))
+  for e in errors:
+    print('ERROR %s [%s] "%s": %s'
+          % (e['path'], e['question_index'], e['question'], e['error']))
+  for path in missing_scenes:
+    print('MISSING SCENE for %s' % path)
+
+  elapsed = max(toc - tic, 1e-9)
+  print('Checked %d questions from %d files in %.2fs (%.1f questions/s, %.1f files/s)'
+        % (num_questions, len(tasks), elapsed, num_questions / elapsed, len(tasks) / elapsed))
+  print('%d mismatches, %d programs now __INVALID__, %d failing programs, %d memoized programs, '
+        '%d missing scenes'
+        % (len(mismatches), num_invalid, len(errors), num_memo_hits, len(missing_scenes)))
+  if args.rewrite:
+    print('Rewrote answers in %d question files' % num_rewritten)
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)